@@ -0,0 +1,256 @@
+""" CloudResourceCatalogue keeps an indexed in-memory view of the cloud resources
+    described in the /Resources/Sites section of the CS. The view is built once with
+    a single walk of the CS tree and rebuilt when the CS version changes.
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import copy
+import threading
+
+import six
+
+from DIRAC import S_OK, S_ERROR, gLogger, gConfig
+from DIRAC.ConfigurationSystem.private.ConfigurationData import gConfigurationData
+from DIRAC.Core.Utilities.List import fromChar
+
+__RCSID__ = "$Id$"
+
+
+class CloudResourceCatalogue(object):
+  """ Catalogue of the cloud sites, endpoints and VM types
+
+      The catalogue has the following structure::
+
+        { site: { 'Grid': grid,
+                  'VO': list of VOs or None,
+                  'CEs': { ce: { 'Options': CE options dictionary,
+                                 'VO': list of VOs or None,
+                                 'Error': message if the VM types can not be listed,
+                                 'VMTypes': { vmType: { 'Options': VM type options dictionary,
+                                                        'VO': list of VOs or None,
+                                                        'Legacy': True if defined in the Images section } } } } } }
+
+      and is completed by an index of the (site, ce) pairs available to each VO
+  """
+
+  def __init__(self):
+    """ c'tor
+    """
+    self.log = gLogger.getSubLogger('CloudResourceCatalogue')
+    self.__lock = threading.Lock()
+    self.__csVersion = None
+    self.__sites = {}
+    self.__siteOrder = []
+    self.__voIndex = {None: []}
+
+  def __refresh(self):
+    """ Rebuild the catalogue if the CS version changed since it was last built
+    """
+    csVersion = gConfigurationData.getVersion()
+    with self.__lock:
+      if self.__csVersion is not None and csVersion == self.__csVersion:
+        return
+      self.log.verbose('Loading the cloud resources for CS version %s' % csVersion)
+      self.__load()
+      self.__csVersion = csVersion
+
+  def __load(self):
+    """ Walk the /Resources/Sites section and build the catalogue with its VO index
+    """
+    sites = {}
+    siteOrder = []
+
+    result = gConfig.getSections('/Resources/Sites')
+    grids = result['Value'] if result['OK'] else []
+    for grid in grids:
+      result = gConfig.getSections('/Resources/Sites/%s' % grid)
+      if not result['OK']:
+        continue
+      for site in result['Value']:
+        sitePath = '/Resources/Sites/%s/%s' % (grid, site)
+        result = gConfig.getSections('%s/Cloud' % sitePath)
+        if not result['OK']:
+          continue
+        siteDict = {'Grid': grid,
+                    'VO': gConfig.getValue('%s/VO' % sitePath, []) or None,
+                    'CEs': {},
+                    'CEOrder': []}
+        for ce in result['Value']:
+          cePath = '%s/Cloud/%s' % (sitePath, ce)
+          result = gConfig.getOptionsDict(cePath)
+          if not result['OK']:
+            continue
+          ceDict = {'Options': result['Value'],
+                    'VO': gConfig.getValue('%s/VO' % cePath, []) or None,
+                    'Error': None,
+                    'VMTypes': {},
+                    'VMTypeOrder': []}
+          legacy = False
+          result = gConfig.getSections('%s/VMTypes' % cePath)
+          if not result['OK']:
+            legacy = True
+            result = gConfig.getSections('%s/Images' % cePath)
+          if not result['OK']:
+            ceDict['Error'] = result['Message']
+          else:
+            for vmType in result['Value']:
+              vmTypeLegacy = legacy
+              result = gConfig.getOptionsDict('%s/VMTypes/%s' % (cePath, vmType))
+              if not result['OK']:
+                vmTypeLegacy = True
+                result = gConfig.getOptionsDict('%s/Images/%s' % (cePath, vmType))
+                if not result['OK']:
+                  continue
+              voList = gConfig.getValue('%s/VMTypes/%s/VO' % (cePath, vmType), [])
+              if not voList:
+                voList = gConfig.getValue('%s/Images/%s/VO' % (cePath, vmType), [])
+              ceDict['VMTypes'][vmType] = {'Options': result['Value'],
+                                           'VO': voList or None,
+                                           'Legacy': vmTypeLegacy}
+              ceDict['VMTypeOrder'].append(vmType)
+          siteDict['CEs'][ce] = ceDict
+          siteDict['CEOrder'].append(ce)
+        if site not in sites:
+          siteOrder.append(site)
+        sites[site] = siteDict
+
+    # VO index: the endpoints of sites and CEs without VO restriction are available to
+    # any VO, the others to the VOs common to the site and CE restrictions
+    allVOs = set()
+    for siteDict in sites.values():
+      allVOs.update(siteDict['VO'] or [])
+      for ceDict in siteDict['CEs'].values():
+        allVOs.update(ceDict['VO'] or [])
+        for vmTypeDict in ceDict['VMTypes'].values():
+          allVOs.update(vmTypeDict['VO'] or [])
+    voIndex = dict((vo, []) for vo in allVOs)
+    voIndex[None] = []
+    for site in siteOrder:
+      siteDict = sites[site]
+      for ce in siteDict['CEOrder']:
+        allowed = self.__intersectVOs(siteDict['VO'], siteDict['CEs'][ce]['VO'])
+        for vo in voIndex:
+          if allowed is None or vo in allowed:
+            voIndex[vo].append((site, ce))
+
+    self.__sites = sites
+    self.__siteOrder = siteOrder
+    self.__voIndex = voIndex
+
+  @staticmethod
+  def __intersectVOs(*voLists):
+    """ Get the VOs allowed by all the given VO restrictions, None meaning no restriction
+    """
+    allowed = None
+    for voList in voLists:
+      if voList:
+        allowed = set(voList) if allowed is None else allowed & set(voList)
+    return allowed
+
+  def getVMTypes(self, siteList=None, ceList=None, vmTypeList=None, vo=None):
+    """ Get CE/vmType options according to the specified selection
+
+    :param list siteList: sites to consider, all if None
+    :param list ceList: endpoints to consider, all if None
+    :param list vmTypeList: VM types to consider, all if None
+    :param str vo: VO the resources must be available to
+    :return: S_OK({site: {ce: ceOptionsDict with 'VMTypes': {vmType: vmTypeOptionsDict}}})/S_ERROR
+    """
+    self.__refresh()
+
+    if isinstance(siteList, six.string_types):
+      siteList = [siteList]
+    if isinstance(ceList, six.string_types):
+      ceList = [ceList]
+    if isinstance(vmTypeList, six.string_types):
+      vmTypeList = [vmTypeList]
+
+    with self.__lock:
+      sites = self.__sites
+      if vo:
+        pairs = self.__voIndex.get(vo, self.__voIndex[None])
+      else:
+        pairs = [(site, ce) for site in self.__siteOrder for ce in sites[site]['CEOrder']]
+
+    if siteList is not None:
+      siteSet = set(siteList)
+      pairs = [(site, ce) for site, ce in pairs if site in siteSet]
+    if ceList is not None:
+      ceSet = set(ceList)
+      pairs = [(site, ce) for site, ce in pairs if ce in ceSet]
+
+    resultDict = {}
+    for site, ce in pairs:
+      ceDict = sites[site]['CEs'][ce]
+      if ceDict['Error']:
+        return S_ERROR(ceDict['Error'])
+      if vmTypeList is not None:
+        vmTypes = [vmType for vmType in vmTypeList if vmType in ceDict['VMTypes']]
+      else:
+        vmTypes = ceDict['VMTypeOrder']
+      for vmType in vmTypes:
+        vmTypeDict = ceDict['VMTypes'][vmType]
+        if vo and vmTypeDict['VO'] and vo not in vmTypeDict['VO']:
+          continue
+        resultDict.setdefault(site, {})
+        resultDict[site].setdefault(ce, copy.deepcopy(ceDict['Options']))
+        resultDict[site][ce].setdefault('VMTypes', {})
+        resultDict[site][ce]['VMTypes'][vmType] = copy.deepcopy(vmTypeDict['Options'])
+
+    return S_OK(resultDict)
+
+  def getVMTypeConfig(self, site, ce='', vmtype=''):
+    """ Get parameters of the specified VM type
+
+    :param str site: site name
+    :param str ce: endpoint name, can be omitted if the site has only one
+    :param str vmtype: VM type name, only the endpoint parameters are returned if omitted
+    :return: S_OK(parameters dictionary)/S_ERROR
+    """
+    self.__refresh()
+
+    grid = site.split('.')[0]
+    with self.__lock:
+      siteDict = self.__sites.get(site)
+    if siteDict is None or siteDict['Grid'] != grid:
+      return S_ERROR('Path /Resources/Sites/%s/%s/Cloud does not exist or it\'s not a section' % (grid, site))
+
+    if not ce:
+      if len(siteDict['CEOrder']) == 1:
+        ce = siteDict['CEOrder'][0]
+      else:
+        return S_ERROR('No cloud endpoint specified')
+
+    ceDict = siteDict['CEs'].get(ce)
+    if ceDict is None:
+      return S_ERROR('Path /Resources/Sites/%s/%s/Cloud/%s does not exist or it\'s not a section' % (grid, site, ce))
+
+    Tags = []
+    resultDict = copy.deepcopy(ceDict['Options'])
+    ceTags = resultDict.get('Tag')
+    if ceTags:
+      Tags = fromChar(ceTags)
+    resultDict['CEName'] = ce
+
+    if vmtype:
+      vmTypeDict = ceDict['VMTypes'].get(vmtype)
+      if vmTypeDict is None or vmTypeDict['Legacy']:
+        return S_ERROR('Path /Resources/Sites/%s/%s/Cloud/%s/VMTypes/%s does not exist or it\'s not a section' %
+                       (grid, site, ce, vmtype))
+      resultDict.update(copy.deepcopy(vmTypeDict['Options']))
+      queueTags = resultDict.get('Tag')
+      if queueTags:
+        queueTags = fromChar(queueTags)
+        Tags = list(set(Tags + queueTags))
+
+    if Tags:
+      resultDict['Tag'] = Tags
+    resultDict['VMType'] = vmtype
+    resultDict['Site'] = site
+    return S_OK(resultDict)
+
+
+gCloudResourceCatalogue = CloudResourceCatalogue()
@@ -13,7 +13,8 @@ import six
 from DIRAC import S_OK, S_ERROR, gLogger, gConfig
 from DIRAC.ConfigurationSystem.Client.Helpers import Registry, Operations
 from DIRAC.FrameworkSystem.Client.ProxyManagerClient import gProxyManager
-from DIRAC.Core.Utilities.List import fromChar
+
+from VMDIRAC.Resources.Cloud.CloudResourceCatalogue import gCloudResourceCatalogue
 
 __RCSID__ = "$Id$"
 
@@ -46,109 +47,13 @@ def findGenericCloudCredentials(vo=False, group=False):
 def getVMTypes(siteList=None, ceList=None, vmTypeList=None, vo=None):
   """ Get CE/vmType options according to the specified selection
   """
-
-  result = gConfig.getSections('/Resources/Sites')
-  if not result['OK']:
-    return result
-
-  resultDict = {}
-
-  grids = result['Value']
-  for grid in grids:
-    result = gConfig.getSections('/Resources/Sites/%s' % grid)
-    if not result['OK']:
-      continue
-    sites = result['Value']
-    for site in sites:
-      if siteList is not None and site not in siteList:
-        continue
-      if vo:
-        voList = gConfig.getValue('/Resources/Sites/%s/%s/VO' % (grid, site), [])
-        if voList and vo not in voList:
-          continue
-      result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud' % (grid, site))
-      if not result['OK']:
-        continue
-      ces = result['Value']
-      for ce in ces:
-        if ceList is not None and ce not in ceList:
-          continue
-        if vo:
-          voList = gConfig.getValue('/Resources/Sites/%s/%s/Cloud/%s/VO' % (grid, site, ce), [])
-          if voList and vo not in voList:
-            continue
-        result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s' % (grid, site, ce))
-        if not result['OK']:
-          continue
-        ceOptionsDict = result['Value']
-        result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud/%s/VMTypes' % (grid, site, ce))
-        if not result['OK']:
-          result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud/%s/Images' % (grid, site, ce))
-          if not result['OK']:
-            return result
-        vmTypes = result['Value']
-        for vmType in vmTypes:
-          if vmTypeList is not None and vmType not in vmTypeList:
-            continue
-          if vo:
-            voList = gConfig.getValue('/Resources/Sites/%s/%s/Cloud/%s/VMTypes/%s/VO' % (grid, site, ce, vmType), [])
-            if not voList:
-              voList = gConfig.getValue('/Resources/Sites/%s/%s/Cloud/%s/Images/%s/VO' % (grid, site, ce, vmType), [])
-            if voList and vo not in voList:
-              continue
-          resultDict.setdefault(site, {})
-          resultDict[site].setdefault(ce, ceOptionsDict)
-          resultDict[site][ce].setdefault('VMTypes', {})
-          result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s/VMTypes/%s' % (grid, site, ce, vmType))
-          if not result['OK']:
-            result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s/Images/%s' % (grid, site, ce, vmType))
-            if not result['OK']:
-              continue
-          vmTypeOptionsDict = result['Value']
-          resultDict[site][ce]['VMTypes'][vmType] = vmTypeOptionsDict
-
-  return S_OK(resultDict)
+  return gCloudResourceCatalogue.getVMTypes(siteList=siteList, ceList=ceList, vmTypeList=vmTypeList, vo=vo)
 
 
 def getVMTypeConfig(site, ce='', vmtype=''):
   """ Get parameters of the specified queue
   """
-  Tags = []
-  grid = site.split('.')[0]
-  if not ce:
-    result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud' % (grid, site))
-    if not result['OK']:
-      return result
-    ceList = result['Value']
-    if len(ceList) == 1:
-      ce = ceList[0]
-    else:
-      return S_ERROR('No cloud endpoint specified')
-
-  result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s' % (grid, site, ce))
-  if not result['OK']:
-    return result
-  resultDict = result['Value']
-  ceTags = resultDict.get('Tag')
-  if ceTags:
-    Tags = fromChar(ceTags)
-  resultDict['CEName'] = ce
-
-  if vmtype:
-    result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s/VMTypes/%s' % (grid, site, ce, vmtype))
-    if not result['OK']:
-      return result
-    resultDict.update(result['Value'])
-    queueTags = resultDict.get('Tag')
-    if queueTags:
-      queueTags = fromChar(queueTags)
-      Tags = list(set(Tags + queueTags))
-
-  if Tags:
-    resultDict['Tag'] = Tags
-  resultDict['VMType'] = vmtype
-  resultDict['Site'] = site
-  return S_OK(resultDict)
+  return gCloudResourceCatalogue.getVMTypeConfig(site, ce=ce, vmtype=vmtype)
 
 
 def getPilotBootstrapParameters(vo='', runningPod=''):
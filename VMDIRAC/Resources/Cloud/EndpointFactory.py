@@ -2,12 +2,16 @@
 # File :   EndpointFactory.py
 # Author : Andrei Tsaregorodtsev
 ########################################################################
-"""  The Cloud Endpoint Factory has one method that instantiates a given Cloud Endpoint
+"""  The Cloud Endpoint Factory instantiates a given Cloud Endpoint, either directly or as
+     a LazyEndpoint handle connecting to the cloud on first use
 """
 from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from DIRAC import S_OK, S_ERROR, gLogger
 from DIRAC.Core.Utilities import ObjectLoader
 from VMDIRAC.Resources.Cloud.ConfigHelper import getVMTypeConfig
@@ -15,6 +19,85 @@ from VMDIRAC.Resources.Cloud.ConfigHelper import getVMTypeConfig
 __RCSID__ = "$Id$"
 
 
+class LazyEndpoint(object):
+  """ Handle of a Cloud Endpoint which is only instantiated, with the network I/O done by the
+      endpoint constructors, when it is first used or when connect() is called. If the
+      endpoint can not be instantiated, the handle is not valid and its methods return S_ERROR
+  """
+
+  def __init__(self, ceClass, parameters, className):
+    """ c'tor
+
+    :param ceClass: Endpoint class
+    :param dict parameters: endpoint parameters, updated by setParameters() before the connection
+    :param str className: endpoint class name used in the messages
+    """
+    self.__ceClass = ceClass
+    self.__parameters = parameters
+    self.__bootstrapParameters = {}
+    self.__className = className
+    self.__lock = threading.Lock()
+    self.__endpoint = None
+    self.__error = None
+    self.log = gLogger.getSubLogger('LazyEndpoint')
+
+  def isConnected(self):
+    """ Check if the endpoint was already instantiated, successfully or not
+    """
+    return self.__endpoint is not None or self.__error is not None
+
+  def connect(self):
+    """ Instantiate the endpoint, only once
+
+    :return: S_OK(endpoint)/S_ERROR
+    """
+    with self.__lock:
+      if self.__endpoint is None and self.__error is None:
+        try:
+          endpoint = self.__ceClass(self.__parameters)
+          if self.__bootstrapParameters:
+            endpoint.setBootstrapParameters(self.__bootstrapParameters)
+          self.__endpoint = endpoint
+        except Exception as x:  # pylint: disable=broad-except
+          self.__error = 'EndpointFactory could not instantiate %s object: %s' % (self.__className, str(x))
+          self.log.exception(lException=x)
+          self.log.warn(self.__error)
+    if self.__error is not None:
+      return S_ERROR(self.__error)
+    return S_OK(self.__endpoint)
+
+  def isValid(self):
+    result = self.connect()
+    if not result['OK']:
+      return False
+    return result['Value'].isValid()
+
+  def setParameters(self, parameters):
+    if self.__endpoint is None:
+      self.__parameters.update(parameters)
+    else:
+      self.__endpoint.setParameters(parameters)
+
+  def setBootstrapParameters(self, bootstrapParameters):
+    if self.__endpoint is None:
+      self.__bootstrapParameters.update(bootstrapParameters)
+    else:
+      self.__endpoint.setBootstrapParameters(bootstrapParameters)
+
+  def __getattr__(self, name):
+    """ Delegate to the endpoint, instantiating it if needed
+    """
+    if name.startswith('_'):
+      raise AttributeError(name)
+    result = self.connect()
+    if result['OK']:
+      return getattr(result['Value'], name)
+    if callable(getattr(self.__ceClass, name, None)):
+      error = result['Message']
+      return lambda *args, **kwargs: S_ERROR(error)
+    raise AttributeError('%s: %s' % (name, result['Message']))
+
+
 class EndpointFactory(object):
 
   #############################################################################
@@ -23,20 +106,24 @@ class EndpointFactory(object):
     """
     self.log = gLogger.getSubLogger('EndpointFactory')
 
-  def getCE(self, site, endpoint, image=''):
+  def getCE(self, site, endpoint, image='', lazy=False):
 
     result = getVMTypeConfig(site, endpoint, image)
     if not result['OK']:
       return result
 
     ceParams = result['Value']
-    result = self.getCEObject(parameters=ceParams)
+    result = self.getCEObject(parameters=ceParams, lazy=lazy)
     return result
 
   #############################################################################
-  def getCEObject(self, parameters=None):
+  def getCEObject(self, parameters=None, lazy=False):
     """This method returns the CloudEndpoint instance corresponding to the supplied
        CEUniqueID.  If no corresponding CE is available, this is indicated.
+
+    :param dict parameters: endpoint parameters
+    :param bool lazy: return a LazyEndpoint handle connecting to the cloud on first use
+    :return: S_OK(endpoint)/S_ERROR
     """
     if not parameters:
       parameters = {}
@@ -51,6 +138,9 @@ class EndpointFactory(object):
       return result
 
     ceClass = result['Value']
+    if lazy:
+      return S_OK(LazyEndpoint(ceClass, parameters, subClassName))
+
     try:
       endpoint = ceClass(parameters)
     except Exception as x:
@@ -60,3 +150,20 @@ class EndpointFactory(object):
       return S_ERROR(msg)
 
     return S_OK(endpoint)
+
+  def warmUp(self, endpoints, threads=10):
+    """ Connect the not yet connected LazyEndpoint handles in parallel. The endpoints which can
+        not be instantiated are invalid and do not delay the others
+
+    :param list endpoints: endpoint objects, the ones which are not LazyEndpoint are ignored
+    :param int threads: number of endpoints connected in parallel
+    :return: S_OK(number of valid endpoints connected)
+    """
+    lazyEndpoints = [ep for ep in endpoints if isinstance(ep, LazyEndpoint) and not ep.isConnected()]
+    if not lazyEndpoints:
+      return S_OK(0)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(lazyEndpoints)))) as executor:
+      valid = list(executor.map(lambda ep: ep.isValid(), lazyEndpoints))
+    self.log.verbose('Endpoints connected', '%d valid out of %d' % (valid.count(True), len(lazyEndpoints)))
+    return S_OK(valid.count(True))
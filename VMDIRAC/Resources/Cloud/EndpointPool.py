@@ -0,0 +1,127 @@
+""" EndpointPool keeps cloud endpoint objects alive between calls so that the
+    authentication and the resource discovery done when an endpoint is created
+    are not repeated for every operation on the same cloud.
+
+    The pooled endpoints are shared by concurrent callers and must not be modified:
+    the endpoints authenticated with a proxy get the proxy of the generic cloud
+    credentials when they are created, and are pooled per credentials identity.
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from DIRAC import S_OK, gLogger
+
+from VMDIRAC.Resources.Cloud.ConfigHelper import getVMTypeConfig
+from VMDIRAC.Resources.Cloud.EndpointFactory import EndpointFactory
+from VMDIRAC.WorkloadManagementSystem.Utilities.Utils import getCloudCredentialsForCE, getProxyFileForCE
+
+__RCSID__ = "$Id$"
+
+# Maximum lifetime in seconds of the pooled endpoints using a proxy, half of the proxy lifetime
+PROXY_ENDPOINT_TTL = 1800
+
+
+class EndpointPool(object):
+  """ Pool of endpoint objects keyed by site, endpoint name and a hash of the endpoint
+      parameters and of the identity of the generic cloud credentials. Entries expire after
+      a given time and the least recently used ones are evicted when the pool is full
+  """
+
+  def __init__(self, ttl=1800, maxSize=100):
+    """ c'tor
+
+    :param int ttl: lifetime of the pooled endpoints in seconds
+    :param int maxSize: maximum number of pooled endpoints
+    """
+    self.log = gLogger.getSubLogger('EndpointPool')
+    self.ttl = ttl
+    self.maxSize = max(1, maxSize)
+    self.__lock = threading.Lock()
+    # key -> ( expiration time, endpoint object ), least recently used first
+    self.__endpoints = OrderedDict()
+
+  @staticmethod
+  def __getKey(site, ce, parameters, identity):
+    """ Get the pool key of the endpoint described by the given parameters and used with
+        the given credentials identity
+    """
+    myMD5 = hashlib.md5()
+    myMD5.update(json.dumps([parameters, identity], sort_keys=True, default=str).encode('utf-8'))
+    return (site, ce, myMD5.hexdigest())
+
+  def getEndpoint(self, site, ce):
+    """ Get the endpoint object for the given site and endpoint name, creating it if
+        there is no valid one in the pool
+
+    :param str site: site name
+    :param str ce: endpoint name
+    :return: S_OK(endpoint object)/S_ERROR
+    """
+    result = getVMTypeConfig(site, ce)
+    if not result['OK']:
+      return result
+    ceParams = result['Value']
+
+    identity = None
+    ttl = self.ttl
+    authType = ceParams.get('Auth')
+    if authType and authType.lower() in ['x509', 'voms']:
+      result = getCloudCredentialsForCE(ceParams)
+      if not result['OK']:
+        return result
+      identity = result['Value']
+      ttl = min(ttl, PROXY_ENDPOINT_TTL)
+    key = self.__getKey(site, ce, ceParams, identity)
+
+    now = time.time()
+    with self.__lock:
+      if key in self.__endpoints:
+        expiration, endpoint = self.__endpoints.pop(key)
+        if expiration > now:
+          self.__endpoints[key] = (expiration, endpoint)
+          return S_OK(endpoint)
+
+    if identity and not ceParams.get('Proxy'):
+      # The proxy is given with the parameters so that the endpoint uses it from its creation
+      result = getProxyFileForCE(ceParams)
+      if not result['OK']:
+        return result
+      ceParams['Proxy'] = result['Value']
+
+    result = EndpointFactory().getCEObject(parameters=ceParams)
+    if not result['OK']:
+      return result
+    endpoint = result['Value']
+    if not endpoint.isValid():
+      # Do not keep endpoints that failed to initialize, they will be retried next time
+      return result
+
+    with self.__lock:
+      if key in self.__endpoints:
+        # Created concurrently by another thread, keep the pooled one
+        return S_OK(self.__endpoints[key][1])
+      self.__endpoints[key] = (time.time() + ttl, endpoint)
+      while len(self.__endpoints) > self.maxSize:
+        evictedKey, _ = self.__endpoints.popitem(last=False)
+        self.log.verbose('Evicting endpoint %s/%s from the pool' % evictedKey[:2])
+
+    return S_OK(endpoint)
+
+  def invalidate(self, site=None, ce=None):
+    """ Remove endpoints from the pool
+
+    :param str site: remove only the endpoints of this site
+    :param str ce: remove only the endpoints with this name
+    """
+    with self.__lock:
+      for key in list(self.__endpoints):
+        if (site is None or key[0] == site) and (ce is None or key[1] == ce):
+          del self.__endpoints[key]
@@ -0,0 +1,105 @@
+""" HTTPSession provides the pooled HTTP sessions used for the REST calls to the cloud
+    services. Connections to a service are kept alive and reused by all the endpoint
+    objects of the process, failed idempotent requests are retried with backoff and
+    every request gets a timeout.
+
+    The sessions can be tuned with the following endpoint parameters:
+
+    - HTTPPoolSize: maximum number of connections kept per host (default 10)
+    - HTTPRetries: number of retries of the failed requests (default 3)
+    - HTTPBackoff: backoff factor in seconds between the retries (default 0.5)
+    - HTTPConnectTimeout: connection timeout in seconds (default 10)
+    - HTTPReadTimeout: read timeout in seconds (default 60)
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from six.moves.urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+__RCSID__ = "$Id$"
+
+# Responses worth retrying: rate limiting and server side errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Only the requests that can be repeated safely are retried after they were sent,
+# POST requests are only retried if the connection could not be established
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS'])
+
+DEFAULTS = {'HTTPPoolSize': 10,
+            'HTTPRetries': 3,
+            'HTTPBackoff': 0.5,
+            'HTTPConnectTimeout': 10,
+            'HTTPReadTimeout': 60}
+
+gSessions = {}
+gSessionsLock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+  """ HTTPAdapter applying a default timeout to the requests without one
+  """
+
+  def __init__(self, timeout=None, **kwargs):
+    self.timeout = timeout
+    super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+  def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+    if kwargs.get('timeout') is None:
+      kwargs['timeout'] = self.timeout
+    return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def _getRetry(retries, backoff):
+  """ Get the retry policy of the sessions
+  """
+  retryArgs = {'total': retries,
+               'connect': retries,
+               'read': retries,
+               'status': retries,
+               'backoff_factor': backoff,
+               'status_forcelist': RETRY_STATUS,
+               'raise_on_status': False,
+               'respect_retry_after_header': True}
+  try:
+    return Retry(allowed_methods=RETRY_METHODS, **retryArgs)
+  except TypeError:
+    # urllib3 < 1.26
+    return Retry(method_whitelist=RETRY_METHODS, **retryArgs)
+
+
+def getSession(url, parameters=None):
+  """ Get the HTTP session shared by the requests to the service of the given URL
+
+  :param str url: service URL
+  :param dict parameters: endpoint parameters with the session options, see the module documentation
+  :return: requests.Session object
+  """
+  options = dict(DEFAULTS)
+  for option in DEFAULTS:
+    if parameters and parameters.get(option) not in (None, ''):
+      options[option] = type(DEFAULTS[option])(parameters[option])
+
+  parsedURL = urlparse(url)
+  key = (parsedURL.scheme, parsedURL.netloc) + tuple(sorted(options.items()))
+  with gSessionsLock:
+    session = gSessions.get(key)
+    if session is None:
+      adapter = TimeoutHTTPAdapter(timeout=(options['HTTPConnectTimeout'], options['HTTPReadTimeout']),
+                                   pool_connections=options['HTTPPoolSize'],
+                                   pool_maxsize=options['HTTPPoolSize'],
+                                   max_retries=_getRetry(options['HTTPRetries'], options['HTTPBackoff']))
+      session = requests.Session()
+      # The session is shared by clients with different credentials, which are
+      # passed with each request, so no cookie is kept
+      session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      gSessions[key] = session
+  return session
@@ -5,11 +5,16 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 
-import requests
+import time
+import datetime
 
 from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Security.X509Chain import X509Chain  # pylint: disable=import-error
 from DIRAC.Core.Utilities.Time import fromString, dateTime
 
+from VMDIRAC.Resources.Cloud.HTTPSession import getSession
+from VMDIRAC.Resources.Cloud.KeystoneTokenCache import gKeystoneTokenCache
+
 __RCSID__ = '$Id$'
 
 
@@ -38,6 +43,9 @@ class KeystoneClient():
     self.imageURL = None
     self.networkURL = None
     self.caPath = self.parameters.get('CAPath', True)
+    # Optional file sharing the tokens between the processes of the host
+    self.tokenCacheFile = self.parameters.get('TokenCacheFile')
+    self.identity = None
 
     self.valid = False
     result = self.initialize()
@@ -54,6 +62,7 @@ class KeystoneClient():
 
     self.log.debug("Initializing for API version %d" % self.apiVersion)
 
+    defaultProject = not self.project
     result = self.getToken()
     if not result['OK']:
       return result
@@ -68,9 +77,70 @@ class KeystoneClient():
         result = self.getToken(force=True)
         if not result['OK']:
           return result
+    if defaultProject and self.project:
+      # The next clients without project get the tenant specific token directly
+      self.__cacheToken(None)
 
     return S_OK()
 
+  def __getIdentity(self):
+    """ Get the identity used to authenticate, as the key of the cached tokens
+
+    :return: str
+    """
+    if self.identity is not None:
+      return self.identity
+
+    if self.parameters.get('User') and self.parameters.get('Password'):
+      self.identity = 'user:%s@%s' % (self.parameters['User'], self.parameters.get('Domain', 'Default'))
+    elif self.parameters.get('Auth') == "voms":
+      proxy = self.parameters.get('Proxy')
+      self.identity = 'proxy:%s' % proxy
+      if proxy:
+        chain = X509Chain()
+        if chain.loadProxyFromFile(proxy)['OK']:
+          result = chain.getCredentials()
+          if result['OK']:
+            self.identity = 'proxy:%s' % result['Value']['identity']
+          # The VOMS attributes select the cloud user the proxy is mapped to
+          result = chain.getVOMSData()
+          if result['OK'] and result['Value'].get('fqan'):
+            self.identity += ':%s' % ','.join(result['Value']['fqan'])
+    else:
+      self.identity = 'appcred:%s' % self.parameters.get('Appcred')
+    return self.identity
+
+  def __cacheToken(self, project):
+    """ Put the current token in the token cache
+
+    :param str project: project key of the cached token
+    """
+    entry = {'Token': self.token,
+             'Expires': time.time() + (self.expires - dateTime()).total_seconds(),
+             'Project': self.project,
+             'ProjectID': self.projectID,
+             'ComputeURL': self.computeURL,
+             'ImageURL': self.imageURL,
+             'NetworkURL': self.networkURL}
+    gKeystoneTokenCache.put(self.url, self.__getIdentity(), project, entry, cacheFile=self.tokenCacheFile)
+
+  def __getCachedToken(self):
+    """ Get a valid token for the client credentials and project from the token cache
+
+    :return: token or None
+    """
+    entry = gKeystoneTokenCache.get(self.url, self.__getIdentity(), self.project, cacheFile=self.tokenCacheFile)
+    if entry is None:
+      return None
+    self.token = entry['Token']
+    self.expires = dateTime() + datetime.timedelta(seconds=entry['Expires'] - time.time())
+    self.project = self.project or entry['Project']
+    self.projectID = entry['ProjectID']
+    self.computeURL = entry['ComputeURL']
+    self.imageURL = entry['ImageURL']
+    self.networkURL = entry['NetworkURL']
+    return self.token
+
   def getToken(self, force=False):
     """Get the Keystone token
 
@@ -79,13 +149,20 @@ class KeystoneClient():
     """
 
     if self.token is not None and not force:
-      if self.expires and (self.expires - dateTime()).seconds > 300:
+      if self.expires and (self.expires - dateTime()).total_seconds() > gKeystoneTokenCache.minLifetime:
         return S_OK(self.token)
 
+    if not force:
+      token = self.__getCachedToken()
+      if token:
+        return S_OK(token)
+
     if self.apiVersion == 2:
       result = self.__getToken2()
     else:
       result = self.__getToken3()
+    if result['OK']:
+      self.__cacheToken(self.project)
     return result
 
   def __getToken2(self):
@@ -113,11 +190,11 @@ class KeystoneClient():
         authArgs['cert'] = self.parameters.get('Proxy')
 
     try:
-      result = requests.post("%s/tokens" % self.url,
-                             headers={"Content-Type": "application/json"},
-                             json=authDict,
-                             verify=self.caPath,
-                             **authArgs)
+      result = getSession(self.url, self.parameters).post("%s/tokens" % self.url,
+                                                          headers={"Content-Type": "application/json"},
+                                                          json=authDict,
+                                                          verify=self.caPath,
+                                                          **authArgs)
     except Exception as exc:
       return S_ERROR('Exception getting keystone token: %s' % str(exc))
 
@@ -200,13 +277,13 @@ class KeystoneClient():
 
     url = "%s/auth/tokens" % self.url
     try:
-      result = requests.post(url,
-                             headers={"Content-Type": "application/json",
-                                      "Accept": "application/json",
-                                      },
-                             json=authDict,
-                             verify=self.caPath,
-                             **authArgs)
+      result = getSession(url, self.parameters).post(url,
+                                                     headers={"Content-Type": "application/json",
+                                                              "Accept": "application/json",
+                                                              },
+                                                     json=authDict,
+                                                     verify=self.caPath,
+                                                     **authArgs)
 
     except Exception as exc:
       return S_ERROR('Exception getting keystone token: %s' % str(exc))
@@ -258,10 +335,10 @@ class KeystoneClient():
       return S_ERROR("No Keystone token yet available")
 
     try:
-      result = requests.get("%s/tenants" % self.url,
-                            headers={"Content-Type": "application/json",
-                                     "X-Auth-Token": self.token},
-                            verify=self.caPath)
+      result = getSession(self.url, self.parameters).get("%s/tenants" % self.url,
+                                                         headers={"Content-Type": "application/json",
+                                                                  "X-Auth-Token": self.token},
+                                                         verify=self.caPath)
     except Exception as exc:
       return S_ERROR('Failed to get keystone token: %s' % str(exc))
 
@@ -0,0 +1,129 @@
+""" KeystoneTokenCache keeps the Keystone tokens obtained in a process, and optionally in a
+    file shared by the processes of the host, so that every KeystoneClient object with the
+    same credentials reuses a valid token instead of authenticating again.
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+from DIRAC import gLogger
+
+__RCSID__ = "$Id$"
+
+
+class KeystoneTokenCache(object):
+  """ Cache of the Keystone tokens keyed by the authentication URL, the identity and the project.
+      The cached entries are dictionaries with the token, its expiration time as seconds since
+      the epoch and the service catalogue information needed by the clients
+  """
+
+  def __init__(self, minLifetime=300):
+    """ c'tor
+
+    :param int minLifetime: tokens expiring in less than minLifetime seconds are not used
+    """
+    self.log = gLogger.getSubLogger('KeystoneTokenCache')
+    self.minLifetime = minLifetime
+    self.__lock = threading.Lock()
+    self.__tokens = {}
+
+  @staticmethod
+  def __getKey(url, identity, project):
+    """ Get the cache key, usable as a JSON object key
+    """
+    return json.dumps([url, identity, project])
+
+  def __isValid(self, entry):
+    """ Check that the cache entry can be used
+    """
+    return entry is not None and entry.get('Expires', 0) - time.time() > self.minLifetime
+
+  def get(self, url, identity, project, cacheFile=None):
+    """ Get a valid cached token
+
+    :param str url: Keystone URL
+    :param str identity: identity the token was obtained for
+    :param str project: project of the token, None for the default one
+    :param str cacheFile: file shared by the processes, not used if None
+    :return: cache entry dictionary or None
+    """
+    key = self.__getKey(url, identity, project)
+    with self.__lock:
+      entry = self.__tokens.get(key)
+    if self.__isValid(entry):
+      return dict(entry)
+
+    if cacheFile:
+      entry = self.__updateFile(cacheFile).get(key)
+      if self.__isValid(entry):
+        with self.__lock:
+          self.__tokens[key] = entry
+        return dict(entry)
+    return None
+
+  def put(self, url, identity, project, entry, cacheFile=None):
+    """ Add a token to the cache
+
+    :param str url: Keystone URL
+    :param str identity: identity the token was obtained for
+    :param str project: project of the token, None for the default one
+    :param dict entry: cache entry with at least the 'Token' and 'Expires' keys
+    :param str cacheFile: file shared by the processes, not used if None
+    """
+    key = self.__getKey(url, identity, project)
+    with self.__lock:
+      self.__tokens[key] = dict(entry)
+      for oldKey in [oldKey for oldKey, oldEntry in self.__tokens.items() if oldEntry.get('Expires', 0) < time.time()]:
+        del self.__tokens[oldKey]
+    if cacheFile:
+      self.__updateFile(cacheFile, {key: dict(entry)})
+
+  def __updateFile(self, cacheFile, newEntries=None):
+    """ Read the cache file, and add the new entries to it, holding a lock on the file.
+        The file is only readable by its owner as it contains credentials
+
+    :param str cacheFile: cache file path
+    :param dict newEntries: entries to add
+    :return: dictionary of the valid entries of the file
+    """
+    entries = {}
+    try:
+      fd = os.open(cacheFile, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as exc:
+      self.log.warn('Cannot open the token cache file', '%s: %s' % (cacheFile, repr(exc)))
+      return entries
+
+    with os.fdopen(fd, 'r+') as cache:
+      try:
+        fcntl.flock(cache, fcntl.LOCK_EX if newEntries else fcntl.LOCK_SH)
+        content = cache.read()
+        if content:
+          try:
+            entries = json.loads(content)
+          except ValueError:
+            self.log.warn('Ignoring the corrupted token cache file', cacheFile)
+        now = time.time()
+        entries = dict((key, entry) for key, entry in entries.items() if entry.get('Expires', 0) > now)
+        if newEntries:
+          entries.update(newEntries)
+          os.fchmod(cache.fileno(), 0o600)
+          cache.seek(0)
+          cache.truncate()
+          cache.write(json.dumps(entries))
+          cache.flush()
+      except (IOError, OSError) as exc:
+        self.log.warn('Cannot use the token cache file', '%s: %s' % (cacheFile, repr(exc)))
+      finally:
+        fcntl.flock(cache, fcntl.LOCK_UN)
+
+    return entries
+
+
+gKeystoneTokenCache = KeystoneTokenCache()
@@ -13,7 +13,6 @@ from __future__ import absolute_import
 __RCSID__ = '$Id$'
 
 import os
-import requests
 from requests.auth import HTTPBasicAuth
 import uuid
 import base64
@@ -22,6 +21,7 @@ import base64
 from DIRAC import gLogger, S_OK, S_ERROR
 from VMDIRAC.Resources.Cloud.Endpoint import Endpoint
 from VMDIRAC.Resources.Cloud.KeystoneClient import KeystoneClient
+from VMDIRAC.Resources.Cloud.HTTPSession import getSession
 from DIRAC.Core.Utilities.File import makeGuid
 
 DEBUG = False
@@ -43,6 +43,9 @@ class OcciEndpoint(Endpoint):
 
     # Prepare the authentication request parameters
     self.session = None
+    # Headers and credentials sent with each request of the shared session
+    self.sessionHeaders = {}
+    self.sessionArgs = {}
     self.authArgs = {}
     self.user = self.parameters.get("User")
     self.password = self.parameters.get("Password")
@@ -85,9 +88,9 @@ class OcciEndpoint(Endpoint):
   def initialize(self):
 
     try:
-      result = requests.head(self.serviceUrl + '/-/',
-                             headers={"Content-Type": "text/plain"},
-                             **self.authArgs)
+      result = getSession(self.serviceUrl, self.parameters).head(self.serviceUrl + '/-/',
+                                                                 headers={"Content-Type": "text/plain"},
+                                                                 **self.authArgs)
     except Exception as exc:
       return S_ERROR(repr(exc))
 
@@ -105,9 +108,9 @@ class OcciEndpoint(Endpoint):
 
     # Make a trial service call
     try:
-      result = requests.head(self.serviceUrl + '/-/',
-                             headers={"Content-Type": "text/plain"},
-                             **self.authArgs)
+      result = getSession(self.serviceUrl, self.parameters).head(self.serviceUrl + '/-/',
+                                                                 headers={"Content-Type": "text/plain"},
+                                                                 **self.authArgs)
     except Exception as e:
       return S_ERROR(str(e))
 
@@ -136,8 +139,8 @@ class OcciEndpoint(Endpoint):
   def __getSchemaDefinitions(self):
 
     try:
-      response = self.session.get("%s/-/" % self.serviceUrl,
-                                  headers={'Accept': 'text/plain,text/occi'})
+      response = self.__request('GET', "%s/-/" % self.serviceUrl,
+                                headers={'Accept': 'text/plain,text/occi'})
 
     except Exception as exc:
       return S_ERROR('Failed to get schema definition: %s' % str(exc))
@@ -188,10 +191,9 @@ class OcciEndpoint(Endpoint):
 
     :return: S_OK | S_ERROR
     """
-    self.session = requests.Session()
-    self.session.mount(self.serviceUrl,
-                       requests.adapters.HTTPAdapter(pool_connections=20))
-    self.session.verify = self.authArgs['verify']
+    self.session = getSession(self.serviceUrl, self.parameters)
+    self.sessionHeaders = {}
+    self.sessionArgs = {'verify': self.authArgs['verify']}
 
     # Retrieve token
     result = self.__getKeystoneUrl()
@@ -205,16 +207,13 @@ class OcciEndpoint(Endpoint):
       if not result['OK']:
         return result
       self.token = result['Value']
-      self.session.headers.clear()
-      self.session.headers.update({"X-Auth-Token": self.token})
-      self.session.verify = self.authArgs['verify']
+      self.sessionHeaders = {"X-Auth-Token": self.token}
     else:
       if self.loginMode:
-        self.session.auth = self.authArgs['auth']
-        self.session.verify = self.authArgs['verify']
+        self.sessionArgs['auth'] = self.authArgs['auth']
       else:
-        self.session.cert = self.userProxy
-        self.session.verify = self.caPath
+        self.sessionArgs['cert'] = self.userProxy
+        self.sessionArgs['verify'] = self.caPath
 
     result = self.__getSchemaDefinitions()
     if not result['OK']:
@@ -222,6 +221,21 @@ class OcciEndpoint(Endpoint):
     self.computeUrl = "%s/compute/" % (self.serviceUrl)
     return S_OK()
 
+  def __request(self, method, url, headers=None, **kwargs):
+    """ Send a request with the endpoint credentials through the shared HTTP session
+
+    :param str method: HTTP method
+    :param str url: request URL
+    :param dict headers: request headers, added to the session ones
+    :param kwargs: other requests arguments, overriding the session credentials
+    :return: requests.Response object
+    """
+    requestHeaders = dict(self.sessionHeaders)
+    requestHeaders.update(headers or {})
+    requestArgs = dict(self.sessionArgs)
+    requestArgs.update(kwargs)
+    return self.session.request(method, url, headers=requestHeaders, **requestArgs)
+
   def createInstances(self, vmsToSubmit):
     outputDict = {}
     message = ''
@@ -312,12 +326,12 @@ class OcciEndpoint(Endpoint):
     data += 'X-OCCI-Attribute: org.openstack.compute.user_data="%s"' % base64.b64encode(userData)
     #data += 'X-OCCI-Attribute: org.openstack.credentials.publickey.data="ssh-rsa ' + sshPublicKey + ' vmdirac"'
 
-    del self.authArgs['data']
+    self.authArgs.pop('data', None)
 
-    result = self.session.post(self.computeUrl,
-                               data=data,
-                               headers=headers,
-                               **self.authArgs)
+    result = self.__request('POST', self.computeUrl,
+                            data=data,
+                            headers=headers,
+                            **self.authArgs)
 
     # print "AT >>> createInstance", result, result.headers
     # print "AT >>> result.text", result.text
@@ -335,7 +349,7 @@ class OcciEndpoint(Endpoint):
     """
 
     try:
-      response = self.session.get(self.computeUrl)
+      response = self.__request('GET', self.computeUrl)
     except Exception as e:
       return S_ERROR('Cannot connect to ' + self.computeUrl + ' (' + str(e) + ')')
 
@@ -359,7 +373,7 @@ class OcciEndpoint(Endpoint):
     """
     url = '%s/%s' % (self.computeUrl, os.path.basename(nodeID))
     try:
-      response = self.session.get(url)
+      response = self.__request('GET', url)
     except Exception as e:
       return S_ERROR('Cannot get node details for %s (' % nodeID + str(e) + ')')
 
@@ -377,7 +391,7 @@ class OcciEndpoint(Endpoint):
     """
     networkUrl = "%s/network/" % self.serviceUrl
     try:
-      response = self.session.get(networkUrl)
+      response = self.__request('GET', networkUrl)
     except Exception as e:
       return S_ERROR('Cannot get network details')
 
@@ -399,7 +413,7 @@ class OcciEndpoint(Endpoint):
     headers = {'Accept': 'application/occi,application/json'}
     networkUrl = "%s/network/%s" % (self.serviceUrl, network)
     try:
-      response = self.session.get(networkUrl)
+      response = self.__request('GET', networkUrl)
     except Exception as e:
       return S_ERROR('Cannot get network details')
 
@@ -425,7 +439,7 @@ class OcciEndpoint(Endpoint):
 
     url = '%s/%s' % (self.computeUrl, os.path.basename(nodeID))
     try:
-      response = self.session.delete(url)
+      response = self.__request('DELETE', url)
     except Exception as e:
       return S_ERROR('Cannot delete node %s (' % nodeID + str(e) + ')')
 
@@ -467,9 +481,9 @@ class OcciEndpoint(Endpoint):
     data += 'X-OCCI-Attribute: occi.core.id="%s"' % networkInterfaceID
 
     headers['Content-Length'] = str(len(data))
-    result = self.session.post("%s/link/networkinterface/" % self.serviceUrl,
-                               headers=headers,
-                               data=data)
+    result = self.__request('POST', "%s/link/networkinterface/" % self.serviceUrl,
+                            headers=headers,
+                            data=data)
 
     if result.status_code != 201:
       return S_ERROR(result.text)
@@ -496,8 +510,8 @@ class OcciEndpoint(Endpoint):
     nodeURL = '%s/link/networkinterface/%s' % (self.serviceUrl, os.path.basename(nodeID))
     nodeURL = nodeURL.replace('//', '/')
 
-    result = self.session.delete(nodeURL,
-                                 headers=headers)
+    result = self.__request('DELETE', nodeURL,
+                            headers=headers)
 
     if result.status_code != 200:
       return S_ERROR(result.text)
@@ -13,18 +13,22 @@ from __future__ import absolute_import
 
 __RCSID__ = '$Id$'
 
-import requests
 import json
 import base64
 
 # DIRAC
 from DIRAC import gLogger, S_OK, S_ERROR
+from DIRAC.Core.Utilities.DictCache import DictCache
 from VMDIRAC.Resources.Cloud.Endpoint import Endpoint
 from VMDIRAC.Resources.Cloud.KeystoneClient import KeystoneClient
+from VMDIRAC.Resources.Cloud.HTTPSession import getSession
 from DIRAC.Core.Utilities.File import makeGuid
 
 DEBUG = False
 
+# Flavors, images and networks of the OpenStack projects, shared by the endpoint objects
+gMetadataCache = DictCache()
+
 
 class OpenStackEndpoint(Endpoint):
   """ OpenStack implementation of the Cloud Endpoint interface
@@ -79,33 +83,169 @@ class OpenStackEndpoint(Endpoint):
     self.log.verbose("Service interfaces:\ncompute %s,\nimage %s,\nnetwork %s" %
                      (self.computeURL, self.imageURL, self.networkURL))
 
-    result = self.getFlavors()
+    # Only the resources referenced by the VM type are looked up
+    result = self.__resolveMetadata()
     if not result['OK']:
       self.valid = False
-    result = self.getImages()
+    return result
+
+  def __getMetadata(self, kind, url, name, loader):
+    """ Get metadata of the project from the shared cache, loading it if not cached
+
+    :param str kind: kind of metadata
+    :param str url: URL of the service providing it
+    :param str name: name of the resource, None for all the resources of the kind
+    :param loader: function loading the metadata, returning S_OK/S_ERROR
+    :return: S_OK(metadata)/S_ERROR
+    """
+    key = (kind, url, self.projectID, name)
+    value = gMetadataCache.get(key)
+    if value is not None:
+      return S_OK(value)
+    result = loader()
     if not result['OK']:
-      self.valid = False
-    self.getNetworks()
+      return result
+    # Resources not found are looked up again next time
+    if result['Value']:
+      gMetadataCache.add(key, int(self.parameters.get('MetadataCacheTime', 600)), result['Value'])
     return result
 
+  def __resolveMetadata(self):
+    """ Resolve the image, flavor and network names of the parameters to IDs, kept in
+        the endpoint parameters, when these are not given
+
+    :return: S_OK/S_ERROR
+    """
+    imageID = self.parameters.get('ImageID')
+    imageName = self.parameters.get('Image')
+    if not imageID and imageName:
+      result = self.__getMetadata('image', self.imageURL, imageName, lambda: self.__loadImage(name=imageName))
+      if not result['OK']:
+        return result
+      if not result['Value']:
+        return S_ERROR('Can not get ID for the image: %s' % imageName)
+      self.parameters['ImageID'] = result['Value']['id']
+    elif imageID and not imageName:
+      result = self.__getMetadata('imageID', self.imageURL, imageID, lambda: self.__loadImage(imageID=imageID))
+      if result['OK'] and result['Value']:
+        self.parameters['Image'] = result['Value']['name']
+
+    flavorName = self.parameters.get('FlavorName')
+    if not self.parameters.get('FlavorID') and flavorName:
+      result = self.getFlavors()
+      if not result['OK']:
+        return result
+      if flavorName not in self.flavors:
+        return S_ERROR('Can not get ID for the flavor: %s' % flavorName)
+      self.parameters['FlavorID'] = self.flavors[flavorName]["FlavorID"]
+      if "NumberOfProcessors" not in self.parameters:
+        self.parameters["NumberOfProcessors"] = self.flavors[flavorName]["NumberOfProcessors"]
+
+    if not self.parameters.get('NetworkID') and self.networkURL:
+      networkName = self.parameters.get('Network')
+      result = self.__getMetadata('network', self.networkURL, networkName,
+                                  lambda: self.__loadNetworks(name=networkName))
+      if not result['OK']:
+        return result
+      networks = result['Value']
+      self.networks.update(networks)
+      networkID = None
+      if networkName:
+        if networkName in networks:
+          networkID = networks[networkName]["NetworkID"]
+      elif networks:
+        networkID = networks[list(networks)[0]]["NetworkID"]
+      if networkID:
+        self.parameters['NetworkID'] = networkID
+      else:
+        self.log.warn("Failed to get ID of the network interface")
+
+    return S_OK()
+
+  def __loadImage(self, name=None, imageID=None):
+    """ Get an image by name, with the Glance name filter, or by ID
+
+    :param str name: image name
+    :param str imageID: image ID
+    :return: S_OK(image dictionary or None)/S_ERROR
+    """
+    try:
+      if imageID:
+        result = self.__request('GET', "%s/v2/images/%s" % (self.imageURL, imageID))
+        if result.status_code == 404:
+          return S_OK(None)
+        image = json.loads(result.text)
+      else:
+        result = self.__request('GET', "%s/v2/images" % self.imageURL, params={'name': name})
+        images = json.loads(result.text)['images']
+        image = images[0] if images else None
+    except Exception as exc:
+      return S_ERROR('Cannot get image %s: %s' % (name or imageID, str(exc)))
+
+    if image is None:
+      return S_OK(None)
+    self.images[image['name']] = {'id': image['id']}
+    return S_OK({'id': image['id'], 'name': image['name']})
+
+  def __loadNetworks(self, name=None):
+    """ Get the networks of the project, with the given name if any
+
+    :param str name: network name
+    :return: S_OK(dict)/S_ERROR, dictionary of network name: {"NetworkID": network ID}
+    """
+    params = {'name': name} if name else {}
+    try:
+      result = self.__request('GET', "%s/v2.0/networks" % self.networkURL, params=params)
+      output = json.loads(result.text)
+    except Exception as exc:
+      return S_ERROR('Cannot get networks: %s' % str(exc))
+
+    networks = {}
+    for network in output['networks']:
+      if network['project_id'] == self.projectID:
+        networks[network["name"]] = {"NetworkID": network["id"]}
+    return S_OK(networks)
+
+  def __request(self, method, url, **kwargs):
+    """ Send an authenticated request to the OpenStack services through the shared HTTP session
+
+    :param str method: HTTP method
+    :param str url: request URL
+    :param kwargs: other requests arguments
+    :return: requests.Response object
+    """
+    headers = {"X-Auth-Token": self.token}
+    headers.update(kwargs.pop('headers', {}))
+    kwargs.setdefault('verify', self.caPath)
+    return getSession(url, self.parameters).request(method, url, headers=headers, **kwargs)
 
   def getFlavors(self):
 
     if not self.computeURL or not self.token:
       return S_ERROR('The endpoint object is not initialized')
 
-    url = "%s/flavors/detail" % self.computeURL
-    self.log.verbose("Getting flavors details on %s" % url)
+    def loadFlavors():
+      url = "%s/flavors/detail" % self.computeURL
+      self.log.verbose("Getting flavors details on %s" % url)
 
-    result = requests.get(url,
-                          headers={"X-Auth-Token": self.token},
-                          verify=self.caPath)
-
-    output = json.loads(result.text)
-    for flavor in output['flavors']:
-      self.flavors[flavor["name"]] = {"FlavorID": flavor['id'],
-                                      "RAM": flavor['ram'],
-                                      "NumberOfProcessors": flavor['vcpus']}
+      try:
+        result = self.__request('GET', url)
+        output = json.loads(result.text)
+      except Exception as exc:
+        return S_ERROR('Cannot get flavors: %s' % str(exc))
+
+      flavors = {}
+      for flavor in output['flavors']:
+        flavors[flavor["name"]] = {"FlavorID": flavor['id'],
+                                   "RAM": flavor['ram'],
+                                   "NumberOfProcessors": flavor['vcpus']}
+      return S_OK(flavors)
+
+    # Nova can not filter the flavors by name, the list of the project is cached
+    result = self.__getMetadata('flavors', self.computeURL, None, loadFlavors)
+    if not result['OK']:
+      return result
+    self.flavors.update(result['Value'])
 
     return S_OK(self.flavors)
 
@@ -114,36 +254,42 @@ class OpenStackEndpoint(Endpoint):
     if not self.imageURL or not self.token:
       return S_ERROR('The endpoint object is not initialized')
 
-    result = requests.get("%s/v2/images" % self.imageURL,
-                          headers={"X-Auth-Token": self.token},
-                          verify=self.caPath)
+    try:
+      result = self.__request('GET', "%s/v2/images" % self.imageURL)
+      output = json.loads(result.text)
+    except Exception as exc:
+      return S_ERROR('Cannot get images: %s' % str(exc))
 
-    output = json.loads(result.text)
     for image in output['images']:
       self.images[image['name']] = {'id': image['id']}
 
     return S_OK(self.images)
 
   def getNetworks(self):
-    """ Get a network object corresponding to the networkName
+    """ Get the networks of the project
 
-    :param str networkName: network name
-    :return: S_OK|S_ERROR network object in case of S_OK
+    :return: S_OK|S_ERROR, dictionary of network name: {"NetworkID": network ID}
     """
-    try:
-      result = requests.get("%s/v2.0/networks" % self.networkURL,
-                            headers={"X-Auth-Token": self.token},
-                            verify=self.caPath)
-      output = json.loads(result.text)
-    except Exception as exc:
-      return S_ERROR('Cannot get networks: %s' % str(exc))
-
-    for network in output['networks']:
-      if network['project_id'] == self.projectID:
-        self.networks[network["name"]] = {"NetworkID": network["id"]}
+    result = self.__getMetadata('network', self.networkURL, None, self.__loadNetworks)
+    if not result['OK']:
+      return result
+    self.networks.update(result['Value'])
     return S_OK(self.networks)
 
   def createInstances(self, vmsToSubmit):
+    """ Create vmsToSubmit VM instances. If the BulkCreate option is set for the endpoint,
+        all the VMs are requested in a single Nova call
+
+    :param int vmsToSubmit: number of VMs to create
+    :return: S_OK(dict)/S_ERROR, dictionary of node ID: node parameters
+    """
+    bulkCreate = str(self.parameters.get('BulkCreate', 'false')).lower() in ('yes', 'true')
+    bootType = self.bootstrapParameters.get('BootType', 'pilot').lower()
+    if bulkCreate and vmsToSubmit > 1:
+      if bootType == 'pilot':
+        return self.__createInstancesBulk(vmsToSubmit)
+      self.log.warn('BulkCreate is only supported with the pilot BootType, creating VMs one by one')
+
     outputDict = {}
     for nvm in range(vmsToSubmit):
       instanceID = makeGuid()[:8]
@@ -164,76 +310,78 @@ class OpenStackEndpoint(Endpoint):
 
     return S_OK(outputDict)
 
-  def createInstance(self, instanceID=''):
+  def __createInstancesBulk(self, vmsToSubmit):
+    """ Create up to vmsToSubmit identical VMs with one Nova request using min_count/max_count.
+        The VMs can not get individual identifiers in the user data, so the VM UUID is left
+        empty and the bootstrap takes the server ID from the instance metadata. The server ID
+        is then also used as the DIRAC instance name.
+
+    :param int vmsToSubmit: maximum number of VMs to create
+    :return: S_OK(dict)/S_ERROR, dictionary of node ID: node parameters
     """
-    This creates a VM instance for the given boot image
-    and creates a context script, taken the given parameters.
-    Successful creation returns instance VM
+    result = self.__getServerRequest('')
+    if not result['OK']:
+      return result
+    requestDict = result['Value']
+    requestDict["server"]["name"] = "DIRAC_%s" % makeGuid()[:8]
+    requestDict["server"]["min_count"] = 1
+    requestDict["server"]["max_count"] = vmsToSubmit
+    requestDict["server"]["return_reservation_id"] = True
 
-    Boots a new node on the OpenStack server defined by self.endpointConfig. The
-    'personality' of the node is done by self.imageConfig. Both variables are
-    defined on initialization phase.
+    try:
+      result = self.__request('POST', "%s/servers" % self.computeURL, json=requestDict)
+    except Exception as exc:
+      return S_ERROR('Exception creating VMs: %s' % str(exc))
 
-    The node name has the following format:
-    <bootImageName><contextMethod><time>
+    if result.status_code not in [200, 201, 202, 203, 204]:
+      return S_ERROR('Error creating VMs: %s' % result.text)
+    reservationID = json.loads(result.text)["reservation_id"]
 
-    :return: S_OK( ( nodeID, publicIP ) ) | S_ERROR
+    # Resolve the IDs of the servers booted by this request
+    try:
+      result = self.__request('GET', "%s/servers" % self.computeURL, params={"reservation_id": reservationID})
+    except Exception as exc:
+      return S_ERROR('Exception getting VMs of reservation %s: %s' % (reservationID, str(exc)))
+
+    if result.status_code != 200:
+      return S_ERROR('Error getting VMs of reservation %s: %s' % (reservationID, result.text))
+
+    outputDict = {}
+    for server in json.loads(result.text)["servers"]:
+      nodeID = server["id"]
+      self.log.debug('Created VM instance %s in reservation %s' % (nodeID, reservationID))
+      outputDict[nodeID] = {'InstanceID': nodeID,
+                            'NumberOfProcessors': self.parameters.get("NumberOfProcessors", 1)}
+
+    if not outputDict:
+      return S_ERROR('No VM submitted in reservation %s' % reservationID)
+
+    return S_OK(outputDict)
+
+  def __getServerRequest(self, instanceID):
+    """ Prepare the body of the Nova server creation request. Image, flavor and network
+        IDs are resolved once and kept in the endpoint parameters
+
+    :param str instanceID: DIRAC VM identifier passed in the user data
+    :return: S_OK(dict)/S_ERROR
     """
 
     if not self.initialized:
-      self.initialize()
+      result = self.initialize()
+      if not result['OK']:
+        return result
+    else:
+      result = self.__resolveMetadata()
+      if not result['OK']:
+        return result
 
     imageID = self.parameters.get('ImageID')
     if not imageID:
-      imageName = self.parameters.get('Image')
-      if not imageName:
-        return S_ERROR('No image name or ID is specified')
-      if not self.images:
-        result = self.getImages()
-        if not result['OK']:
-          return result
-      imageID = self.images.get(imageName)['id']
-      if not imageID:
-        return S_ERROR('Can not get ID for the image: %s' % imageName)
-    self.parameters['ImageID'] = imageID
-    if "Image" not in self.parameters:
-      for image in self.images:
-        if self.images[image]['id'] == imageID:
-          self.parameters['Image'] = image
-
+      return S_ERROR('No image name or ID is specified')
     flavorID = self.parameters.get('FlavorID')
     if not flavorID:
-      flavor = self.parameters.get('FlavorName')
-      if not flavor:
-        return S_ERROR('No flavor name or ID is specified')
-      if not self.flavors:
-        result = self.getFlavors()
-        if not result['OK']:
-          return result
-      flavorID = self.flavors.get(flavor)["FlavorID"]
-      if not flavorID:
-        return S_ERROR('Can not get ID for the flavor: %s' % flavor)
-      numberOfProcessors = self.flavors.get(flavor)["NumberOfProcessors"]
-    self.parameters['FlavorID'] = flavorID
-    if "NumberOfProcessors" not in self.parameters:
-      self.parameters["NumberOfProcessors"] = numberOfProcessors
-
+      return S_ERROR('No flavor name or ID is specified')
     networkID = self.parameters.get('NetworkID')
-    if not networkID:
-      network = self.parameters.get('Network')
-      if not self.networks and self.networkURL:
-        result = self.getNetworks()
-        if not result['OK']:
-          return result
-      if network:
-        if network in self.networks:
-          networkID = self.networks[network]["NetworkID"]
-      elif self.networks:
-        randomNW = self.networks.keys()[0]
-        networkID = self.networks[randomNW]["NetworkID"]
-      if not networkID:
-        self.log.warn("Failed to get ID of the network interface")
-
 
     self.parameters['VMUUID'] = instanceID
     self.parameters['VMType'] = self.parameters.get('CEType', 'OpenStack')
@@ -244,7 +392,6 @@ class OpenStackEndpoint(Endpoint):
     userDataCrude = str(result['Value'])
     userData = base64.b64encode(userDataCrude)
 
-    headers = {"X-Auth-Token": self.token}
     requestDict = {"server": {"user_data": userData,
                               "name": "DIRAC_%s" % instanceID,
                               "imageRef": imageID,
@@ -259,15 +406,31 @@ class OpenStackEndpoint(Endpoint):
     if osSSHKey:
       requestDict["server"]["key_name"] = osSSHKey
 
-    # print "AT >>> user data", userDataCrude
-    # print "AT >>> requestDict", requestDict
-    # return S_ERROR()
+    return S_OK(requestDict)
+
+  def createInstance(self, instanceID=''):
+    """
+    This creates a VM instance for the given boot image
+    and creates a context script, taken the given parameters.
+    Successful creation returns instance VM
+
+    Boots a new node on the OpenStack server defined by self.endpointConfig. The
+    'personality' of the node is done by self.imageConfig. Both variables are
+    defined on initialization phase.
+
+    The node name has the following format:
+    <bootImageName><contextMethod><time>
+
+    :return: S_OK( ( nodeID, publicIP ) ) | S_ERROR
+    """
+
+    result = self.__getServerRequest(instanceID)
+    if not result['OK']:
+      return result
+    requestDict = result['Value']
 
     try:
-      result = requests.post("%s/servers" % self.computeURL,
-                             json=requestDict,
-                             headers=headers,
-                             verify=self.caPath)
+      result = self.__request('POST', "%s/servers" % self.computeURL, json=requestDict)
     except Exception as exc:
       return S_ERROR('Exception creating VM: %s' % str(exc))
 
@@ -278,28 +441,76 @@ class OpenStackEndpoint(Endpoint):
     else:
       return S_ERROR('Error creating VM: %s' % result.text)
 
+  @staticmethod
+  def __getPublicIP(server):
+    """ Get the floating IP address of a server description, if any
+    """
+    for addresses in server.get('addresses', {}).values():
+      for address in addresses:
+        if address.get('OS-EXT-IPS:type') == 'floating':
+          return address.get('addr')
+    return None
+
+  def iterVMs(self, namePattern='^DIRAC_', statusList=None, detail=True, pageSize=1000):
+    """ Generator over the servers of the endpoint project. The name and status filters are
+        applied by the server, the pages of the listing are followed and each server is
+        yielded as a compact record as soon as its page is received
+
+    :param str namePattern: regular expression the server names must match, None for all servers
+    :param list statusList: server statuses to select, e.g. [ 'ACTIVE', 'ERROR' ], None for all statuses
+    :param bool detail: get the server details, otherwise only the IDs and names
+    :param int pageSize: number of servers per page
+    :return: generator of dictionaries with the ID, Name, Status and PublicIP keys,
+             Status and PublicIP being None without detail
+    :raise IOError: if the servers can not be listed
+    """
+    if not self.initialized:
+      result = self.initialize()
+      if not result['OK']:
+        raise IOError(result['Message'])
+
+    url = "%s/servers/detail" % self.computeURL if detail else "%s/servers" % self.computeURL
+    params = {'limit': pageSize}
+    if namePattern:
+      params['name'] = namePattern
+    # Nova accepts one status value per listing
+    for status in (statusList or [None]):
+      if status:
+        params['status'] = status
+      nextURL, nextParams = url, dict(params)
+      while nextURL:
+        try:
+          response = self.__request('GET', nextURL, params=nextParams)
+        except Exception as e:
+          raise IOError('Cannot connect to %s (%s)' % (self.computeURL, str(e)))
+        if response.status_code != 200:
+          raise IOError('Cannot list the servers: %s' % response.text)
+
+        output = json.loads(response.text)
+        for server in output.get("servers", []):
+          yield {'ID': server['id'],
+                 'Name': server.get('name', ''),
+                 'Status': server.get('status'),
+                 'PublicIP': self.__getPublicIP(server)}
+
+        # The next link already carries the filters and the marker of the page
+        nextURL, nextParams = None, None
+        for link in output.get("servers_links", []):
+          if link.get('rel') == 'next':
+            nextURL = link['href']
+        if not output.get("servers"):
+          nextURL = None
+
   def getVMIDs(self):
     """ Get all the VM IDs on the endpoint
 
     :return: list of VM ids
     """
 
-    if not self.initialized:
-      result = self.initialize()
-      if not result['OK']:
-        return result
-
     try:
-      response = requests.get("%s/servers" % self.computeURL,
-                              headers={"X-Auth-Token": self.token},
-                              verify=self.caPath)
-    except Exception as e:
-      return S_ERROR('Cannot connect to ' + str(self.computeURL) + ' (' + str(e) + ')')
-
-    output = json.loads(response.text)
-    idList = []
-    for server in output["servers"]:
-      idList.append(server['id'])
+      idList = [server['ID'] for server in self.iterVMs(namePattern=None, detail=False)]
+    except IOError as e:
+      return S_ERROR(str(e))
     return S_OK(idList)
 
   def getVMStatus(self, vmID):
@@ -342,9 +553,7 @@ class OpenStackEndpoint(Endpoint):
       self.initialize()
 
     try:
-      response = requests.delete("%s/servers/%s" % (self.computeURL, nodeID),
-                                 headers={"X-Auth-Token": self.token},
-                                 verify=self.caPath)
+      response = self.__request('DELETE', "%s/servers/%s" % (self.computeURL, nodeID))
     except Exception as e:
       return S_ERROR('Cannot get node details for %s (' % nodeID + str(e) + ')')
 
@@ -368,9 +577,7 @@ class OpenStackEndpoint(Endpoint):
 
     # Get the port of my VM
     try:
-      result = requests.get("%s/v2.0/ports" % self.networkURL,
-                            headers={"X-Auth-Token": self.token},
-                            verify=self.caPath)
+      result = self.__request('GET', "%s/v2.0/ports" % self.networkURL)
       output = json.loads(result.text)
       portID = None
       for port in output['ports']:
@@ -412,9 +619,7 @@ class OpenStackEndpoint(Endpoint):
 
     # Get an available floating IP
     try:
-      result = requests.get("%s/v2.0/floatingips" % self.networkURL,
-                            headers={"X-Auth-Token": self.token},
-                            verify=self.caPath)
+      result = self.__request('GET', "%s/v2.0/floatingips" % self.networkURL)
       output = json.loads(result.text)
     except Exception as e:
       return S_ERROR('Cannot get floatingips')
@@ -432,10 +637,7 @@ class OpenStackEndpoint(Endpoint):
     dataJson = json.dumps(data)
 
     try:
-      result = requests.put("%s/v2.0/floatingips/%s" % (self.networkURL, fipID),
-                            data=dataJson,
-                            headers={"X-Auth-Token": self.token},
-                            verify=self.caPath)
+      result = self.__request('PUT', "%s/v2.0/floatingips/%s" % (self.networkURL, fipID), data=dataJson)
     except Exception as e:
       return S_ERROR('Cannot assign floating IP')
 
@@ -454,9 +656,7 @@ class OpenStackEndpoint(Endpoint):
   def getVMInfo(self, vmID):
 
     try:
-      response = requests.get("%s/servers/%s" % (self.computeURL, vmID),
-                              headers={"X-Auth-Token": self.token},
-                              verify=self.caPath)
+      response = self.__request('GET', "%s/servers/%s" % (self.computeURL, vmID))
     except Exception as e:
       return S_ERROR('Cannot get node details for %s (' % vmID + str(e) + ')')
 
@@ -519,9 +719,7 @@ class OpenStackEndpoint(Endpoint):
       portID = result['Value']
       # Get an available floating IP
       try:
-        result = requests.get("%s/v2.0/floatingips" % self.networkURL,
-                              headers={"X-Auth-Token": self.token},
-                              verify=self.caPath)
+        result = self.__request('GET', "%s/v2.0/floatingips" % self.networkURL)
         output = json.loads(result.text)
       except Exception as e:
         return S_ERROR('Cannot get floatingips')
@@ -539,10 +737,7 @@ class OpenStackEndpoint(Endpoint):
     dataJson = json.dumps(data)
 
     try:
-      result = requests.put("%s/v2.0/floatingips/%s" % (self.networkURL, fipID),
-                            data=dataJson,
-                            headers={"X-Auth-Token": self.token},
-                            verify=self.caPath)
+      result = self.__request('PUT', "%s/v2.0/floatingips/%s" % (self.networkURL, fipID), data=dataJson)
     except Exception as exc:
       return S_ERROR('Cannot disassociate floating IP: %s' % str(exc))
 
@@ -56,8 +56,15 @@ class VMDiracHandler(WebHandler):
     except BaseException:
       pass
 
+    cursor = None
+    if 'cursor' in self.request.arguments:
+      cursor = json.loads(self.request.arguments['cursor'][0]) or None
+    includeArchive = 'includeArchive' in self.request.arguments and \
+        str(self.request.arguments['includeArchive'][0]).lower() in ('true', '1')
+
     rpcClient = RPCClient("WorkloadManagement/VirtualMachineManager")
-    result = rpcClient.getInstancesContent(condDict, sort, start, limit)
+    # The total is only needed for the pager, a recent count is good enough
+    result = rpcClient.getInstancesContent(condDict, sort, start, limit, cursor, 'cached', includeArchive)
     if not result['OK']:
       callback = {"success": "false", "error": result["Message"]}
       self.write(callback)
@@ -74,6 +81,8 @@ class VMDiracHandler(WebHandler):
           rD[param] = record[iP]
       data['instances'].append(rD)
     callback = {"success": "true", "result": data['instances'], "total": data['numRecords'], "date": None}
+    if svcData.get('Cursor'):
+      callback['cursor'] = json.dumps(svcData['Cursor'], default=str)
     self.write(callback)
 
   def web_stopInstances(self):
@@ -85,8 +94,10 @@ class VMDiracHandler(WebHandler):
 
   def web_getHistoryForInstance(self):
     instanceID = int(self.request.arguments['instanceID'][0])
+    includeArchive = 'includeArchive' in self.request.arguments and \
+        str(self.request.arguments['includeArchive'][0]).lower() in ('true', '1')
     rpcClient = RPCClient("WorkloadManagement/VirtualMachineManager")
-    result = rpcClient.getHistoryForInstanceID(instanceID)
+    result = rpcClient.getHistoryForInstanceID(instanceID, includeArchive)
     if not result['OK']:
       return result
     svcData = result['Value']
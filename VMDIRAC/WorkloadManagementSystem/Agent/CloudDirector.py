@@ -11,13 +11,17 @@ from __future__ import absolute_import
 import six
 import random
 import socket
+import json
 import hashlib
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # DIRAC
 from DIRAC import S_OK, S_ERROR, gConfig
 from DIRAC.Core.Base.AgentModule import AgentModule
 from DIRAC.ConfigurationSystem.Client.Helpers import CSGlobals, Registry, Resources
+from DIRAC.ConfigurationSystem.private.ConfigurationData import gConfigurationData
 from DIRAC.WorkloadManagementSystem.Client.MatcherClient import MatcherClient
 from DIRAC.Core.DISET.RPCClient import RPCClient
 from DIRAC.Core.Utilities.List import fromChar
@@ -52,8 +56,18 @@ class CloudDirector(AgentModule):
     AgentModule.__init__(self, *args, **kwargs)
     self.vmTypeDict = {}
     self.vmTypeCECache = {}
+    # (site, ce) -> hash of the endpoint description and its vmTypeDict entries
+    self.endpointCache = {}
+    # Key of the configuration the vmTypeDict was built with
+    self.vmTypeReloadKey = None
     self.vmTypeSlots = {}
     self.failedVMTypes = defaultdict(int)
+    self.failedVMTypesLock = threading.Lock()
+    self.instanceCounters = {}
+    self.instanceCountersLock = threading.Lock()
+    # Platform resolutions, valid for the CS version they were computed with
+    self.platformCache = {'CSVersion': None, 'Compatible': {}, 'DIRAC': {}}
+    self.platformCacheLock = threading.Lock()
     self.firstPass = True
 
     self.vo = ''
@@ -106,7 +120,24 @@ class CloudDirector(AgentModule):
       return result
     self.cloudDN, self.cloudGroup = result['Value']
     self.maxVMsToSubmit = self.am_getOption('MaxVMsToSubmit', 1)
+    # Number of VM types processed in parallel in one cycle, 1 means serial submission
+    self.submissionThreads = self.am_getOption('SubmissionThreads', 1)
+    # Maximum number of VM types of the same endpoint processed in parallel
+    self.submissionThreadsPerEndpoint = max(1, self.am_getOption('SubmissionThreadsPerEndpoint', 1))
+    # Match the task queues of the VM types locally against the result of the global
+    # Matcher call, or ask the Matcher for each VM type. The local matching does not apply
+    # the site job limits and matching delays of the Matcher
+    self.localTQMatching = self.am_getOption('LocalTaskQueueMatching', False)
     self.runningPod = self.am_getOption('RunningPod', self.vo)
+    # Endpoints connect to the clouds on first use, new endpoints are connected in parallel
+    self.lazyEndpoints = self.am_getOption('LazyEndpoints', True)
+    self.endpointWarmUpThreads = max(1, self.am_getOption('EndpointWarmUpThreads', 10))
+
+    # Platform resolutions are only valid for a given version of the configuration
+    csVersion = gConfigurationData.getVersion()
+    with self.platformCacheLock:
+      if self.platformCache['CSVersion'] != csVersion:
+        self.platformCache = {'CSVersion': csVersion, 'Compatible': {}, 'DIRAC': {}}
 
     # Get the site description dictionary
     siteNames = None
@@ -120,14 +151,18 @@ class CloudDirector(AgentModule):
       if not ces:
         ces = None
 
-    result = getVMTypes(vo=self.vo,
-                        siteList=siteNames)
-    if not result['OK']:
-      return result
-    resourceDict = result['Value']
-    result = self.getEndpoints(resourceDict)
-    if not result['OK']:
-      return result
+    # The VM types are only reloaded when the configuration has changed
+    reloadKey = (csVersion, self.vo, self.runningPod, str(siteNames))
+    if reloadKey != self.vmTypeReloadKey:
+      result = getVMTypes(vo=self.vo,
+                          siteList=siteNames)
+      if not result['OK']:
+        return result
+      resourceDict = result['Value']
+      result = self.getEndpoints(resourceDict)
+      if not result['OK']:
+        return result
+      self.vmTypeReloadKey = reloadKey
 
     # if not siteNames:
     #  siteName = gConfig.getValue( '/DIRAC/Site', 'Unknown' )
@@ -159,25 +194,76 @@ class CloudDirector(AgentModule):
     """ Generate a hash of the queue description
     """
     myMD5 = hashlib.md5()
-    myMD5.update(str(vmTypeDict))
+    myMD5.update(json.dumps(vmTypeDict, sort_keys=True, default=str).encode('utf-8'))
     hexstring = myMD5.hexdigest()
     return hexstring
 
+  def __getCompatiblePlatforms(self, platforms):
+    """ Cached version of Resources.getCompatiblePlatforms()
+
+    :param platforms: platform name or list of platform names
+    :return: S_OK(list of compatible DIRAC platforms)/S_ERROR
+    """
+    if isinstance(platforms, six.string_types):
+      platforms = [platforms]
+    key = tuple(sorted(set(platforms)))
+    with self.platformCacheLock:
+      if key in self.platformCache['Compatible']:
+        return S_OK(list(self.platformCache['Compatible'][key]))
+    result = Resources.getCompatiblePlatforms(list(key))
+    if not result['OK']:
+      return result
+    with self.platformCacheLock:
+      self.platformCache['Compatible'][key] = list(result['Value'])
+    return result
+
+  def __getDIRACPlatform(self, platform):
+    """ Cached version of Resources.getDIRACPlatform()
+
+    :param str platform: OS platform name
+    :return: S_OK(list of DIRAC platforms)/S_ERROR
+    """
+    with self.platformCacheLock:
+      if platform in self.platformCache['DIRAC']:
+        return S_OK(list(self.platformCache['DIRAC'][platform]))
+    result = Resources.getDIRACPlatform(platform)
+    if not result['OK']:
+      return result
+    with self.platformCacheLock:
+      self.platformCache['DIRAC'][platform] = list(result['Value'])
+    return result
+
   def getEndpoints(self, resourceDict):
-    """ Get the list of relevant CEs and their descriptions
+    """ Get the list of relevant CEs and their descriptions. The VM types of the
+        endpoints with an unchanged description are taken over from the previous call
     """
 
-    self.vmTypeDict = {}
+    vmTypeDict = {}
+    endpointCache = {}
     ceFactory = EndpointFactory()
 
     result = getPilotBootstrapParameters(vo=self.vo, runningPod=self.runningPod)
     if not result['OK']:
       return result
     opParameters = result['Value']
+    # Configuration outside of the endpoint sections that the VM type descriptions depend on
+    globalParameters = [self.vo, self.runningPod, opParameters,
+                        gConfig.getValue('/DIRAC/Setup', 'unknown'),
+                        gConfig.getValue('/DIRAC/Configuration/Servers', []),
+                        gConfig.getValue('/DIRAC/Security/CAPath', ''),
+                        gConfig.getOptionsDict('/Resources/Computing/OSCompatibility').get('Value', {})]
 
     for site in resourceDict:
       for ce in resourceDict[site]:
         ceDict = resourceDict[site][ce]
+        endpointHash = self.__generateVMTypeHash([site, ce, ceDict, globalParameters])
+        if (site, ce) in self.endpointCache and self.endpointCache[(site, ce)]['Hash'] == endpointHash:
+          endpointCache[(site, ce)] = self.endpointCache[(site, ce)]
+          vmTypeDict.update(endpointCache[(site, ce)]['VMTypes'])
+          continue
+        endpointCache[(site, ce)] = {'Hash': endpointHash, 'VMTypes': {}}
+        endpointVMTypes = endpointCache[(site, ce)]['VMTypes']
+
         ceTags = ceDict.get('Tag', [])
         if isinstance(ceTags, six.string_types):
           ceTags = fromChar(ceTags)
@@ -185,47 +271,44 @@ class CloudDirector(AgentModule):
         qDict = ceDict.pop('VMTypes')
         for vmType in qDict:
           vmTypeName = '%s_%s' % (ce, vmType)
-          self.vmTypeDict[vmTypeName] = {}
-          self.vmTypeDict[vmTypeName]['ParametersDict'] = qDict[vmType]
-          self.vmTypeDict[vmTypeName]['ParametersDict']['VMType'] = vmType
-          self.vmTypeDict[vmTypeName]['ParametersDict']['Site'] = site
-          self.vmTypeDict[vmTypeName]['ParametersDict']['Setup'] = gConfig.getValue('/DIRAC/Setup', 'unknown')
-          self.vmTypeDict[vmTypeName]['ParametersDict']['CPUTime'] = 99999999
-
-          vmTypeTags = self.vmTypeDict[vmTypeName]['ParametersDict'].get('Tag')
+          endpointVMTypes[vmTypeName] = {}
+          endpointVMTypes[vmTypeName]['ParametersDict'] = qDict[vmType]
+          endpointVMTypes[vmTypeName]['ParametersDict']['VMType'] = vmType
+          endpointVMTypes[vmTypeName]['ParametersDict']['Site'] = site
+          endpointVMTypes[vmTypeName]['ParametersDict']['Setup'] = gConfig.getValue('/DIRAC/Setup', 'unknown')
+          endpointVMTypes[vmTypeName]['ParametersDict']['CPUTime'] = 99999999
+
+          vmTypeTags = endpointVMTypes[vmTypeName]['ParametersDict'].get('Tag')
           if vmTypeTags and isinstance(vmTypeTags, six.string_types):
             vmTypeTags = fromChar(vmTypeTags)
-            self.vmTypeDict[vmTypeName]['ParametersDict']['Tag'] = vmTypeTags
+            endpointVMTypes[vmTypeName]['ParametersDict']['Tag'] = vmTypeTags
           if ceTags:
             if vmTypeTags:
               allTags = list(set(ceTags + vmTypeTags))
-              self.vmTypeDict[vmTypeName]['ParametersDict']['Tag'] = allTags
+              endpointVMTypes[vmTypeName]['ParametersDict']['Tag'] = allTags
             else:
-              self.vmTypeDict[vmTypeName]['ParametersDict']['Tag'] = ceTags
+              endpointVMTypes[vmTypeName]['ParametersDict']['Tag'] = ceTags
 
-          maxRAM = self.vmTypeDict[vmTypeName]['ParametersDict'].get('MaxRAM')
+          maxRAM = endpointVMTypes[vmTypeName]['ParametersDict'].get('MaxRAM')
           maxRAM = ceMaxRAM if not maxRAM else maxRAM
           if maxRAM:
-            self.vmTypeDict[vmTypeName]['ParametersDict']['MaxRAM'] = maxRAM
+            endpointVMTypes[vmTypeName]['ParametersDict']['MaxRAM'] = maxRAM
 
           ceWholeNode = ceDict.get('WholeNode', 'true')
-          wholeNode = self.vmTypeDict[vmTypeName]['ParametersDict'].get('WholeNode', ceWholeNode)
+          wholeNode = endpointVMTypes[vmTypeName]['ParametersDict'].get('WholeNode', ceWholeNode)
           if wholeNode.lower() in ('yes', 'true'):
-            self.vmTypeDict[vmTypeName]['ParametersDict'].setdefault('Tag', [])
-            self.vmTypeDict[vmTypeName]['ParametersDict']['Tag'].append('WholeNode')
+            endpointVMTypes[vmTypeName]['ParametersDict'].setdefault('Tag', [])
+            endpointVMTypes[vmTypeName]['ParametersDict']['Tag'].append('WholeNode')
 
           platform = ''
-          if "Platform" in self.vmTypeDict[vmTypeName]['ParametersDict']:
-            platform = self.vmTypeDict[vmTypeName]['ParametersDict']['Platform']
+          if "Platform" in endpointVMTypes[vmTypeName]['ParametersDict']:
+            platform = endpointVMTypes[vmTypeName]['ParametersDict']['Platform']
           elif "Platform" in ceDict:
             platform = ceDict['Platform']
-          if platform and platform not in self.platforms:
-            self.platforms.append(platform)
-
-          if "Platform" not in self.vmTypeDict[vmTypeName]['ParametersDict'] and platform:
-            result = Resources.getDIRACPlatform(platform)
+          if "Platform" not in endpointVMTypes[vmTypeName]['ParametersDict'] and platform:
+            result = self.__getDIRACPlatform(platform)
             if result['OK']:
-              self.vmTypeDict[vmTypeName]['ParametersDict']['Platform'] = result['Value'][0]
+              endpointVMTypes[vmTypeName]['ParametersDict']['Platform'] = result['Value'][0]
 
           ceVMTypeDict = dict(ceDict)
           ceVMTypeDict['CEName'] = ce
@@ -233,7 +316,7 @@ class CloudDirector(AgentModule):
           ceVMTypeDict['VMType'] = vmType
           ceVMTypeDict['RunningPod'] = self.runningPod
           ceVMTypeDict['CSServers'] = gConfig.getValue("/DIRAC/Configuration/Servers", [])
-          ceVMTypeDict.update(self.vmTypeDict[vmTypeName]['ParametersDict'])
+          ceVMTypeDict.update(endpointVMTypes[vmTypeName]['ParametersDict'])
 
           # Allow a resource-specifc CAPath to be set (as some clouds have their own CAs)
           # Otherwise fall back to the system-wide default(s)
@@ -247,28 +330,44 @@ class CloudDirector(AgentModule):
           if vmTypeName in self.vmTypeCECache and self.vmTypeCECache[vmTypeName]['Hash'] == vmTypeHash:
             vmTypeCE = self.vmTypeCECache[vmTypeName]['CE']
           else:
-            result = ceFactory.getCEObject(parameters=ceVMTypeDict)
+            result = ceFactory.getCEObject(parameters=ceVMTypeDict, lazy=self.lazyEndpoints)
             if not result['OK']:
               return result
             self.vmTypeCECache.setdefault(vmTypeName, {})
             self.vmTypeCECache[vmTypeName]['Hash'] = vmTypeHash
             self.vmTypeCECache[vmTypeName]['CE'] = result['Value']
             vmTypeCE = self.vmTypeCECache[vmTypeName]['CE']
-            vmTypeCE.setBootstrapParameters(opParameters)
-
-          self.vmTypeDict[vmTypeName]['CE'] = vmTypeCE
-          self.vmTypeDict[vmTypeName]['CEName'] = ce
-          self.vmTypeDict[vmTypeName]['CEType'] = ceDict['CEType']
-          self.vmTypeDict[vmTypeName]['Site'] = site
-          self.vmTypeDict[vmTypeName]['VMType'] = vmType
-          self.vmTypeDict[vmTypeName]['Platform'] = platform
-          self.vmTypeDict[vmTypeName]['MaxInstances'] = ceDict['MaxInstances']
-          if not self.vmTypeDict[vmTypeName]['CE'].isValid():
-            self.log.error('Failed to instantiate CloudEndpoint for %s' % vmTypeName)
-            continue
-
-          if site not in self.sites:
-            self.sites.append(site)
+          vmTypeCE.setBootstrapParameters(opParameters)
+
+          endpointVMTypes[vmTypeName]['CE'] = vmTypeCE
+          endpointVMTypes[vmTypeName]['CEName'] = ce
+          endpointVMTypes[vmTypeName]['CEType'] = ceDict['CEType']
+          endpointVMTypes[vmTypeName]['Site'] = site
+          endpointVMTypes[vmTypeName]['VMType'] = vmType
+          endpointVMTypes[vmTypeName]['Platform'] = platform
+          endpointVMTypes[vmTypeName]['MaxInstances'] = ceDict['MaxInstances']
+
+        vmTypeDict.update(endpointVMTypes)
+
+    ceFactory.warmUp([vmTypeDict[vmTypeName]['CE'] for vmTypeName in vmTypeDict],
+                     threads=self.endpointWarmUpThreads)
+    for vmTypeName in vmTypeDict:
+      if not vmTypeDict[vmTypeName]['CE'].isValid():
+        self.log.error('Failed to instantiate CloudEndpoint for %s' % vmTypeName)
+
+    self.vmTypeDict = vmTypeDict
+    self.endpointCache = endpointCache
+    for vmTypeName in list(self.vmTypeCECache):
+      if vmTypeName not in vmTypeDict:
+        del self.vmTypeCECache[vmTypeName]
+    self.platforms = []
+    self.sites = []
+    for vmTypeName in vmTypeDict:
+      platform = vmTypeDict[vmTypeName]['Platform']
+      if platform and platform not in self.platforms:
+        self.platforms.append(platform)
+      if vmTypeDict[vmTypeName]['CE'].isValid() and vmTypeDict[vmTypeName]['Site'] not in self.sites:
+        self.sites.append(vmTypeDict[vmTypeName]['Site'])
 
     return S_OK()
 
@@ -307,7 +406,7 @@ class CloudDirector(AgentModule):
     if self.voGroups:
       tqDict['OwnerGroup'] = self.voGroups
 
-    result = Resources.getCompatiblePlatforms(self.platforms)
+    result = self.__getCompatiblePlatforms(self.platforms)
     if not result['OK']:
       return result
     tqDict['Platform'] = result['Value']
@@ -316,7 +415,11 @@ class CloudDirector(AgentModule):
     for vmType in vmTypeList:
       if 'Tag' in self.vmTypeDict[vmType]['ParametersDict']:
         tags += self.vmTypeDict[vmType]['ParametersDict']['Tag']
-    tqDict['Tag'] = list(set(tags))
+      # The processor and memory tags the Matcher derives for each VM type, see __submitVMType()
+      if self.vmTypeDict[vmType]['CE'].isValid():
+        tags += self.__getResourceTags(self.vmTypeDict[vmType]['CE'].getParameterDict())
+    # VMs always provide the WholeNode tag, see __submitVMType()
+    tqDict['Tag'] = list(set(tags + ['WholeNode']))
     tqDict['SubmitPool'] = "wenmrPool"
 
     self.log.verbose('Checking overall TQ availability with requirements')
@@ -350,14 +453,18 @@ class CloudDirector(AgentModule):
               testSites.add(site)
       totalWaitingJobs += result['Value'][tqID]['Jobs']
 
-    tqIDList = result['Value'].keys()
+    taskQueueDict = result['Value']
+    tqIDList = list(taskQueueDict)
 
-    result = virtualMachineDB.getInstanceCounters('Status', {})
+    # Snapshot of the instance counters of all the endpoints, kept up to date
+    # in memory with the VMs submitted during this cycle
+    result = virtualMachineDB.getEndpointInstanceCounters({'Status': ['New', 'Submitted', 'Running']})
+    if not result['OK']:
+      return result
+    self.instanceCounters = result['Value']
     totalVMs = 0
-    if result['OK']:
-      for status in result['Value']:
-        if status in ['New', 'Submitted', 'Running']:
-          totalVMs += result['Value'][status]
+    for endpoint in self.instanceCounters:
+      totalVMs += sum(self.instanceCounters[endpoint].values())
     self.log.info('Total %d jobs in %d task queues with %d VMs' % (totalWaitingJobs, len(tqIDList), totalVMs))
 
     # Check if the site is allowed in the mask
@@ -366,178 +473,350 @@ class CloudDirector(AgentModule):
       return S_ERROR('Can not get the site mask')
     siteMaskList = result.get('Value', [])
 
-    vmTypeList = self.vmTypeDict.keys()
+    vmTypeList = list(self.vmTypeDict)
     random.shuffle(vmTypeList)
+
+    cycleDict = {'MatcherClient': matcherClient,
+                 'TaskQueues': taskQueueDict,
+                 'SiteMask': siteMaskList,
+                 'JobSites': jobSites,
+                 'AnySite': anySite,
+                 'TestSites': testSites}
+
     totalSubmittedPilots = 0
     matchedQueues = 0
-    for vmType in vmTypeList:
-      ce = self.vmTypeDict[vmType]['CE']
-      ceName = self.vmTypeDict[vmType]['CEName']
-      vmTypeName = self.vmTypeDict[vmType]['VMType']
-      siteName = self.vmTypeDict[vmType]['Site']
-      platform = self.vmTypeDict[vmType]['Platform']
-      vmTypeTags = self.vmTypeDict[vmType]['ParametersDict'].get('Tag', [])
-      siteMask = siteName in siteMaskList
-      endpoint = "%s::%s" % (siteName, ceName)
-      maxInstances = int(self.vmTypeDict[vmType]['MaxInstances'])
-      processorTags = []
-
-      # vms support WholeNode naturally
-      processorTags.append('WholeNode')
-
-      if not anySite and siteName not in jobSites:
-        self.log.verbose("Skipping queue %s at %s: no workload expected" % (vmTypeName, siteName))
-        continue
-      if not siteMask and siteName not in testSites:
-        self.log.verbose("Skipping queue %s: site %s not in the mask" % (vmTypeName, siteName))
-        continue
-
-      if 'CPUTime' in self.vmTypeDict[vmType]['ParametersDict']:
-        vmTypeCPUTime = int(self.vmTypeDict[vmType]['ParametersDict']['CPUTime'])
-      else:
-        self.log.warn('CPU time limit is not specified for queue %s, skipping...' % vmType)
-        continue
+    if self.submissionThreads <= 1:
+      for vmType in vmTypeList:
+        result = self.__submitVMType(vmType, cycleDict)
+        if not result['OK']:
+          return result
+        matched, submitted = result['Value']
+        matchedQueues += matched
+        totalSubmittedPilots += submitted
+    else:
+      # The VM types of each endpoint are queued, and only SubmissionThreadsPerEndpoint tasks
+      # per endpoint are given to the pool, each one taking the VM types from the endpoint queue
+      # in turn, so that the pool threads never wait for a slow or overloaded endpoint
+      endpointQueues = {}
+      for vmType in vmTypeList:
+        endpoint = "%s::%s" % (self.vmTypeDict[vmType]['Site'], self.vmTypeDict[vmType]['CEName'])
+        endpointQueues.setdefault(endpoint, deque()).append(vmType)
+      endpointTasks = []
+      for vmTypeQueue in endpointQueues.values():
+        endpointTasks.append([vmTypeQueue] * min(self.submissionThreadsPerEndpoint, len(vmTypeQueue)))
+
+      futures = []
+      with ThreadPoolExecutor(max_workers=self.submissionThreads) as executor:
+        # The first task of every endpoint is submitted first
+        for taskRound in range(max([len(tasks) for tasks in endpointTasks] or [0])):
+          for tasks in endpointTasks:
+            if taskRound < len(tasks):
+              futures.append(executor.submit(self.__submitEndpointVMTypes, tasks[taskRound], cycleDict))
+        errors = []
+        for future in as_completed(futures):
+          for result in future.result():
+            if not result['OK']:
+              errors.append(result['Message'])
+              continue
+            matched, submitted = result['Value']
+            matchedQueues += matched
+            totalSubmittedPilots += submitted
+      if errors:
+        return S_ERROR('; '.join(errors))
 
-      # Prepare the queue description to look for eligible jobs
-      ceDict = ce.getParameterDict()
+    self.log.info("%d VMs submitted in total in this cycle, %d matched queues" % (totalSubmittedPilots, matchedQueues))
+    return S_OK()
 
-      if not siteMask:
-        ceDict['JobType'] = "Test"
-      if self.vo:
-        ceDict['VO'] = self.vo
-      if self.voGroups:
-        ceDict['OwnerGroup'] = self.voGroups
+  def __submitEndpointVMTypes(self, vmTypeQueue, cycleDict):
+    """ Submit VMs for the VM types taken in turn from the queue of an endpoint, until it is empty
 
-      result = Resources.getCompatiblePlatforms(platform)
-      if not result['OK']:
-        continue
-      ceDict['Platform'] = result['Value']
+    :param deque vmTypeQueue: VM types of the endpoint, shared by the tasks of the endpoint
+    :param dict cycleDict: information collected once per agent cycle
+    :return: list of the __submitVMType() results
+    """
+    results = []
+    while True:
+      try:
+        vmType = vmTypeQueue.popleft()
+      except IndexError:
+        return results
+      try:
+        results.append(self.__submitVMType(vmType, cycleDict))
+      except Exception as exc:  # pylint: disable=broad-except
+        self.log.exception('Exception while submitting VMs for %s' % vmType, lException=exc)
+        results.append(S_ERROR('Exception while submitting VMs for %s: %s' % (vmType, repr(exc))))
+
+  def __submitVMType(self, vmType, cycleDict):
+    """ Check the eligible workload for the given VM type and submit VMs if necessary
+
+    :param str vmType: VM type name as used in self.vmTypeDict
+    :param dict cycleDict: information collected once per agent cycle
+    :return: S_OK((matched, submitted))/S_ERROR, where matched is 1 if the VM type
+             had eligible task queues, submitted is the number of VMs submitted
+    """
+    ce = self.vmTypeDict[vmType]['CE']
+    ceName = self.vmTypeDict[vmType]['CEName']
+    vmTypeName = self.vmTypeDict[vmType]['VMType']
+    siteName = self.vmTypeDict[vmType]['Site']
+    platform = self.vmTypeDict[vmType]['Platform']
+    vmTypeTags = self.vmTypeDict[vmType]['ParametersDict'].get('Tag', [])
+    siteMask = siteName in cycleDict['SiteMask']
+    endpoint = "%s::%s" % (siteName, ceName)
+    maxInstances = int(self.vmTypeDict[vmType]['MaxInstances'])
+    processorTags = []
+
+    # vms support WholeNode naturally
+    processorTags.append('WholeNode')
+
+    if not cycleDict['AnySite'] and siteName not in cycleDict['JobSites']:
+      self.log.verbose("Skipping queue %s at %s: no workload expected" % (vmTypeName, siteName))
+      return S_OK((0, 0))
+    if not siteMask and siteName not in cycleDict['TestSites']:
+      self.log.verbose("Skipping queue %s: site %s not in the mask" % (vmTypeName, siteName))
+      return S_OK((0, 0))
+
+    if 'CPUTime' not in self.vmTypeDict[vmType]['ParametersDict']:
+      self.log.warn('CPU time limit is not specified for queue %s, skipping...' % vmType)
+      return S_OK((0, 0))
+
+    # Prepare the queue description to look for eligible jobs
+    ceDict = ce.getParameterDict()
+
+    if not siteMask:
+      ceDict['JobType'] = "Test"
+    if self.vo:
+      ceDict['VO'] = self.vo
+    if self.voGroups:
+      ceDict['OwnerGroup'] = self.voGroups
 
-      ceDict['Tag'] = list(set(processorTags + vmTypeTags))
+    result = self.__getCompatiblePlatforms(platform)
+    if not result['OK']:
+      return S_OK((0, 0))
+    ceDict['Platform'] = result['Value']
 
-      # Get the number of eligible jobs for the target site/queue
+    ceDict['Tag'] = list(set(processorTags + vmTypeTags + self.__getResourceTags(ceDict)))
 
-      result = matcherClient.getMatchingTaskQueues(ceDict)
+    # Get the number of eligible jobs for the target site/queue
+    if self.localTQMatching:
+      taskQueueDict = self.__matchTaskQueues(cycleDict['TaskQueues'], ceDict)
+    else:
+      result = cycleDict['MatcherClient'].getMatchingTaskQueues(ceDict)
       if not result['OK']:
         self.log.error('Could not retrieve TaskQueues from TaskQueueDB', result['Message'])
         return result
       taskQueueDict = result['Value']
-      if not taskQueueDict:
-        self.log.verbose('No matching TQs found for %s' % vmType)
-        continue
-
-      matchedQueues += 1
-      totalTQJobs = 0
-      tqIDList = taskQueueDict.keys()
-      for tq in taskQueueDict:
-        totalTQJobs += taskQueueDict[tq]['Jobs']
-
-      self.log.verbose(
-          '%d job(s) from %d task queue(s) are eligible for %s queue' %
-          (totalTQJobs, len(tqIDList), vmType))
-
-      # Get the number of already instantiated VMs for these task queues
-      totalWaitingVMs = 0
-      result = virtualMachineDB.getInstanceCounters('Status', {'Endpoint': endpoint})
-      if result['OK']:
-        for status in result['Value']:
-          if status in ['New', 'Submitted']:
-            totalWaitingVMs += result['Value'][status]
-      if totalWaitingVMs >= totalTQJobs:
-        self.log.verbose("%d VMs already for all the available jobs" % totalWaitingVMs)
-
-      self.log.verbose("%d VMs for the total of %d eligible jobs for %s" % (totalWaitingVMs, totalTQJobs, vmType))
-
-      # Get proxy to be used to connect to the cloud endpoint
-      authType = ce.parameters.get('Auth')
-      if authType and authType.lower() in ['x509', 'voms']:
-        self.log.verbose("Getting cloud proxy for %s/%s" % (siteName, ceName))
-        result = getProxyFileForCE(ce)
-        if not result['OK']:
-          continue
-        ce.setProxy(result['Value'])
-
-      # Get the number of available slots on the target site/endpoint
-      totalSlots = self.getVMInstances(endpoint, maxInstances)
-      if totalSlots == 0:
-        self.log.debug('%s: No slots available' % vmType)
-        continue
-
-      vmsToSubmit = max(0, min(totalSlots, totalTQJobs - totalWaitingVMs))
-      self.log.info('%s: Slots=%d, TQ jobs=%d, VMs: %d, to submit=%d' %
-                    (vmType, totalSlots, totalTQJobs, totalWaitingVMs, vmsToSubmit))
-
-      # Limit the number of VM instances to create to vmsToSubmit
-      vmsToSubmit = min(self.maxVMsToSubmit, vmsToSubmit)
-      if vmsToSubmit == 0:
-        continue
-
-      self.log.info('Going to submit %d VMs to %s queue' % (vmsToSubmit, vmType))
+    if not taskQueueDict:
+      self.log.verbose('No matching TQs found for %s' % vmType)
+      return S_OK((0, 0))
+
+    totalTQJobs = 0
+    tqIDList = list(taskQueueDict)
+    for tq in taskQueueDict:
+      totalTQJobs += taskQueueDict[tq]['Jobs']
+
+    self.log.verbose(
+        '%d job(s) from %d task queue(s) are eligible for %s queue' %
+        (totalTQJobs, len(tqIDList), vmType))
+
+    # Get the number of already instantiated VMs for these task queues
+    totalWaitingVMs = 0
+    with self.instanceCountersLock:
+      endpointCounters = self.instanceCounters.get(endpoint, {})
+      for status in ['New', 'Submitted']:
+        totalWaitingVMs += endpointCounters.get(status, 0)
+    if totalWaitingVMs >= totalTQJobs:
+      self.log.verbose("%d VMs already for all the available jobs" % totalWaitingVMs)
+
+    self.log.verbose("%d VMs for the total of %d eligible jobs for %s" % (totalWaitingVMs, totalTQJobs, vmType))
+
+    # Get proxy to be used to connect to the cloud endpoint
+    authType = ce.parameters.get('Auth')
+    if authType and authType.lower() in ['x509', 'voms']:
+      self.log.verbose("Getting cloud proxy for %s/%s" % (siteName, ceName))
+      result = getProxyFileForCE(ce)
+      if not result['OK']:
+        return S_OK((1, 0))
+      ce.setProxy(result['Value'])
+
+    # Get the number of available slots on the target site/endpoint and reserve the ones
+    # of the VMs to submit
+    totalSlots, totalWaitingVMs, vmsToSubmit = self.__reserveSlots(endpoint, maxInstances, totalTQJobs)
+    if totalSlots == 0:
+      self.log.debug('%s: No slots available' % vmType)
+      return S_OK((1, 0))
+
+    self.log.info('%s: Slots=%d, TQ jobs=%d, VMs: %d, to submit=%d' %
+                  (vmType, totalSlots, totalTQJobs, totalWaitingVMs, vmsToSubmit))
+    if vmsToSubmit == 0:
+      return S_OK((1, 0))
+
+    self.log.info('Going to submit %d VMs to %s queue' % (vmsToSubmit, vmType))
+    try:
       result = ce.createInstances(vmsToSubmit)
+    except Exception:
+      self.__releaseSlots(endpoint, vmsToSubmit)
+      raise
 
-      #result = S_OK()
-      if not result['OK']:
-        self.log.error('Failed submission to queue %s:\n' % vmType, result['Message'])
-        self.failedVMTypes.setdefault(vmType, 0)
+    if not result['OK']:
+      self.__releaseSlots(endpoint, vmsToSubmit)
+      self.log.error('Failed submission to queue %s:\n' % vmType, result['Message'])
+      with self.failedVMTypesLock:
         self.failedVMTypes[vmType] += 1
-        continue
-
-      # Add VMs to the VirtualMachineDB
-      vmDict = result['Value']
-      totalSubmittedPilots += len(vmDict)
-      self.log.info('Submitted %d VMs to %s@%s' % (len(vmDict), vmTypeName, ceName))
+      return S_OK((1, 0))
 
-      pilotList = []
-      for uuID in vmDict:
-        diracUUID = vmDict[uuID]['InstanceID']
-        endpoint = '%s::%s' % (self.vmTypeDict[vmType]['Site'], ceName)
-        result = virtualMachineDB.insertInstance(uuID, vmTypeName, diracUUID, endpoint, self.vo)
-        if not result['OK']:
-          continue
-        for ncpu in range(vmDict[uuID]['NumberOfProcessors']):
-          pRef = 'vm://' + ceName + '/' + diracUUID + ':' + str(ncpu).zfill(2)
-          pilotList.append(pRef)
-
-      stampDict = {}
-      tqPriorityList = []
-      sumPriority = 0.
-      for tq in taskQueueDict:
-        sumPriority += taskQueueDict[tq]['Priority']
-        tqPriorityList.append((tq, sumPriority))
-      tqDict = {}
-      for pilotID in pilotList:
-        rndm = random.random() * sumPriority
-        for tq, prio in tqPriorityList:
-          if rndm < prio:
-            tqID = tq
-            break
-        if tqID not in tqDict:
-          tqDict[tqID] = []
-        tqDict[tqID].append(pilotID)
-
-      for tqID, pilotList in tqDict.items():
-        result = pilotAgentsDB.addPilotTQReference(pilotList,
-                                                   tqID,
-                                                   '',
-                                                   '',
-                                                   self.localhost,
-                                                   'Cloud',
-                                                   stampDict)
-        if not result['OK']:
-          self.log.error('Failed to insert pilots into the PilotAgentsDB: %s' % result['Message'])
+    # Add VMs to the VirtualMachineDB
+    vmDict = result['Value']
+    self.__releaseSlots(endpoint, vmsToSubmit - len(vmDict))
+    self.log.info('Submitted %d VMs to %s@%s' % (len(vmDict), vmTypeName, ceName))
 
-    self.log.info("%d VMs submitted in total in this cycle, %d matched queues" % (totalSubmittedPilots, matchedQueues))
-    return S_OK()
+    pilotList = []
+    for uuID in vmDict:
+      diracUUID = vmDict[uuID]['InstanceID']
+      result = virtualMachineDB.insertInstance(uuID, vmTypeName, diracUUID, endpoint, self.vo)
+      if not result['OK']:
+        continue
+      for ncpu in range(vmDict[uuID]['NumberOfProcessors']):
+        pRef = 'vm://' + ceName + '/' + diracUUID + ':' + str(ncpu).zfill(2)
+        pilotList.append(pRef)
+
+    stampDict = {}
+    tqPriorityList = []
+    sumPriority = 0.
+    for tq in taskQueueDict:
+      sumPriority += taskQueueDict[tq]['Priority']
+      tqPriorityList.append((tq, sumPriority))
+    tqDict = {}
+    for pilotID in pilotList:
+      rndm = random.random() * sumPriority
+      for tq, prio in tqPriorityList:
+        if rndm < prio:
+          tqID = tq
+          break
+      if tqID not in tqDict:
+        tqDict[tqID] = []
+      tqDict[tqID].append(pilotID)
+
+    for tqID, pilotList in tqDict.items():
+      result = pilotAgentsDB.addPilotTQReference(pilotList,
+                                                 tqID,
+                                                 '',
+                                                 '',
+                                                 self.localhost,
+                                                 'Cloud',
+                                                 stampDict)
+      if not result['OK']:
+        self.log.error('Failed to insert pilots into the PilotAgentsDB: %s' % result['Message'])
 
-  def getVMInstances(self, endpoint, maxInstances):
+    return S_OK((1, len(vmDict)))
 
-    result = virtualMachineDB.getInstanceCounters('Status', {'Endpoint': endpoint})
-    if not result['OK']:
-      return result
+  @staticmethod
+  def __getResourceTags(ceDict):
+    """ Get the tags the Matcher derives from the NumberOfProcessors and MaxRAM (in MB)
+        parameters of a resource description: 2Processors..NProcessors, MultiProcessor
+        and 2GB..NGB
 
-    count = 0
-    for status in result['Value']:
-      if status in ['New', 'Submitted', 'Running']:
-        count += int(result['Value'][status])
+    :param dict ceDict: resource description
+    :return: list of tags
+    """
+    tags = []
+    try:
+      nProcessors = int(ceDict.get('NumberOfProcessors') or 0)
+    except (TypeError, ValueError):
+      nProcessors = 0
+    try:
+      maxRAM = int(ceDict.get('MaxRAM') or 0) // 1000
+    except (TypeError, ValueError):
+      maxRAM = 0
+    for param, key in [(maxRAM, 'GB'), (nProcessors, 'Processors')]:
+      if param <= 1024:
+        tags += ['%d%s' % (par, key) for par in range(2, param + 1)]
+    if nProcessors > 1:
+      tags.append('MultiProcessor')
+    return tags
+
+  @staticmethod
+  def __matchTaskQueues(taskQueueDict, ceDict):
+    """ Select the task queues eligible for the given VM type description following the
+        matching rules of the TaskQueueDB. This is used instead of a Matcher call per VM
+        type, the taskQueueDict being the result of the global Matcher call of the cycle.
+        Unlike the Matcher, it does not apply the site job limits and matching delays
+
+    :param dict taskQueueDict: task queues as returned by MatcherClient.getMatchingTaskQueues()
+    :param dict ceDict: VM type description as passed to MatcherClient.getMatchingTaskQueues()
+    :return: dict of the matching task queues
+    """
 
-    return max(0, maxInstances - count)
+    def toSet(value):
+      if value is None:
+        return set()
+      if isinstance(value, six.string_types):
+        return set(fromChar(value))
+      return set(value)
+
+    site = ceDict.get('Site')
+    ownerGroups = toSet(ceDict.get('OwnerGroup'))
+    platforms = toSet(ceDict.get('Platform'))
+    tags = toSet(ceDict.get('Tag'))
+    requiredTags = toSet(ceDict.get('RequiredTag'))
+    cpuTime = ceDict.get('CPUTime')
+    # Resource parameter and the corresponding multi-valued task queue field
+    multiValueFields = [('JobType', 'JobTypes'), ('SubmitPool', 'SubmitPools'), ('GridCE', 'GridCEs')]
+
+    matchDict = {}
+    for tqID, tqDict in taskQueueDict.items():
+      if 'Setup' in ceDict and 'Setup' in tqDict and tqDict['Setup'] != ceDict['Setup']:
+        continue
+      if cpuTime is not None and 'CPUTime' in tqDict and int(tqDict['CPUTime']) > int(cpuTime):
+        continue
+      if ownerGroups and 'OwnerGroup' in tqDict and tqDict['OwnerGroup'] not in ownerGroups:
+        continue
+      tqSites = toSet(tqDict.get('Sites'))
+      if tqSites and 'any' not in [s.lower() for s in tqSites] and site not in tqSites:
+        continue
+      if site in toSet(tqDict.get('BannedSites')):
+        continue
+      tqPlatforms = toSet(tqDict.get('Platforms'))
+      if tqPlatforms and 'any' not in [p.lower() for p in tqPlatforms] and not tqPlatforms & platforms:
+        continue
+      tqTags = toSet(tqDict.get('Tags'))
+      if not tqTags <= tags or not requiredTags <= tqTags:
+        continue
+      matched = True
+      for ceField, tqField in multiValueFields:
+        tqValues = toSet(tqDict.get(tqField))
+        if ceDict.get(ceField) and tqValues and not tqValues & toSet(ceDict[ceField]):
+          matched = False
+          break
+      if matched:
+        matchDict[tqID] = tqDict
+
+    return matchDict
+
+  def __reserveSlots(self, endpoint, maxInstances, totalTQJobs):
+    """ Reserve in the instance counters snapshot the slots of the VMs to submit to the endpoint,
+        so that the VM types of the endpoint submitted in parallel do not exceed its limits.
+        The reserved VMs are counted as Submitted until they are released
+
+    :param str endpoint: endpoint name, site::ce
+    :param int maxInstances: maximum number of instances of the endpoint
+    :param int totalTQJobs: number of jobs eligible for the VM type
+    :return: tuple (free slots, VMs waiting for jobs, number of VMs reserved)
+    """
+    with self.instanceCountersLock:
+      endpointCounters = self.instanceCounters.setdefault(endpoint, {})
+      totalWaitingVMs = 0
+      for status in ['New', 'Submitted']:
+        totalWaitingVMs += int(endpointCounters.get(status, 0))
+      totalSlots = max(0, maxInstances - totalWaitingVMs - int(endpointCounters.get('Running', 0)))
+      vmsToSubmit = max(0, min(totalSlots, totalTQJobs - totalWaitingVMs, self.maxVMsToSubmit))
+      endpointCounters['Submitted'] = endpointCounters.get('Submitted', 0) + vmsToSubmit
+    return totalSlots, totalWaitingVMs, vmsToSubmit
+
+  def __releaseSlots(self, endpoint, count):
+    """ Give back reserved slots which were not used
+    """
+    if count <= 0:
+      return
+    with self.instanceCountersLock:
+      endpointCounters = self.instanceCounters.setdefault(endpoint, {})
+      endpointCounters['Submitted'] = max(0, endpointCounters.get('Submitted', 0) - count)
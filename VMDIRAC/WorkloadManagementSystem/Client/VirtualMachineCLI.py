@@ -91,7 +91,8 @@ class VirtualMachineCLI(CLI):
     """ Get cloud Endpoint object
     """
 
-    result = EndpointFactory().getCE(self.site, self.endpoint, self.vmType)
+    # The endpoint connects on first use, with the extra parameters
+    result = EndpointFactory().getCE(self.site, self.endpoint, self.vmType, lazy=True)
     if not result['OK']:
       print(result['Message'])
       return
@@ -108,7 +109,6 @@ class VirtualMachineCLI(CLI):
 
     if extraParams:
       ce.setParameters(extraParams)
-      ce.initialize()
 
     return ce
 
@@ -42,11 +42,23 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 
+import time
+import atexit
+import datetime
+import threading
+
 import six
+from six.moves import queue
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # DIRAC
 from DIRAC import gConfig, S_ERROR, S_OK
 from DIRAC.Core.Base.DB import DB
+from DIRAC.ConfigurationSystem.Client.PathFinder import getDatabaseSection
 from DIRAC.Core.Utilities import Time
 
 __RCSID__ = "$Id$"
@@ -63,6 +75,17 @@ class VirtualMachineDB(DB):
   # In seconds !
   stallingInterval = 60 * 40
 
+  # Bucket sizes in seconds of the vm_History rollups, and how many days each is kept (0 for ever)
+  historyRollupRetention = {300: 14, 3600: 180, 86400: 0}
+  # Only the buckets older than this (seconds) are rolled up, so that late history records are included
+  historyRollupGrace = 600
+  # Maximum time range in seconds rolled up by one rollupHistory call for each bucket size
+  historyRollupChunk = 7 * 86400
+  # Lifetime in seconds of the cached instance counts
+  countCacheTime = 60
+  # Instance states archived by archiveInstances(), no transition leaves them
+  archiveStates = ['Halted', 'Error']
+
   # When attempting a transition it will be checked if the current state is allowed
   allowedTransitions = {'Image': {'Validated': ['New', 'Validated'], },
                         'Instance': {'Submitted': ['New'],
@@ -104,7 +127,11 @@ class VirtualMachineDB(DB):
                                            'Jobs': 'INTEGER UNSIGNED NOT NULL DEFAULT 0'
                                            },
                                 'PrimaryKey': 'InstanceID',
-                                'Indexes': {'Status': ['Status']},
+                                'Indexes': {'Status': ['Status', 'LastUpdate'],
+                                            'UniqueID': ['UniqueID'],
+                                            'Name': ['Name'],
+                                            'EndpointStatus': ['Endpoint', 'Status'],
+                                            },
                                 }
 
   tablesDesc['vm_History'] = {'Fields': {'InstanceID': 'INTEGER UNSIGNED NOT NULL',
@@ -115,7 +142,10 @@ class VirtualMachineDB(DB):
                                          'TransferredBytes': 'BIGINT UNSIGNED NOT NULL DEFAULT 0',
                                          'Update': 'DATETIME'
                                          },
-                              'Indexes': {'InstanceID': ['InstanceID']},
+                              'Indexes': {'InstanceID': ['InstanceID', 'Update'],
+                                          'Update': ['Update'],
+                                          'StatusUpdate': ['Status', 'Update', 'InstanceID'],
+                                          },
                               }
 
   tablesDesc['vm_RunningPods'] = {'Fields': {'RunningPodID': 'BIGINT UNSIGNED AUTO_INCREMENT NOT NULL',
@@ -131,6 +161,46 @@ class VirtualMachineDB(DB):
                                               }
                                   }
 
+  tablesDesc['vm_HistoryRollup'] = {'Fields': {'BucketSize': 'INTEGER UNSIGNED NOT NULL',
+                                               'BucketStart': 'DATETIME NOT NULL',
+                                               'InstanceID': 'INTEGER UNSIGNED NOT NULL',
+                                               'Endpoint': 'VARCHAR(255) NOT NULL DEFAULT ""',
+                                               'Name': 'VARCHAR(255) NOT NULL DEFAULT ""',
+                                               'RunningPod': 'VARCHAR(255) NOT NULL DEFAULT ""',
+                                               'LoadSum': 'DOUBLE NOT NULL DEFAULT 0',
+                                               'LoadCount': 'INTEGER UNSIGNED NOT NULL DEFAULT 0',
+                                               'MaxJobs': 'INTEGER UNSIGNED NOT NULL DEFAULT 0',
+                                               'MaxTransferredFiles': 'INTEGER UNSIGNED NOT NULL DEFAULT 0',
+                                               'MaxTransferredBytes': 'BIGINT UNSIGNED NOT NULL DEFAULT 0',
+                                               'RunningCount': 'INTEGER UNSIGNED NOT NULL DEFAULT 0'
+                                               },
+                                    'PrimaryKey': ['BucketSize', 'BucketStart', 'InstanceID'],
+                                    }
+
+  # Range [Start, Watermark) of the history covered by the rollups of each bucket size
+  tablesDesc['vm_HistoryRollupState'] = {'Fields': {'BucketSize': 'INTEGER UNSIGNED NOT NULL',
+                                                    'Start': 'DATETIME NOT NULL',
+                                                    'Watermark': 'DATETIME NOT NULL'
+                                                    },
+                                         'PrimaryKey': 'BucketSize',
+                                         }
+
+  # Archive of the instances in a terminal state, and of their history, moved by archiveInstances()
+  tablesDesc['vm_InstancesArchive'] = {'Fields': dict(tablesDesc['vm_Instances']['Fields'],
+                                                      InstanceID='BIGINT UNSIGNED NOT NULL',
+                                                      ArchiveTime='DATETIME'),
+                                       'PrimaryKey': 'InstanceID',
+                                       'Indexes': {'Status': ['Status', 'LastUpdate'],
+                                                   'UniqueID': ['UniqueID'],
+                                                   'EndpointStatus': ['Endpoint', 'Status'],
+                                                   },
+                                       }
+
+  tablesDesc['vm_HistoryArchive'] = {'Fields': dict(tablesDesc['vm_History']['Fields']),
+                                     'Indexes': {'InstanceID': ['InstanceID', 'Update'],
+                                                 },
+                                     }
+
   #######################
   # VirtualDB constructor
   #######################
@@ -143,10 +213,71 @@ class VirtualMachineDB(DB):
     if not result['OK']:
       raise Exception('Can\'t create tables: %s' % result['Message'])
 
+    # Write-behind buffer of the history records, disabled by default
+    self.__historyQueue = None
+    self.__historyThread = None
+    self.__historyFlushSize = 0
+    self.__historyFlushInterval = 0
+    self.__historyPutTimeout = 0
+
+    # Instance counts of getInstancesContent: query -> ( expiration time, count )
+    self.__countCache = {}
+    self.__countCacheLock = threading.Lock()
+
   #######################
   # Public Functions
   #######################
 
+  def enableHistoryBuffer(self, maxSize=10000, flushSize=500, flushInterval=5, putTimeout=1):
+    """
+    Buffer the history records in memory and write them with multi-row inserts from a
+    background thread, when flushSize records are buffered or every flushInterval seconds.
+    Callers block up to putTimeout seconds when the buffer is full and write the record
+    directly if it is still full. The buffer is flushed when the process exits
+
+    :param int maxSize: maximum number of buffered records
+    :param int flushSize: maximum number of records written by one insert
+    :param float flushInterval: maximum time in seconds a record stays in the buffer
+    :param float putTimeout: maximum time in seconds to wait for space in the buffer
+    :return: S_OK
+    """
+    if self.__historyQueue is not None:
+      return S_OK()
+    self.__historyFlushSize = max(1, flushSize)
+    self.__historyFlushInterval = flushInterval
+    self.__historyPutTimeout = putTimeout
+    self.__historyQueue = queue.Queue(maxsize=max(1, maxSize))
+    self.__historyThread = threading.Thread(target=self.__historyFlushLoop, name='VirtualMachineDBHistory')
+    self.__historyThread.setDaemon(True)
+    self.__historyThread.start()
+    atexit.register(self.flushHistoryBuffer)
+    self.log.info('History write-behind buffer enabled, size %d, flush size %d, flush interval %s s' %
+                  (maxSize, flushSize, flushInterval))
+    return S_OK()
+
+  def flushHistoryBuffer(self, timeout=30):
+    """
+    Stop the history buffer thread after it has written all the buffered records,
+    further history records are written directly
+
+    :param float timeout: maximum time in seconds to wait for the buffer to be written
+    :return: S_OK
+    """
+    historyQueue, historyThread = self.__historyQueue, self.__historyThread
+    if historyQueue is None:
+      return S_OK()
+    self.__historyQueue = None
+    self.__historyThread = None
+    deadline = time.time() + timeout
+    # The None sentinel makes the thread write what it has and exit
+    try:
+      historyQueue.put(None, timeout=timeout)
+    except queue.Full:
+      self.log.warn('History buffer still full after %s s, buffered records may be lost' % timeout)
+      return S_OK()
+    historyThread.join(max(0, deadline - time.time()))
+    return S_OK()
+
   def setRunningPodStatus(self, runningPodName):
     """
     Set Status of a given runningPod depending in date interval
@@ -481,6 +612,38 @@ class VirtualMachineDB(DB):
 
     return status
 
+  def recordDBHalts(self, instanceIDList, load=0.0):
+    """
+    Declares "Halted" a list of instances and records their history in one transaction.
+    Instances whose current status does not allow the transition are left untouched
+
+    :param list instanceIDList: DIRAC instance IDs
+    :param float load: load to record in the history
+    :return: S_OK(number of halted instances)/S_ERROR
+    """
+    if not instanceIDList:
+      return S_OK(0)
+    try:
+      load = float(load)
+      idString = ", ".join([str(int(instanceID)) for instanceID in instanceIDList])
+    except ValueError as e:
+      return S_ERROR("Invalid halt parameters: %s" % e)
+
+    tableName, _validStates, idName = self.__getTypeTuple('Instance')
+    sqlCond = '%s IN ( %s ) AND Status IN ( "%s" )' % (idName, idString,
+                                                       '", "'.join(self.allowedTransitions['Instance']['Halted']))
+
+    sqlInsert = 'INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Update`, `Jobs`, ' \
+                '`TransferredFiles`, `TransferredBytes` ) ' \
+                'SELECT %s, "Halted", %s, "%s", 0, 0, 0 FROM `%s` WHERE %s' % \
+                (idName, load, Time.toString(), tableName, sqlCond)
+    sqlUpdate = 'UPDATE `%s` SET Status = "Halted", LastUpdate = UTC_TIMESTAMP() WHERE %s' % (tableName, sqlCond)
+
+    result = self.__runTransaction([sqlInsert, sqlUpdate])
+    if not result['OK']:
+      return result
+    return S_OK(result['Value'][sqlUpdate])
+
   def declareInstanceHalting(self, uniqueID, load):
     """
     Insert the heart beat info from a halting instance
@@ -500,28 +663,43 @@ class VirtualMachineDB(DB):
 
   def declareStalledInstances(self):
     """
-    Check last Heart Beat for all Running instances and declare them Stalled if older than interval
+    Check last Heart Beat for all Running instances and declare them Stalled if older than interval.
+    All the transitions and their history records are written in one transaction
     """
-    oldInstances = self.__getOldInstanceIDs(self.stallingInterval,
-                                            self.allowedTransitions['Instance']['Stalled'])
-    if not oldInstances['OK']:
-      return oldInstances
-
-    stallingInstances = []
-
-    if not oldInstances['Value']:
-      return S_OK(stallingInstances)
-
-    for instanceID in oldInstances['Value']:
-      instanceID = instanceID[0]
-      stalled = self.__setState('Instance', instanceID, 'Stalled')
-      if not stalled['OK']:
-        continue
+    tableName, _validStates, idName = self.__getTypeTuple('Instance')
 
-      self.__addInstanceHistory(instanceID, 'Stalled')
-      stallingInstances.append(instanceID)
+    cutoff = Time.toString(Time.dateTime() - datetime.timedelta(seconds=self.stallingInterval))
+    sqlCond = 'Status IN ( "%s" ) AND LastUpdate < "%s"' % ('", "'.join(self.allowedTransitions['Instance']['Stalled']),
+                                                            cutoff)
+    result = self._query('SELECT %s FROM `%s` WHERE %s' % (idName, tableName, sqlCond))
+    if not result['OK']:
+      return result
+    instanceIDs = [int(row[0]) for row in result['Value']]
+    if not instanceIDs:
+      return S_OK([])
+
+    # The condition is checked again in case an instance reported meanwhile
+    sqlIDs = ', '.join([str(instanceID) for instanceID in instanceIDs])
+    sqlCond = '%s IN ( %s ) AND %s' % (idName, sqlIDs, sqlCond)
+    sqlInsert = 'INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Update`, `Jobs`, ' \
+                '`TransferredFiles`, `TransferredBytes` ) ' \
+                'SELECT %s, "Stalled", 0, "%s", 0, 0, 0 FROM `%s` WHERE %s' % \
+                (idName, Time.toString(), tableName, sqlCond)
+    sqlUpdate = 'UPDATE `%s` SET Status = "Stalled", LastUpdate = UTC_TIMESTAMP() WHERE %s' % (tableName, sqlCond)
+
+    result = self.__runTransaction([sqlInsert, sqlUpdate])
+    if not result['OK']:
+      return result
+    if not result['Value'][sqlUpdate]:
+      return S_OK([])
+    if result['Value'][sqlUpdate] == len(instanceIDs):
+      return S_OK(instanceIDs)
 
-    return S_OK(stallingInstances)
+    sqlSelect = 'SELECT %s FROM `%s` WHERE %s IN ( %s ) AND Status = "Stalled"' % (idName, tableName, idName, sqlIDs)
+    result = self._query(sqlSelect)
+    if not result['OK']:
+      return result
+    return S_OK([int(row[0]) for row in result['Value']])
 
   def instanceIDHeartBeat(self, uniqueID, load, jobs, transferredFiles, transferredBytes, uptime):
     """
@@ -530,24 +708,139 @@ class VirtualMachineDB(DB):
     Declares "Running" the instance and the image
     It returns S_ERROR if the status is not OK
     """
-    instanceID = self.__getInstanceID(uniqueID)
-    if not instanceID['OK']:
-      return instanceID
-    instanceID = instanceID['Value']
+    result = self.instanceIDHeartBeats([(uniqueID, load, jobs, transferredFiles, transferredBytes, uptime)])
+    if not result['OK']:
+      return result
+    return result['Value'][uniqueID]
+
+  def instanceIDHeartBeats(self, heartBeatList):
+    """
+    Insert the heart beat info of a list of running instances with a fixed set of statements
+    It checks the status of each instance and the corresponding image
+    Declares "Running" the instances and the images
+
+    :param list heartBeatList: (uniqueID, load, jobs, transferredFiles, transferredBytes, uptime) tuples,
+                               uptime can be omitted
+    :return: S_OK({uniqueID: S_OK()/S_ERROR, with the 'State' directive for not allowed transitions})/S_ERROR
+    """
+    resultDict = {}
+    heartBeatDict = {}
+    for heartBeat in heartBeatList:
+      uniqueID = heartBeat[0]
+      try:
+        load, jobs, transferredFiles, transferredBytes = heartBeat[1:5]
+        uptime = heartBeat[5] if len(heartBeat) > 5 else 0
+        heartBeatDict[uniqueID] = (float(load), int(jobs), int(transferredFiles),
+                                   int(transferredBytes), int(uptime))
+      except (ValueError, TypeError) as e:
+        resultDict[uniqueID] = S_ERROR("Invalid heart beat values: %s" % e)
+    if not heartBeatDict:
+      return S_OK(resultDict)
+
+    # Instances and images status in one query
+    uniqueIDs = self._escapeValues(list(heartBeatDict))
+    if not uniqueIDs['OK']:
+      return uniqueIDs
+    sqlQuery = 'SELECT i.UniqueID, i.InstanceID, i.Status, i.ErrorMessage, i.VMImageID, img.Status, img.ErrorMessage ' \
+               'FROM `vm_Instances` AS i LEFT JOIN `vm_Images` AS img ON i.VMImageID = img.VMImageID ' \
+               'WHERE i.UniqueID IN ( %s )' % ', '.join(uniqueIDs['Value'])
+    result = self._query(sqlQuery)
+    if not result['OK']:
+      return result
+    statusDict = {}
+    for row in result['Value']:
+      statusDict.setdefault(row[0], row[1:])
+
+    # Instances that can be declared Running
+    runningDict = {}
+    imageIDs = set()
+    for uniqueID in heartBeatDict:
+      if uniqueID not in statusDict:
+        resultDict[uniqueID] = S_ERROR('Unknown %s = %s' % ('UniqueID', uniqueID))
+        continue
+      instanceID, status, errorMessage, imageID, imageStatus, imageErrorMessage = statusDict[uniqueID]
+      result = self.__checkRunningTransition(instanceID, status, errorMessage, imageID, imageStatus, imageErrorMessage)
+      if not result['OK']:
+        resultDict[uniqueID] = result
+        continue
+      runningDict[instanceID] = uniqueID
+      imageIDs.add(imageID)
+    if not runningDict:
+      return S_OK(resultDict)
 
-    result = self.__runningInstance(instanceID, load, jobs, transferredFiles, transferredBytes)
+    tableName, _validStates, idName = self.__getTypeTuple('Instance')
+    sqlValues = ' UNION ALL '.join(['SELECT %d AS InstanceID, %f AS HLoad, %d AS HJobs, %d AS HFiles, '
+                                    '%d AS HBytes, %d AS HUptime' % ((instanceID, ) + heartBeatDict[uniqueID])
+                                    for instanceID, uniqueID in runningDict.items()])
+    sqlJoin = '`%s` AS i JOIN ( %s ) AS v ON i.%s = v.InstanceID' % (tableName, sqlValues, idName)
+    sqlCond = 'i.Status IN ( "%s" )' % '", "'.join(self.allowedTransitions['Instance']['Running'])
+
+    sqlInsert = 'INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Update`, `Jobs`, ' \
+                '`TransferredFiles`, `TransferredBytes` ) ' \
+                'SELECT i.%s, "Running", v.HLoad, "%s", v.HJobs, v.HFiles, v.HBytes FROM %s WHERE %s' % \
+                (idName, Time.toString(), sqlJoin, sqlCond)
+    # Uptime is taken from the history when not reported by the VM
+    sqlUptime = 'IF( v.HUptime > 0, v.HUptime, ' \
+                'IFNULL( ( SELECT MAX( UNIX_TIMESTAMP( h.`Update` ) ) - MIN( UNIX_TIMESTAMP( h.`Update` ) ) ' \
+                'FROM `vm_History` AS h WHERE h.InstanceID = i.%s ), 0 ) )' % idName
+    sqlUpdate = 'UPDATE %s SET i.Status = "Running", i.LastUpdate = UTC_TIMESTAMP(), ' \
+                'i.`Load` = v.HLoad, i.`Jobs` = v.HJobs, i.`Uptime` = %s WHERE %s' % (sqlJoin, sqlUptime, sqlCond)
+    sqlImageUpdate = 'UPDATE `vm_Images` SET Status = "Validated", LastUpdate = UTC_TIMESTAMP() ' \
+                     'WHERE VMImageID IN ( %s ) AND Status IN ( "%s" )' % \
+                     (', '.join([str(int(imageID)) for imageID in imageIDs]),
+                      '", "'.join(self.allowedTransitions['Image']['Validated']))
+
+    # With the history buffer the history records are queued once the transitions are done
+    buffered = self.__historyQueue is not None
+    if buffered:
+      result = self.__runTransaction([sqlUpdate, sqlImageUpdate])
+    else:
+      result = self.__runTransaction([sqlInsert, sqlUpdate, sqlImageUpdate])
     if not result['OK']:
       return result
 
-    self.__setLastLoadJobsAndUptime(instanceID, load, jobs, uptime)
+    if buffered or result['Value'][sqlInsert] < len(runningDict):
+      # The status of some instances may have changed since it was checked
+      sqlQuery = 'SELECT %s, Status FROM `%s` WHERE %s IN ( %s )' % \
+                 (idName, tableName, idName, ', '.join([str(int(instanceID)) for instanceID in runningDict]))
+      result = self._query(sqlQuery)
+      if not result['OK']:
+        return result
+      for instanceID, status in result['Value']:
+        uniqueID = runningDict[instanceID]
+        if status != 'Running':
+          resultDict[uniqueID] = self.__transitionError(status, 'Running')
+        elif buffered:
+          self.__addInstanceHistory(instanceID, 'Running', *heartBeatDict[uniqueID][:4])
+
+    for uniqueID in runningDict.values():
+      resultDict.setdefault(uniqueID, S_OK())
+
+    return S_OK(resultDict)
+
+  def __checkRunningTransition(self, instanceID, status, errorMessage, imageID, imageStatus, imageErrorMessage):
+    """
+    Check that an instance with the given status and image status can be declared Running,
+    setting the instance in Error if its image is not valid
+    """
+    if imageStatus is None:
+      return self.__setError('Instance', instanceID, 'Unknown VMImageID = %s' % imageID)
+    if imageStatus not in self.validImageStates:
+      result = self.__setError('Image', imageID, 'Invalid Status: %s' % imageStatus)
+      return self.__setError('Instance', instanceID, result['Message'])
+    if imageStatus == self.validImageStates[-1]:
+      return self.__setError('Instance', instanceID, imageErrorMessage)
+    if imageStatus not in self.allowedTransitions['Image']['Validated']:
+      result = self.__transitionError(imageStatus, 'Validated')
+      return self.__setError('Instance', instanceID, result['Message'])
 
-    status = self.__getStatus('Instance', instanceID)
-    if not status['OK']:
-      return result
-    status = status['Value']
+    if status not in self.validInstanceStates:
+      return self.__setError('Instance', instanceID, 'Invalid Status: %s' % status)
+    if status == self.validInstanceStates[-1]:
+      return S_ERROR(errorMessage)
+    if status not in self.allowedTransitions['Instance']['Running']:
+      return self.__transitionError(status, 'Running')
 
-    if status == 'Stopping':
-      return S_OK('stop')
     return S_OK()
 
   def getPublicIpFromInstance(self, uniqueId):
@@ -584,6 +877,32 @@ class VirtualMachineDB(DB):
 
     return S_OK(endpoint[0][0])
 
+  def getInstancesEndpointInfo(self, instanceIDList):
+    """
+    For a list of DIRAC instance IDs get the UniqueID, Endpoint and Status of each instance
+
+    :param list instanceIDList: DIRAC instance IDs
+    :return: S_OK({instanceID: {'UniqueID': uniqueID, 'Endpoint': endpoint, 'Status': status}})/S_ERROR
+    """
+    if not instanceIDList:
+      return S_OK({})
+    try:
+      idString = ", ".join([str(int(instanceID)) for instanceID in instanceIDList])
+    except ValueError as e:
+      return S_ERROR("Invalid instance ID: %s" % e)
+
+    tableName, _validStates, idName = self.__getTypeTuple('Instance')
+    sqlQuery = "SELECT %s, UniqueID, Endpoint, Status FROM `%s` WHERE %s IN ( %s )" % \
+               (idName, tableName, idName, idString)
+    result = self._query(sqlQuery)
+    if not result['OK']:
+      return result
+
+    infoDict = {}
+    for instanceID, uniqueID, endpoint, status in result['Value']:
+      infoDict[int(instanceID)] = {'UniqueID': uniqueID, 'Endpoint': endpoint, 'Status': status}
+    return S_OK(infoDict)
+
   def getImageNameFromInstance(self, uniqueId):
     """
     For a given uniqueId it returns the asociated Name in the instance table, thus the ImageName of such instance
@@ -714,103 +1033,232 @@ class VirtualMachineDB(DB):
   # Monitoring Public Functions
   #############################
 
-  def getInstancesContent(self, selDict, sortList, start=0, limit=0):
+  def getInstancesContent(self, selDict, sortList, start=0, limit=0, cursor=None, countMode='exact',
+                          includeArchive=False):
     """
     Function to get the contents of the db
       parameters are a filter to the db
-    """
+
+    Pages can be selected with start and limit, or with cursor and limit: the cursor returned
+    with a page selects the following records in the sort order, whatever its depth
+
+    :param dict selDict: selection, field: value or list of values
+    :param list sortList: sort fields, as ( field, 'ASC'|'DESC' )
+    :param int start: offset of the first record, ignored if a cursor is given
+    :param int limit: maximum number of records, 0 for all
+    :param list cursor: the 'Cursor' of the previous page
+    :param str countMode: how TotalRecords is computed:
+                          'exact', 'cached' (exact, kept for countCacheTime seconds),
+                          'approximate' (table statistics when there is no selection, cached otherwise)
+                          or 'none'
+    :param bool includeArchive: include the archived instances
+    :return: S_OK({'ParameterNames': list, 'Records': list, 'TotalRecords': int|None, 'Cursor': list|None})/S_ERROR
+    """
+    if countMode not in ('exact', 'cached', 'approximate', 'none'):
+      return S_ERROR("Invalid count mode %s" % countMode)
+    try:
+      start = max(0, int(start))
+      limit = max(0, int(limit))
+    except (TypeError, ValueError):
+      return S_ERROR("Start and limit have to be integers")
+
     # Main fields
-    tables = ("`vm_Images` AS img", "`vm_Instances` AS inst")
     imageFields = ('VMImageID', 'Name')
     instanceFields = ('RunningPod', 'InstanceID', 'Endpoint', 'Name', 'UniqueID', 'VMImageID',
                       'Status', 'PublicIP', 'Status', 'ErrorMessage', 'LastUpdate', 'Load', 'Uptime', 'Jobs')
 
     fields = ['img.%s' % f for f in imageFields] + ['inst.%s' % f for f in instanceFields]
-    sqlQuery = "SELECT %s FROM %s" % (", ".join(fields), ", ".join(tables))
-    sqlCond = ['img.VMImageID = inst.VMImageID']
-    for field in selDict:
+
+    def getSQLField(field):
       if field in instanceFields:
-        sqlField = "inst.%s" % field
-      elif field in imageFields:
-        sqlField = "img.%s" % field
-      elif field in fields:
-        sqlField = field
-      else:
+        return "inst.%s" % field
+      if field in imageFields:
+        return "img.%s" % field
+      if field in fields:
+        return field
+      return None
+
+    sqlCond = []
+    needImages = False
+    for field in selDict:
+      sqlField = getSQLField(field)
+      if not sqlField:
         continue
+      needImages = needImages or sqlField.startswith('img.')
       value = selDict[field]
-      if isinstance(value, six.string_types):
-        value = [str(value)]
-      sqlCond.append(" OR ".join(["%s=%s" % (sqlField, self._escapeString(str(value))['Value'])
-                                  for value in selDict[field]]))
-    sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    if sortList:
-      sqlSortList = []
-      for sorting in sortList:
-        if sorting[0] in instanceFields:
-          sqlField = "inst.%s" % sorting[0]
-        elif sorting[0] in imageFields:
-          sqlField = "img.%s" % sorting[0]
-        elif sorting[0] in fields:
-          sqlField = sorting[0]
-        else:
-          continue
-        direction = sorting[1].upper()
-        if direction not in ("ASC", "DESC"):
-          continue
-        sqlSortList.append("%s %s" % (sqlField, direction))
-      if sqlSortList:
-        sqlQuery += " ORDER BY %s" % ", ".join(sqlSortList)
+      if not isinstance(value, (list, tuple)):
+        value = [value]
+      if not value:
+        continue
+      # IN lists let the Status and Endpoint selections use the vm_Instances indexes
+      sqlCond.append("%s IN ( %s )" % (sqlField, ", ".join([self._escapeString(str(v))['Value'] for v in value])))
+
+    sortFields = []
+    for sorting in sortList or []:
+      sqlField = getSQLField(sorting[0])
+      if not sqlField:
+        continue
+      direction = sorting[1].upper()
+      if direction not in ("ASC", "DESC"):
+        continue
+      sortFields.append((sqlField, direction))
+
+    instanceTables = ['vm_Instances']
+    if includeArchive:
+      instanceTables.append('vm_InstancesArchive')
+    sqlInstances = self.__getUnionSource(instanceTables, instanceFields)
+    sqlTables = "%s AS inst JOIN `vm_Images` AS img ON img.VMImageID = inst.VMImageID" % sqlInstances
+    sqlQuery = "SELECT %s FROM %s" % (", ".join(fields), sqlTables)
+    pageCond = list(sqlCond)
+    if cursor is not None:
+      # Keyset pagination: the instance ID makes the sort order total
+      sortFields = [sortField for sortField in sortFields if sortField[0] != 'inst.InstanceID']
+      sortFields.append(('inst.InstanceID', sortFields[-1][1] if sortFields else 'ASC'))
+      if not isinstance(cursor, (list, tuple)) or len(cursor) != len(sortFields):
+        return S_ERROR("Invalid cursor for the given sort fields")
+      pageCond.append(self.__getKeysetCondition(sortFields, cursor))
+    if pageCond:
+      sqlQuery += " WHERE %s" % " AND ".join(pageCond)
+    if sortFields:
+      sqlQuery += " ORDER BY %s" % ", ".join(["%s %s" % sortField for sortField in sortFields])
     if limit:
-      sqlQuery += " LIMIT %d,%d" % (start, limit)
+      if cursor is not None:
+        sqlQuery += " LIMIT %d" % limit
+      else:
+        sqlQuery += " LIMIT %d,%d" % (start, limit)
     retVal = self._query(sqlQuery)
     if not retVal['OK']:
       return retVal
-    data = []
-    # Total records
-    for record in retVal['Value']:
-      record = list(record)
-      data.append(record)
-    totalRecords = len(data)
-    sqlQuery = "SELECT COUNT( InstanceID ) FROM %s WHERE %s" % (", ".join(tables),
-                                                                " AND ".join(sqlCond))
-    retVal = self._query(sqlQuery)
-    if retVal['OK']:
-      totalRecords = retVal['Value'][0][0]
-    # return
+    data = [list(record) for record in retVal['Value']]
+
+    nextCursor = None
+    if cursor is not None and limit and len(data) == limit:
+      nextCursor = [data[-1][fields.index(sortField[0])] for sortField in sortFields]
+
+    if countMode == 'none':
+      totalRecords = None
+    elif cursor is None and not limit:
+      totalRecords = len(data)
+    else:
+      # Count on vm_Instances alone unless the selection needs the images
+      if needImages:
+        sqlQuery = "SELECT COUNT( inst.InstanceID ) FROM %s" % sqlTables
+      else:
+        sqlQuery = "SELECT COUNT( inst.InstanceID ) FROM %s AS inst" % sqlInstances
+      if sqlCond:
+        sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
+      totalRecords = self.__countInstances(sqlQuery, countMode, instanceTables if not sqlCond else None)
+      if totalRecords is None:
+        totalRecords = len(data)
+
     return S_OK({'ParameterNames': fields,
                  'Records': data,
-                 'TotalRecords': totalRecords})
+                 'TotalRecords': totalRecords,
+                 'Cursor': nextCursor})
+
+  def __getKeysetCondition(self, sortFields, cursor):
+    """
+    Condition selecting the records after the cursor in the given sort order,
+    NULL values being the smallest ones as in MySQL
+
+    :param list sortFields: sort fields, as ( SQL field, 'ASC'|'DESC' )
+    :param list cursor: values of the sort fields of the last record of the previous page
+    :return: SQL condition
+    """
+    orCond = []
+    equalCond = []
+    for (sqlField, direction), value in zip(sortFields, cursor):
+      if value is None:
+        afterCond = "%s IS NOT NULL" % sqlField if direction == 'ASC' else None
+        sameCond = "%s IS NULL" % sqlField
+      else:
+        value = self._escapeString(str(value))['Value']
+        if direction == 'ASC':
+          afterCond = "%s > %s" % (sqlField, value)
+        else:
+          afterCond = "( %s < %s OR %s IS NULL )" % (sqlField, value, sqlField)
+        sameCond = "%s = %s" % (sqlField, value)
+      if afterCond:
+        orCond.append("( %s )" % " AND ".join(equalCond + [afterCond]))
+      equalCond.append(sameCond)
+    if not orCond:
+      return "FALSE"
+    return "( %s )" % " OR ".join(orCond)
+
+  @staticmethod
+  def __getUnionSource(tableNames, fields):
+    """
+    Get the table, or the union of the tables with the same fields, to select from
+
+    :param list tableNames: table names
+    :param list fields: fields needed from the tables
+    :return: SQL table reference
+    """
+    if len(tableNames) == 1:
+      return "`%s`" % tableNames[0]
+    sqlFields = ", ".join(["`%s`" % field for field in sorted(set(fields))])
+    return "( %s )" % " UNION ALL ".join(["SELECT %s FROM `%s`" % (sqlFields, tableName)
+                                          for tableName in tableNames])
+
+  def __countInstances(self, sqlQuery, countMode, allInstancesTables=None):
+    """
+    Count the instances with the given query according to the count mode
+
+    :param str sqlQuery: COUNT query
+    :param str countMode: 'exact', 'cached' or 'approximate'
+    :param list allInstancesTables: tables of the instances, if the query counts all of them
+    :return: number of instances, None if it can not be obtained
+    """
+    if countMode == 'approximate' and allInstancesTables:
+      result = self._query("SELECT SUM( TABLE_ROWS ) FROM information_schema.TABLES "
+                           "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ( %s )" %
+                           ", ".join(["'%s'" % tableName for tableName in allInstancesTables]))
+      if result['OK'] and result['Value'] and result['Value'][0][0] is not None:
+        return int(result['Value'][0][0])
+
+    now = time.time()
+    if countMode != 'exact':
+      with self.__countCacheLock:
+        cached = self.__countCache.get(sqlQuery)
+      if cached and cached[0] > now:
+        return cached[1]
 
-  def getHistoryForInstanceID(self, instanceId):
+    result = self._query(sqlQuery)
+    if not result['OK']:
+      return None
+    count = result['Value'][0][0]
+    with self.__countCacheLock:
+      for query in [query for query, cached in self.__countCache.items() if cached[0] <= now]:
+        del self.__countCache[query]
+      self.__countCache[sqlQuery] = (now + self.countCacheTime, count)
+    return count
+
+  def getHistoryForInstanceID(self, instanceId, includeArchive=False):
     try:
       instanceId = int(instanceId)
     except ValueError:
       return S_ERROR("Instance Id has to be a number!")
 
     fields = ('Status', 'Load', 'Update', 'Jobs', 'TransferredFiles', 'TransferredBytes')
-    sqlFields = ['`%s`' % f for f in fields]
+    sqlFields = ", ".join(['`%s`' % f for f in fields])
 
-    sqlQuery = "SELECT %s FROM `vm_History` WHERE InstanceId=%d" % (", ".join(sqlFields), instanceId)
+    sqlQuery = "SELECT %s FROM `vm_History` WHERE InstanceId=%d" % (sqlFields, instanceId)
+    if includeArchive:
+      # The history of an instance is archived together with the instance
+      sqlQuery += " UNION ALL SELECT %s FROM `vm_HistoryArchive` WHERE InstanceId=%d" % (sqlFields, instanceId)
     retVal = self._query(sqlQuery)
     if not retVal['OK']:
       return retVal
     return S_OK({'ParameterNames': fields, 'Records': retVal['Value']})
 
   def getInstanceCounters(self, groupField="Status", selDict=None):
-    if not selDict:
-      selDict = {}
     validFields = VirtualMachineDB.tablesDesc['vm_Instances']['Fields']
     if groupField not in validFields:
       return S_ERROR("%s is not a valid field" % groupField)
-    sqlCond = []
-    for field in selDict:
-      if field not in validFields:
-        return S_ERROR("%s is not a valid field" % field)
-      value = selDict[field]
-      if not isinstance(value, (dict, tuple)):
-        value = (value, )
-      value = [self._escapeString(str(v))['Value'] for v in value]
-      sqlCond.append("`%s` in (%s)" % (field, ", ".join(value)))
+    result = self.__getInstanceCountersCondition(selDict)
+    if not result['OK']:
+      return result
+    sqlCond = result['Value']
     sqlQuery = "SELECT `%s`, COUNT( `%s` ) FROM `vm_Instances`" % (groupField, groupField)
 
     if sqlCond:
@@ -822,6 +1270,30 @@ class VirtualMachineDB(DB):
       return result
     return S_OK(dict(result['Value']))
 
+  def getEndpointInstanceCounters(self, selDict=None):
+    """ Get the number of instances per Endpoint and Status with a single query
+
+    :param dict selDict: selection on the vm_Instances fields
+    :return: S_OK/S_ERROR, value is a dictionary {endpoint: {status: count}}
+    """
+    result = self.__getInstanceCountersCondition(selDict)
+    if not result['OK']:
+      return result
+    sqlCond = result['Value']
+    sqlQuery = "SELECT `Endpoint`, `Status`, COUNT( `InstanceID` ) FROM `vm_Instances`"
+
+    if sqlCond:
+      sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
+    sqlQuery += " GROUP BY `Endpoint`, `Status`"
+
+    result = self._query(sqlQuery)
+    if not result['OK']:
+      return result
+    counterDict = {}
+    for endpoint, status, count in result['Value']:
+      counterDict.setdefault(endpoint, {})[status] = int(count)
+    return S_OK(counterDict)
+
   def getHistoryValues(self, averageBucket, selDict=None, fields2Get=False, timespan=0):
     if not selDict:
       selDict = {}
@@ -846,17 +1318,16 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Average bucket has to be an integer")
 
-    sqlGroup = "FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %d)" % bucketSize
-    sqlFields = ['`InstanceID`', sqlGroup]  # + [ "SUM(`%s`)/COUNT(`%s`)" % ( f, f ) for f in fields2Get ]
+    aggregates = []
     for field in fields2Get:
       if field in cumulativeFields:
-        sqlFields.append("MAX(`%s`)" % field)
+        aggregates.append("MAX( hist.%s )" % field)
       else:
-        sqlFields.append("SUM(`%s`)/COUNT(`%s`)" % (field, field))
+        aggregates.append("SUM( hist.%sSum ) / SUM( hist.%sCount )" % (field, field))
 
-    sqlGroup = "%s, InstanceID" % sqlGroup
     paramFields = ['Update'] + fields2Get
-    sqlCond = []
+    historyCond = []
+    rollupCond = []
 
     for field in selDict:
       if field not in allValidFields:
@@ -865,79 +1336,39 @@ class VirtualMachineDB(DB):
       if not isinstance(value, (list, tuple)):
         value = (value, )
       value = [self._escapeString(str(v))['Value'] for v in value]
-      sqlCond.append("`%s` in (%s)" % (field, ", ".join(value)))
-    if timespan > 0:
-      sqlCond.append("TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %d" % timespan)
-    sqlQuery = "SELECT %s FROM `vm_History`" % ", ".join(sqlFields)
-    if sqlCond:
-      sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    sqlQuery += " GROUP BY %s ORDER BY `Update` ASC" % sqlGroup
-    result = self._query(sqlQuery)
+      historyCond.append("h.`%s` in (%s)" % (field, ", ".join(value)))
+      rollupCond.append("r.`%s` in (%s)" % (field, ", ".join(value)))
+
+    # The rollups only keep the instance dimension of the history
+    useRollup = set(selDict) <= set(['InstanceID'])
+    columns = [('InstanceID', 'r.InstanceID', 'h.InstanceID'),
+               ('LoadSum', 'r.LoadSum', 'h.`Load`'),
+               ('LoadCount', 'r.LoadCount', '1'),
+               ('Jobs', 'r.MaxJobs', 'h.Jobs'),
+               ('TransferredFiles', 'r.MaxTransferredFiles', 'h.TransferredFiles'),
+               ('TransferredBytes', 'r.MaxTransferredBytes', 'h.TransferredBytes')]
+    result = self.__getHistoryBucketsQuery(bucketSize, timespan, columns, "`vm_History` h", historyCond,
+                                           rollupCond, ['InstanceID'], aggregates, useRollup=useRollup)
     if not result['OK']:
       return result
-    dbData = result['Value']
-    # Need ext?
-    requireExtension = set()
-    for i in range(len(fields2Get)):
-      f = fields2Get[i]
-      if f in cumulativeFields:
-        requireExtension.add(i)
+    result = self._query(result['Value'])
+    if not result['OK']:
+      return result
+    # Rows as ( InstanceID, bucket, values... )
+    dbData = [(row[1], row[0]) + tuple(row[2:]) for row in result['Value']]
+    # Cumulative fields are extended to the following buckets of the instance
+    requireExtension = set(i for i, field in enumerate(fields2Get) if field in cumulativeFields)
 
-    if requireExtension:
-      rDates = []
-      for row in dbData:
-        if row[1] not in rDates:
-          rDates.append(row[1])
-      vmData = {}
-      for row in dbData:
-        vmID = row[0]
-        if vmID not in vmData:
-          vmData[vmID] = {}
-        vmData[vmID][row[1]] = row[2:]
-      rDates.sort()
-
-      dbData = []
-      for vmID in vmData:
-        prevValues = []
-        for rDate in rDates:
-          if rDate not in vmData[vmID]:
-            if prevValues:
-              instValues = [rDate]
-              for i in range(len(prevValues)):
-                instValues.append(prevValues[i])
-              dbData.append(instValues)
-          else:
-            row = vmData[vmID][rDate]
-            prevValues = []
-            for i in range(len(row)):
-              if i in requireExtension:
-                prevValues.append(row[i])
-              else:
-                prevValues.append(0)
-
-            instValues = [rDate]
-            for i in range(len(row)):
-              instValues.append(row[i])
-            dbData.append(instValues)
+    if numpy is not None:
+      rDates, sums = self.__sumHistoryRecordsNumPy(dbData, len(fields2Get), requireExtension)
     else:
-      # If we don't require extension just strip vmName
-      dbData = [row[1:] for row in dbData]
-
-    # Final sum
-    sumData = {}
-    for record in dbData:
-      recDate = record[0]
-      rawData = record[1:]
-      if recDate not in sumData:
-        sumData[recDate] = [0.0 for f in rawData]
-      for i in range(len(rawData)):
-        sumData[recDate][i] += float(rawData[i])
+      rDates, sums = self.__sumHistoryRecords(dbData, len(fields2Get), requireExtension)
+
     finalData = []
-    if len(sumData) > 0:
-      firstValues = sumData[sorted(sumData)[0]]
-      for date in sorted(sumData):
+    if rDates:
+      firstValues = sums[0]
+      for date, values in zip(rDates, sums):
         finalData.append([date])
-        values = sumData[date]
         for i in range(len(values)):
           if i in requireExtension:
             finalData[-1].append(max(0, values[i] - firstValues[i]))
@@ -947,6 +1378,96 @@ class VirtualMachineDB(DB):
     return S_OK({'ParameterNames': paramFields,
                  'Records': finalData})
 
+  @staticmethod
+  def __sumHistoryRecords(dbData, nFields, requireExtension):
+    """
+    Sum the per instance history records of each bucket, the fields in requireExtension
+    keeping the last value of the instance in the buckets without record
+
+    :param list dbData: records as ( InstanceID, bucket, values... )
+    :param int nFields: number of values in the records
+    :param set requireExtension: indexes of the values to extend
+    :return: sorted list of buckets, list of the summed values of each bucket
+    """
+    rDates = sorted(set(row[1] for row in dbData))
+    sumData = dict((rDate, [0.0] * nFields) for rDate in rDates)
+
+    if requireExtension:
+      vmData = {}
+      for row in dbData:
+        vmData.setdefault(row[0], {})[row[1]] = row[2:]
+      for vmRecords in vmData.values():
+        prevValues = None
+        for rDate in rDates:
+          values = vmRecords.get(rDate)
+          if values is None:
+            if prevValues is None:
+              continue
+            values = prevValues
+          else:
+            prevValues = [value if i in requireExtension else 0 for i, value in enumerate(values)]
+          dateSum = sumData[rDate]
+          for i in range(nFields):
+            dateSum[i] += float(values[i])
+    else:
+      for row in dbData:
+        dateSum = sumData[row[1]]
+        for i in range(nFields):
+          dateSum[i] += float(row[2 + i])
+
+    return rDates, [sumData[rDate] for rDate in rDates]
+
+  @staticmethod
+  def __sumHistoryRecordsNumPy(dbData, nFields, requireExtension):
+    """
+    NumPy version of __sumHistoryRecords(), the records are pivoted into an
+    ( instance x bucket x value ) array. The values are added in the same order,
+    hence the sums are the same
+
+    :param list dbData: records as ( InstanceID, bucket, values... )
+    :param int nFields: number of values in the records
+    :param set requireExtension: indexes of the values to extend
+    :return: sorted list of buckets, list of the summed values of each bucket
+    """
+    rDates = sorted(set(row[1] for row in dbData))
+    if not rDates:
+      return rDates, []
+    dateIndex = dict((rDate, i) for i, rDate in enumerate(rDates))
+    vmIndex = {}
+    for row in dbData:
+      vmIndex.setdefault(row[0], len(vmIndex))
+
+    rowDates = numpy.array([dateIndex[row[1]] for row in dbData], dtype=numpy.intp)
+    rowValues = numpy.array([[float(value) for value in row[2:]] for row in dbData],
+                            dtype=float).reshape(len(dbData), nFields)
+
+    if not requireExtension:
+      # Unbuffered accumulation, in the order of the records
+      sums = numpy.zeros((len(rDates), nFields))
+      numpy.add.at(sums, rowDates, rowValues)
+      return rDates, sums.tolist()
+
+    nVMs = len(vmIndex)
+    rowVMs = numpy.array([vmIndex[row[0]] for row in dbData], dtype=numpy.intp)
+    values = numpy.zeros((nVMs, len(rDates), nFields))
+    values[rowVMs, rowDates] = rowValues
+    present = numpy.zeros((nVMs, len(rDates)), dtype=bool)
+    present[rowVMs, rowDates] = True
+
+    # Index of the last bucket with a record of the instance, for each bucket
+    lastIndex = numpy.where(present, numpy.arange(len(rDates)), 0)
+    lastIndex = numpy.maximum.accumulate(lastIndex, axis=1)
+    started = numpy.logical_or.accumulate(present, axis=1)
+    filled = values[numpy.arange(nVMs)[:, None], lastIndex]
+    filled[~started] = 0.0
+    notExtended = [i for i in range(nFields) if i not in requireExtension]
+    if notExtended:
+      filled[:, :, notExtended] = numpy.where(present[:, :, None], filled[:, :, notExtended], 0.0)
+
+    # The reduction is not on the contiguous axis, so the instances are added one after
+    # the other, as in the pure Python version
+    return rDates, filled.sum(axis=0).tolist()
+
   def getRunningInstancesHistory(self, timespan=0, bucketSize=900):
 
     try:
@@ -959,17 +1480,7 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Timespan has to be an integer")
 
-    groupby = "FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %d )" % bucketSize
-    sqlFields = [groupby, "COUNT( DISTINCT( `InstanceID` ) )"]
-    sqlQuery = "SELECT %s FROM `vm_History`" % ", ".join(sqlFields)
-    sqlCond = ["`Status` = 'Running'"]
-
-    if timespan > 0:
-      sqlCond.append("TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %d" % timespan)
-    sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    sqlQuery += " GROUP BY %s ORDER BY `Update` ASC" % groupby
-
-    return self._query(sqlQuery)
+    return self.__getRunningInstancesHistory(timespan, bucketSize)
 
   def getRunningInstancesBEPHistory(self, timespan=0, bucketSize=900):
     try:
@@ -981,17 +1492,7 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Timespan has to be an integer")
 
-    groupby = "FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %d )" % bucketSize
-    sqlFields = [groupby, " i.Endpoint, COUNT( DISTINCT( h.`InstanceID` ) ) "]
-    sqlQuery = "SELECT %s FROM `vm_History` h, `vm_Instances` i" % ", ".join(sqlFields)
-    sqlCond = [" h.InstanceID = i.InstanceID AND h.`Status` = 'Running'"]
-
-    if timespan > 0:
-      sqlCond.append("TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %d" % timespan)
-    sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    sqlQuery += " GROUP BY %s , EndPoint ORDER BY `Update` ASC" % groupby
-
-    return self._query(sqlQuery)
+    return self.__getRunningInstancesHistory(timespan, bucketSize, 'Endpoint')
 
   def getRunningInstancesByRunningPodHistory(self, timespan=0, bucketSize=900):
     try:
@@ -1003,17 +1504,7 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Timespan has to be an integer")
 
-    groupby = "FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %d )" % bucketSize
-    sqlFields = [groupby, " i.RunningPod, COUNT( DISTINCT( h.`InstanceID` ) ) "]
-    sqlQuery = "SELECT %s FROM `vm_History` h, `vm_Instances` i" % ", ".join(sqlFields)
-    sqlCond = [" h.InstanceID = i.InstanceID AND h.`Status` = 'Running'"]
-
-    if timespan > 0:
-      sqlCond.append("TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %d" % timespan)
-    sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    sqlQuery += " GROUP BY %s , RunningPod ORDER BY `Update` ASC" % groupby
-
-    return self._query(sqlQuery)
+    return self.__getRunningInstancesHistory(timespan, bucketSize, 'RunningPod')
 
   def getRunningInstancesByImageHistory(self, timespan=0, bucketSize=900):
     try:
@@ -1025,22 +1516,237 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Timespan has to be an integer")
 
-    groupby = "FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %d )" % bucketSize
-    sqlFields = [groupby, " ins.Name, COUNT( DISTINCT( h.`InstanceID` ) ) "]
-    sqlQuery = "SELECT %s FROM `vm_History` h, `vm_Images` img, `vm_Instances` ins" % ", ".join(sqlFields)
-    sqlCond = [" h.InstanceID = ins.InstanceID AND img.VMImageID = ins.VMImageID AND h.`Status` = 'Running'"]
+    return self.__getRunningInstancesHistory(timespan, bucketSize, 'Name')
 
-    if timespan > 0:
-      sqlCond.append("TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %d" % timespan)
-    sqlQuery += " WHERE %s" % " AND ".join(sqlCond)
-    sqlQuery += " GROUP BY %s , ins.Name ORDER BY `Update` ASC" % groupby
+  def rollupHistory(self):
+    """
+    Aggregate the complete buckets of vm_History not yet rolled up into vm_HistoryRollup,
+    for each rollup bucket size, and purge the rollups older than their retention
+
+    :return: S_OK({bucketSize: new watermark})/S_ERROR
+    """
+    result = self._query("SELECT BucketSize, Start, Watermark FROM `vm_HistoryRollupState`")
+    if not result['OK']:
+      return result
+    stateDict = dict((int(row[0]), row[1:]) for row in result['Value'])
 
-    return self._query(sqlQuery)
+    rolledUp = {}
+    for bucketSize in sorted(self.historyRollupRetention):
+      if bucketSize in stateDict:
+        start, watermark = stateDict[bucketSize]
+      else:
+        result = self._query("SELECT FROM_UNIXTIME( UNIX_TIMESTAMP( MIN( `Update` ) ) DIV %d * %d ) "
+                             "FROM `vm_History`" % (bucketSize, bucketSize))
+        if not result['OK']:
+          return result
+        start = watermark = result['Value'][0][0]
+        if watermark is None:
+          # Empty history
+          continue
+
+      # End of the last complete bucket, bounded to keep each run short
+      result = self._query("SELECT FROM_UNIXTIME( LEAST( ( UNIX_TIMESTAMP( UTC_TIMESTAMP() ) - %d ) DIV %d * %d, "
+                           "UNIX_TIMESTAMP( '%s' ) + %d ) )" % (self.historyRollupGrace, bucketSize, bucketSize,
+                                                                watermark, self.historyRollupChunk))
+      if not result['OK']:
+        return result
+      end = result['Value'][0][0]
+      if end is None or end <= watermark:
+        continue
+
+      sqlBucket = "FROM_UNIXTIME( UNIX_TIMESTAMP( h.`Update` ) DIV %d * %d )" % (bucketSize, bucketSize)
+      sqlInsert = "INSERT INTO `vm_HistoryRollup` ( `BucketSize`, `BucketStart`, `InstanceID`, `Endpoint`, " \
+                  "`Name`, `RunningPod`, `LoadSum`, `LoadCount`, `MaxJobs`, `MaxTransferredFiles`, " \
+                  "`MaxTransferredBytes`, `RunningCount` ) " \
+                  "SELECT %d, %s, h.`InstanceID`, IFNULL( i.`Endpoint`, '' ), IFNULL( i.`Name`, '' ), " \
+                  "IFNULL( i.`RunningPod`, '' ), SUM( h.`Load` ), COUNT( h.`Load` ), MAX( h.`Jobs` ), " \
+                  "MAX( h.`TransferredFiles` ), MAX( h.`TransferredBytes` ), SUM( h.`Status` = 'Running' ) " \
+                  "FROM `vm_History` h LEFT JOIN `vm_Instances` i ON h.`InstanceID` = i.`InstanceID` " \
+                  "WHERE h.`Update` >= '%s' AND h.`Update` < '%s' GROUP BY %s, h.`InstanceID` " \
+                  "ON DUPLICATE KEY UPDATE `LoadSum` = VALUES( `LoadSum` ), `LoadCount` = VALUES( `LoadCount` ), " \
+                  "`MaxJobs` = VALUES( `MaxJobs` ), `MaxTransferredFiles` = VALUES( `MaxTransferredFiles` ), " \
+                  "`MaxTransferredBytes` = VALUES( `MaxTransferredBytes` ), " \
+                  "`RunningCount` = VALUES( `RunningCount` )" % (bucketSize, sqlBucket, watermark, end, sqlBucket)
+      sqlState = "INSERT INTO `vm_HistoryRollupState` ( `BucketSize`, `Start`, `Watermark` ) " \
+                 "VALUES ( %d, '%s', '%s' ) ON DUPLICATE KEY UPDATE `Watermark` = VALUES( `Watermark` )" % \
+                 (bucketSize, start, end)
+      result = self.__runTransaction([sqlInsert, sqlState])
+      if not result['OK']:
+        return result
+      rolledUp[bucketSize] = end
+
+    # Retention of the rollups
+    for bucketSize, retentionDays in self.historyRollupRetention.items():
+      if not retentionDays or bucketSize not in stateDict and bucketSize not in rolledUp:
+        continue
+      sqlStart = "FROM_UNIXTIME( ( UNIX_TIMESTAMP( UTC_TIMESTAMP() ) - %d ) DIV %d * %d )" % \
+                 (retentionDays * 86400, bucketSize, bucketSize)
+      sqlDelete = "DELETE FROM `vm_HistoryRollup` WHERE `BucketSize` = %d AND `BucketStart` < %s" % \
+                  (bucketSize, sqlStart)
+      sqlState = "UPDATE `vm_HistoryRollupState` SET `Start` = LEAST( `Watermark`, GREATEST( `Start`, %s ) ) " \
+                 "WHERE `BucketSize` = %d" % (sqlStart, bucketSize)
+      result = self.__runTransaction([sqlState, sqlDelete])
+      if not result['OK']:
+        return result
+
+    return S_OK(rolledUp)
+
+  def archiveInstances(self, archiveDays, batchSize=500, maxBatches=100):
+    """
+    Move the instances in a terminal state not updated for archiveDays days, with their
+    history, to vm_InstancesArchive and vm_HistoryArchive. Each batch of instances is moved
+    in one transaction, with statements which can be repeated after a failure. The most recent
+    instance is never archived, so that its ID can not be reused by the auto increment after
+    a server restart
+
+    :param int archiveDays: minimum age in days of the instances to archive
+    :param int batchSize: number of instances moved per transaction
+    :param int maxBatches: maximum number of batches moved by one call
+    :return: S_OK(number of archived instances)/S_ERROR
+    """
+    try:
+      archiveDays = int(archiveDays)
+      batchSize = max(1, int(batchSize))
+    except ValueError:
+      return S_ERROR("Archive days and batch size have to be integers")
+    if archiveDays <= 0:
+      return S_ERROR("Archive days has to be positive")
+
+    result = self._query("SELECT MAX( `InstanceID` ) FROM `vm_Instances`")
+    if not result['OK']:
+      return result
+    maxInstanceID = result['Value'][0][0]
+    if maxInstanceID is None:
+      return S_OK(0)
+
+    sqlStates = ", ".join(["'%s'" % state for state in self.archiveStates])
+    sqlCutoff = "UTC_TIMESTAMP() - INTERVAL %d DAY" % archiveDays
+    instanceFields = ", ".join(["`%s`" % field for field in self.tablesDesc['vm_Instances']['Fields']])
+    historyFields = ", ".join(["`%s`" % field for field in self.tablesDesc['vm_History']['Fields']])
+
+    archived = 0
+    for _ in range(maxBatches):
+      result = self._query("SELECT `InstanceID` FROM `vm_Instances` WHERE `Status` IN ( %s ) "
+                           "AND `LastUpdate` < %s AND `InstanceID` < %d ORDER BY `InstanceID` LIMIT %d" %
+                           (sqlStates, sqlCutoff, maxInstanceID, batchSize))
+      if not result['OK']:
+        return result
+      instanceIDs = [int(row[0]) for row in result['Value']]
+      if not instanceIDs:
+        break
+      sqlIDs = ", ".join([str(instanceID) for instanceID in instanceIDs])
+
+      # The instances are locked and selected again, in case their state changed meanwhile.
+      # The statements are idempotent so that instances left in vm_Instances after a failure
+      # are archived by a later batch without duplicates
+      sqlCond = "`InstanceID` IN ( %s ) AND `Status` IN ( %s ) AND `LastUpdate` < %s" % \
+                (sqlIDs, sqlStates, sqlCutoff)
+      sqlInstances = "SELECT i.`InstanceID` FROM `vm_Instances` i WHERE i.`InstanceID` IN ( %s ) " \
+                     "AND i.`Status` IN ( %s ) AND i.`LastUpdate` < %s AND %%sEXISTS ( " \
+                     "SELECT 1 FROM `vm_InstancesArchive` a WHERE a.`InstanceID` = i.`InstanceID` )" % \
+                     (sqlIDs, sqlStates, sqlCutoff)
+      sqlInsertHistory = "INSERT INTO `vm_HistoryArchive` ( %s ) SELECT %s FROM `vm_History` " \
+                         "WHERE `InstanceID` IN ( %s )" % (historyFields, historyFields, sqlInstances % 'NOT ')
+      sqlInsertInstances = "INSERT IGNORE INTO `vm_InstancesArchive` ( %s, `ArchiveTime` ) " \
+                           "SELECT %s, UTC_TIMESTAMP() FROM `vm_Instances` WHERE %s" % \
+                           (instanceFields, instanceFields, sqlCond)
+      sqlDeleteHistory = "DELETE FROM `vm_History` WHERE `InstanceID` IN ( %s )" % (sqlInstances % '')
+      sqlDeleteInstances = "DELETE FROM `vm_Instances` WHERE %s AND `InstanceID` IN ( " \
+                           "SELECT a.`InstanceID` FROM `vm_InstancesArchive` a WHERE a.`InstanceID` IN ( %s ) )" % \
+                           (sqlCond, sqlIDs)
+      # The history is copied before the instances, as only the history of the instances
+      # not yet archived is copied
+      result = self.__runTransaction(["SELECT `InstanceID` FROM `vm_Instances` WHERE %s FOR UPDATE" % sqlCond,
+                                      sqlInsertHistory, sqlInsertInstances, sqlDeleteHistory, sqlDeleteInstances])
+      if not result['OK']:
+        return result
+      moved = result['Value'][sqlDeleteInstances]
+      archived += moved
+      self.log.verbose('Archived %d instances' % moved)
+      if len(instanceIDs) < batchSize:
+        break
+
+    return S_OK(archived)
+
+  def maintainHistoryPartitions(self, retentionDays=0, partitionDays=1, partitionsAhead=7):
+    """
+    Partition vm_History by range of days of the Update field, create the partitions for the
+    coming days and drop the ones older than the retention. Partitions not yet rolled up are
+    never dropped
+
+    :param int retentionDays: number of days of history to keep, 0 to keep everything
+    :param int partitionDays: number of days per partition
+    :param int partitionsAhead: number of partitions to prepare after the current one
+    :return: S_OK/S_ERROR
+    """
+    partitionDays = max(1, int(partitionDays))
+    result = self._query("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                         "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'vm_History' "
+                         "AND PARTITION_NAME IS NOT NULL")
+    if not result['OK']:
+      return result
+    boundDict = {}
+    for name, description in result['Value']:
+      if description != 'MAXVALUE':
+        boundDict[int(description)] = name
+
+    def toDays(date):
+      """ Equivalent of the MySQL TO_DAYS function """
+      return date.toordinal() + 365
+
+    def partitionSQL(bound):
+      name = datetime.date.fromordinal(bound - 365).strftime('p%Y%m%d')
+      return 'PARTITION %s VALUES LESS THAN ( %d )' % (name, bound)
+
+    today = toDays(Time.dateTime().date())
+    bounds = [(today // partitionDays + i) * partitionDays for i in range(1, partitionsAhead + 2)]
+
+    if not boundDict:
+      partitions = [partitionSQL(bound) for bound in bounds] + ['PARTITION pMax VALUES LESS THAN MAXVALUE']
+      self.log.info('Partitioning vm_History by range of %d days' % partitionDays)
+      return self._update("ALTER TABLE `vm_History` PARTITION BY RANGE ( TO_DAYS( `Update` ) ) ( %s )" %
+                          ", ".join(partitions))
+
+    newBounds = [bound for bound in bounds if bound > max(boundDict)]
+    if newBounds:
+      partitions = [partitionSQL(bound) for bound in newBounds] + ['PARTITION pMax VALUES LESS THAN MAXVALUE']
+      result = self._update("ALTER TABLE `vm_History` REORGANIZE PARTITION pMax INTO ( %s )" % ", ".join(partitions))
+      if not result['OK']:
+        return result
+
+    if retentionDays > 0:
+      limit = today - retentionDays
+      result = self._query("SELECT TO_DAYS( MIN( `Watermark` ) ) FROM `vm_HistoryRollupState`")
+      if not result['OK']:
+        return result
+      if result['Value'] and result['Value'][0][0] is not None:
+        limit = min(limit, int(result['Value'][0][0]))
+      oldPartitions = [boundDict[bound] for bound in sorted(boundDict) if bound <= limit]
+      if oldPartitions:
+        self.log.info('Dropping vm_History partitions', ', '.join(oldPartitions))
+        result = self._update("ALTER TABLE `vm_History` DROP PARTITION %s" % ", ".join(oldPartitions))
+        if not result['OK']:
+          return result
+
+    return S_OK()
 
   #######################
   # Private Functions
   #######################
 
+  def __runTransaction(self, cmdList):
+    """
+    Run the commands in one transaction. The DIRAC connections are in autocommit mode, so the
+    transaction is opened explicitly, _transaction() rolls it back if a command fails
+
+    :param list cmdList: SQL commands
+    :return: S_OK({command: number of affected rows})/S_ERROR
+    """
+    result = self._transaction(['START TRANSACTION'] + cmdList + ['COMMIT'])
+    if not result['OK']:
+      return result
+    return S_OK(dict(result['Value']))
+
   def __initializeDB(self):
     """
     Create the tables
@@ -1051,13 +1757,187 @@ class VirtualMachineDB(DB):
 
     tablesInDB = [table[0] for table in tables['Value']]
 
+    # Rebuilding the indexes of existing tables locks them, possibly for a long time on large
+    # tables, so it is only done when explicitly requested
+    updateIndexes = gConfig.getValue('%s/UpdateIndexes' % getDatabaseSection('WorkloadManagement/VirtualMachineDB'),
+                                     False)
+
     tablesToCreate = {}
     for tableName in self.tablesDesc:
       if tableName not in tablesInDB:
         tablesToCreate[tableName] = self.tablesDesc[tableName]
+      else:
+        result = self.__updateIndexes(tableName, updateIndexes)
+        if not result['OK']:
+          return result
 
     return self._createTables(tablesToCreate)
 
+  def __updateIndexes(self, tableName, update=False):
+    """
+    Bring the indexes of an existing table in line with its description: missing indexes
+    are added and indexes with other columns than described are rebuilt. The ALTER TABLE
+    blocks the writes to the table while it runs, without update the differences are only
+    reported
+    """
+    result = self._query("SHOW INDEX FROM `%s`" % tableName)
+    if not result['OK']:
+      return result
+    # Columns: Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+    indexesInDB = {}
+    for row in result['Value']:
+      indexesInDB.setdefault(row[2], {})[int(row[3])] = row[4]
+    indexesInDB = dict((name, [columns[seq] for seq in sorted(columns)]) for name, columns in indexesInDB.items())
+
+    alterList = []
+    for indexName, columns in self.tablesDesc[tableName].get('Indexes', {}).items():
+      if indexesInDB.get(indexName) == columns:
+        continue
+      if indexName in indexesInDB:
+        alterList.append('DROP INDEX `%s`' % indexName)
+      alterList.append('ADD INDEX `%s` ( %s )' % (indexName, ', '.join(['`%s`' % column for column in columns])))
+    if not alterList:
+      return S_OK()
+
+    if not update:
+      self.log.warn('The indexes of %s differ from its description, set the UpdateIndexes option '
+                    'of the database to migrate them' % tableName, ', '.join(alterList))
+      return S_OK()
+
+    self.log.info('Updating the indexes of %s' % tableName, ', '.join(alterList))
+    return self._update('ALTER TABLE `%s` %s' % (tableName, ', '.join(alterList)))
+
+  def __getRunningInstancesHistory(self, timespan, bucketSize, groupField=None):
+    """
+    Count the running instances per time bucket, and per instance field if groupField is given
+    """
+    columns = [('InstanceID', 'r.InstanceID', 'h.InstanceID')]
+    historyTables = "`vm_History` h"
+    groupFields = []
+    if groupField:
+      columns.append((groupField, 'r.%s' % groupField, 'i.%s' % groupField))
+      historyTables += " JOIN `vm_Instances` i ON h.InstanceID = i.InstanceID"
+      if groupField == 'Name':
+        historyTables += " JOIN `vm_Images` img ON img.VMImageID = i.VMImageID"
+      groupFields.append(groupField)
+
+    result = self.__getHistoryBucketsQuery(bucketSize, timespan, columns, historyTables,
+                                           ["h.`Status` = 'Running'"], ["r.RunningCount > 0"],
+                                           groupFields, ["COUNT( DISTINCT( hist.InstanceID ) )"])
+    if not result['OK']:
+      return result
+
+    return self._query(result['Value'])
+
+  def __getHistoryBucketsQuery(self, bucketSize, timespan, columns, historyTables, historyCond, rollupCond,
+                               groupFields, aggregates, useRollup=True):
+    """
+    Build the query aggregating the history records of the last timespan seconds per time bucket.
+    The time window condition is a plain range on the indexed Update field and the buckets are
+    grouped by integer keys
+
+    :param int bucketSize: bucket size in seconds
+    :param int timespan: time span in seconds, 0 for all the history
+    :param list columns: columns of the history records, see __getHistorySource()
+    :param str historyTables: tables of the history records, vm_History as h
+    :param list historyCond: conditions on the history records, besides the time window
+    :param list rollupCond: conditions on the rollup records, vm_HistoryRollup as r
+    :param list groupFields: columns to group by besides the bucket
+    :param list aggregates: aggregate expressions on the "hist" columns
+    :param bool useRollup: whether the rollups can be used
+    :return: S_OK(SQL query returning rows of bucket time, group fields and aggregates)/S_ERROR
+    """
+    historyCond = list(historyCond)
+    if timespan > 0:
+      historyCond.append("h.`Update` > UTC_TIMESTAMP() - INTERVAL %d SECOND" % timespan)
+
+    result = self.__getHistorySource(bucketSize, timespan if useRollup else -1, columns, historyTables,
+                                     historyCond, rollupCond)
+    if not result['OK']:
+      return result
+
+    bucketKey = "UNIX_TIMESTAMP( hist.T ) DIV %d * %d" % (bucketSize, bucketSize)
+    innerFields = ["%s AS BucketKey" % bucketKey]
+    innerFields += ["hist.%s AS G%d" % (field, i) for i, field in enumerate(groupFields)]
+    innerFields += ["%s AS A%d" % (aggregate, i) for i, aggregate in enumerate(aggregates)]
+    sqlQuery = "SELECT %s FROM %s GROUP BY %s" % (", ".join(innerFields), result['Value'],
+                                                  ", ".join(["BucketKey"] + ["G%d" % i
+                                                                             for i in range(len(groupFields))]))
+
+    outerFields = ["FROM_UNIXTIME( BucketKey )"]
+    outerFields += ["G%d" % i for i in range(len(groupFields))]
+    outerFields += ["A%d" % i for i in range(len(aggregates))]
+    return S_OK("SELECT %s FROM ( %s ) AS buckets ORDER BY BucketKey ASC" % (", ".join(outerFields), sqlQuery))
+
+  def __getHistorySource(self, bucketSize, timespan, columns, historyTables, historyCond, rollupCond):
+    """
+    Get the SQL derived table "hist" with the history records of the last timespan seconds, read from
+    the rollups for the time range they cover with a bucket size dividing bucketSize, and from
+    vm_History otherwise. The time of the records is in its T column
+
+    :param int bucketSize: bucket size of the query in seconds
+    :param int timespan: time span in seconds, 0 for all the history, negative not to use the rollups
+    :param list columns: (name, rollup table expression, history table expression) of the columns
+    :param str historyTables: tables of the history part, vm_History as h
+    :param list historyCond: conditions on the history part, including the timespan condition
+    :param list rollupCond: conditions on the rollup part, vm_HistoryRollup as r
+    :return: S_OK(SQL derived table)/S_ERROR
+    """
+    historyColumns = ", ".join(["%s AS %s" % (column[2], column[0]) for column in columns])
+    historySelect = "SELECT h.`Update` AS T, %s FROM %s" % (historyColumns, historyTables)
+
+    rollupSizes = [size for size in self.historyRollupRetention if bucketSize % size == 0]
+    state = None
+    if timespan >= 0 and rollupSizes:
+      result = self._query("SELECT BucketSize, Start, Watermark FROM `vm_HistoryRollupState` "
+                           "WHERE BucketSize IN ( %s ) AND Watermark > Start ORDER BY BucketSize DESC" %
+                           ", ".join([str(size) for size in rollupSizes]))
+      if not result['OK']:
+        return result
+      if result['Value']:
+        state = result['Value'][0]
+
+    if not state:
+      sqlQuery = historySelect
+      if historyCond:
+        sqlQuery += " WHERE %s" % " AND ".join(historyCond)
+      return S_OK("( %s ) AS hist" % sqlQuery)
+
+    # The rollups are used from the first complete rollup bucket of the timespan
+    rollupSize, start, watermark = state
+    rollupStart = "'%s'" % start
+    if timespan > 0:
+      rollupStart = "GREATEST( %s, FROM_UNIXTIME( CEIL( UNIX_TIMESTAMP( UTC_TIMESTAMP() - INTERVAL %d SECOND ) " \
+                    "/ %d ) * %d ) )" % (rollupStart, timespan, rollupSize, rollupSize)
+
+    rollupColumns = ", ".join([column[1] for column in columns])
+    rollupSelect = "SELECT r.BucketStart AS T, %s FROM `vm_HistoryRollup` r" % rollupColumns
+    rollupCond = ["r.BucketSize = %d" % rollupSize,
+                  "r.BucketStart >= %s" % rollupStart,
+                  "r.BucketStart < '%s'" % watermark] + list(rollupCond)
+    historyCond = list(historyCond) + ["( h.`Update` < %s OR h.`Update` >= '%s' )" % (rollupStart, watermark)]
+
+    return S_OK("( %s WHERE %s UNION ALL %s WHERE %s ) AS hist" % (rollupSelect, " AND ".join(rollupCond),
+                                                                   historySelect, " AND ".join(historyCond)))
+
+  def __getInstanceCountersCondition(self, selDict):
+    """
+    Build the list of SQL conditions on vm_Instances fields for the instance counters
+    """
+    if not selDict:
+      selDict = {}
+    validFields = VirtualMachineDB.tablesDesc['vm_Instances']['Fields']
+    sqlCond = []
+    for field in selDict:
+      if field not in validFields:
+        return S_ERROR("%s is not a valid field" % field)
+      value = selDict[field]
+      if not isinstance(value, (list, tuple)):
+        value = (value, )
+      value = [self._escapeString(str(v))['Value'] for v in value]
+      sqlCond.append("`%s` in (%s)" % (field, ", ".join(value)))
+    return S_OK(sqlCond)
+
   def __getTypeTuple(self, element):
     """
     return tuple of (tableName, validStates, idName) for object
@@ -1118,70 +1998,6 @@ class VirtualMachineDB(DB):
 
     return S_ERROR('Failed to insert new Instance')
 
-  def __runningInstance(self, instanceID, load, jobs, transferredFiles, transferredBytes):
-    """
-    Checks image status, set it to running and set instance status to running
-    """
-    # Check the Image is OK
-    imageID = self.__getImageForRunningInstance(instanceID)
-    if not imageID['OK']:
-      self.__setError('Instance', instanceID, imageID['Message'])
-      return imageID
-    imageID = imageID['Value']
-
-    # Update Instance to Running
-    stateInstance = self.__setState('Instance', instanceID, 'Running')
-    if not stateInstance['OK']:
-      return stateInstance
-
-    # Update Image to Validated
-    stateImage = self.__setState('Image', imageID, 'Validated')
-    if not stateImage['OK']:
-      self.__setError('Instance', instanceID, stateImage['Message'])
-      return stateImage
-
-    # Add History record
-    self.__addInstanceHistory(instanceID, 'Running', load, jobs, transferredFiles, transferredBytes)
-    return S_OK()
-
-  def __getImageForRunningInstance(self, instanceID):
-    """
-    Looks for imageID for a given instanceID.
-    Check image Transition to Running is allowed
-    Returns:
-      S_OK( imageID )
-      S_ERROR( Reason )
-    """
-    info = self.__getInfo('Instance', instanceID)
-    if not info['OK']:
-      return info
-    info = info['Value']
-
-    _tableName, _validStates, idName = self.__getTypeTuple('Image')
-
-    imageID = info[idName]
-
-    imageStatus = self.__getStatus('Image', imageID)
-    if not imageStatus['OK']:
-      return imageStatus
-
-    return S_OK(imageID)
-
-  def __getOldInstanceIDs(self, secondsIdle, states):
-    """
-    Return list of instance IDs that have not updated after the given time stamp
-    they are required to be in one of the given states
-    """
-    tableName, _validStates, idName = self.__getTypeTuple('Instance')
-
-    sqlCond = []
-    sqlCond.append('TIMESTAMPDIFF( SECOND, `LastUpdate`, UTC_TIMESTAMP() ) > % d' % secondsIdle)
-    sqlCond.append('Status IN ( "%s" )' % '", "'.join(states))
-
-    sqlSelect = 'SELECT %s from `%s` WHERE %s' % (idName, tableName, " AND ".join(sqlCond))
-
-    return self._query(sqlSelect)
-
   def __getSubmittedInstanceID(self, imageName):
     """
     Retrieve and InstanceID associated to a submitted Instance for a given Image
@@ -1232,14 +2048,7 @@ class VirtualMachineDB(DB):
     currentState = currentState['Value']
 
     if currentState not in allowedStates:
-      msg = 'Transition ( %s -> %s ) not allowed' % (currentState, state)
-      if currentState == "Halted":
-        val_state = "halt"
-      elif currentState == "Stopping":
-        val_state = "stop"
-      else:
-        val_state = currentState
-      return {'OK': False, "Message": msg, 'State': val_state}
+      return self.__transitionError(currentState, state)
 
     tableName, _validStates, idName = self.__getTypeTuple(element)
 
@@ -1255,6 +2064,20 @@ class VirtualMachineDB(DB):
       return ret
     return S_OK(state)
 
+  @staticmethod
+  def __transitionError(currentState, state):
+    """
+    Error returned for a not allowed transition, with the directive for the instance in 'State'
+    """
+    msg = 'Transition ( %s -> %s ) not allowed' % (currentState, state)
+    if currentState == "Halted":
+      val_state = "halt"
+    elif currentState == "Stopping":
+      val_state = "stop"
+    else:
+      val_state = currentState
+    return {'OK': False, "Message": msg, 'State': val_state}
+
   def __setInstanceIPs(self, instanceID, publicIP, privateIP):
     """
     Update parameters for an instanceID reporting as running
@@ -1352,25 +2175,74 @@ class VirtualMachineDB(DB):
     except ValueError:
       return S_ERROR("Transferred files has to be an integer value")
 
-    self.insertFields('vm_History', ['InstanceID', 'Status', 'Load',
-                                     'Update', 'Jobs', 'TransferredFiles',
-                                     'TransferredBytes'],
-                      [instanceID, status, load,
-                       Time.toString(), jobs,
-                       transferredFiles, transferredBytes])
+    row = (instanceID, status, load, Time.toString(), jobs, transferredFiles, transferredBytes)
+    historyQueue = self.__historyQueue
+    if historyQueue is not None:
+      try:
+        historyQueue.put(row, timeout=self.__historyPutTimeout)
+        return
+      except queue.Full:
+        self.log.warn('History buffer is full, writing the record directly')
+
+    self.__insertHistoryRows([row])
     return
 
-  def __setLastLoadJobsAndUptime(self, instanceID, load, jobs, uptime):
-    if not uptime:
-      sqlQuery = "SELECT MAX( UNIX_TIMESTAMP( `Update` ) ) - MIN( UNIX_TIMESTAMP( `Update` ) )" \
-                 " FROM `vm_History` WHERE InstanceID = %d GROUP BY InstanceID" % instanceID
-      result = self._query(sqlQuery)
-      if result['OK'] and len(result['Value']) > 0:
-        uptime = int(result['Value'][0][0])
-    sqlUpdate = "UPDATE `vm_Instances` SET `Uptime` = %d, `Jobs`= %d, `Load` = %f WHERE `InstanceID` = %d" % (
-        uptime, jobs, load, instanceID)
-    self._update(sqlUpdate)
-    return S_OK()
+  def __insertHistoryRows(self, rows):
+    """
+    Insert History Records with one statement
+
+    :param list rows: (instanceID, status, load, update, jobs, transferredFiles, transferredBytes) tuples
+    """
+    values = []
+    for instanceID, status, load, update, jobs, transferredFiles, transferredBytes in rows:
+      result = self._escapeValues([status, update])
+      if not result['OK']:
+        return result
+      status, update = result['Value']
+      values.append('( %d, %s, %f, %s, %d, %d, %d )' % (int(instanceID), status, load, update,
+                                                        jobs, transferredFiles, int(transferredBytes)))
+
+    sqlInsert = 'INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Update`, `Jobs`, ' \
+                '`TransferredFiles`, `TransferredBytes` ) VALUES %s' % ', '.join(values)
+    result = self._update(sqlInsert)
+    if not result['OK']:
+      self.log.error('Failed to insert history records', '%d records: %s' % (len(rows), result['Message']))
+    return result
+
+  def __historyFlushLoop(self):
+    """
+    Write the buffered history records, see enableHistoryBuffer()
+    """
+    historyQueue = self.__historyQueue
+    stop = False
+    while not stop:
+      rows = []
+      deadline = time.time() + self.__historyFlushInterval
+      while len(rows) < self.__historyFlushSize:
+        try:
+          row = historyQueue.get(timeout=max(0.01, deadline - time.time()))
+        except queue.Empty:
+          break
+        if row is None:
+          stop = True
+          break
+        rows.append(row)
+      if stop:
+        # Write everything left in the buffer before exiting
+        while True:
+          try:
+            row = historyQueue.get_nowait()
+          except queue.Empty:
+            break
+          if row is not None:
+            rows.append(row)
+      for i in range(0, len(rows), self.__historyFlushSize):
+        # The thread must survive a failed write, the records would be buffered for nothing otherwise
+        try:
+          self.__insertHistoryRows(rows[i:i + self.__historyFlushSize])
+        except Exception as exc:  # pylint: disable=broad-except
+          self.log.exception('Failed to write buffered history records',
+                             '%d records' % len(rows[i:i + self.__historyFlushSize]), lException=exc)
 
   def __getInfo(self, element, iD):
     """
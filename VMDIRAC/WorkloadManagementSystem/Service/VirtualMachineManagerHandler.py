@@ -6,6 +6,7 @@
     - declareInstanceSubmitted
     - declareInstanceRunning
     - instanceIDHeartBeat
+    - instanceIDHeartBeats
     - declareInstanceHalting
     - getInstancesByStatus
     - declareInstancesStopping
@@ -19,10 +20,11 @@ from __future__ import absolute_import
 
 import os
 from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 import six
 
 # DIRAC
-from DIRAC import gLogger, S_ERROR, S_OK
+from DIRAC import gLogger, gConfig, S_ERROR, S_OK
 from DIRAC.Core.DISET.RequestHandler import RequestHandler
 from DIRAC.Core.Utilities.ThreadScheduler import gThreadScheduler
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
@@ -31,26 +33,72 @@ from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from VMDIRAC.WorkloadManagementSystem.DB.VirtualMachineDB import VirtualMachineDB
 from VMDIRAC.Security import VmProperties
 from VMDIRAC.Resources.Cloud.Utilities import STATE_MAP
-from VMDIRAC.Resources.Cloud.ConfigHelper import getVMTypeConfig, getVMTypes
-from VMDIRAC.Resources.Cloud.EndpointFactory import EndpointFactory
-from VMDIRAC.WorkloadManagementSystem.Utilities.Utils import getProxyFileForCE
+from VMDIRAC.Resources.Cloud.ConfigHelper import getVMTypes
+from VMDIRAC.Resources.Cloud.EndpointPool import EndpointPool
+from VMDIRAC.WorkloadManagementSystem.Utilities.QueryCache import QueryCache
 
 __RCSID__ = '$Id$'
 
 # This is a global instance of the VirtualMachineDB class
 gVirtualMachineDB = False
+# This is a global pool of the cloud endpoint objects used by the service
+gEndpointPool = False
+# Number of endpoints and of VMs per endpoint processed in parallel when halting VMs
+gHaltThreads = 10
+gHaltThreadsPerEndpoint = 5
+# vm_History maintenance options
+gHistoryOptions = {}
+# Cache of the history query results shared by the clients
+gHistoryCache = False
+# Archival options of the instances in a terminal state
+gArchiveOptions = {}
 
 
-def initializeVirtualMachineManagerHandler(_serviceInfo):
+def initializeVirtualMachineManagerHandler(serviceInfo):
 
   global gVirtualMachineDB
+  global gEndpointPool
+  global gHaltThreads
+  global gHaltThreadsPerEndpoint
+  global gHistoryOptions
+  global gHistoryCache
+  global gArchiveOptions
 
   gVirtualMachineDB = VirtualMachineDB()
+  gEndpointPool = EndpointPool(ttl=gConfig.getValue('%s/EndpointPoolTTL' % serviceInfo['serviceSectionPath'], 1800),
+                               maxSize=gConfig.getValue('%s/EndpointPoolSize' % serviceInfo['serviceSectionPath'], 100))
+  gHaltThreads = max(1, gConfig.getValue('%s/HaltThreads' % serviceInfo['serviceSectionPath'], 10))
+  gHaltThreadsPerEndpoint = max(1, gConfig.getValue('%s/HaltThreadsPerEndpoint' % serviceInfo['serviceSectionPath'], 5))
+  historyCacheInterval = gConfig.getValue('%s/HistoryCacheInterval' % serviceInfo['serviceSectionPath'], 60)
+  if historyCacheInterval > 0:
+    gHistoryCache = QueryCache(interval=historyCacheInterval,
+                               maxSize=gConfig.getValue('%s/HistoryCacheSize' % serviceInfo['serviceSectionPath'],
+                                                        1000))
+
+  if gConfig.getValue('%s/HistoryWriteBehind' % serviceInfo['serviceSectionPath'], False):
+    gVirtualMachineDB.enableHistoryBuffer(
+        maxSize=gConfig.getValue('%s/HistoryBufferSize' % serviceInfo['serviceSectionPath'], 10000),
+        flushSize=gConfig.getValue('%s/HistoryFlushSize' % serviceInfo['serviceSectionPath'], 500),
+        flushInterval=gConfig.getValue('%s/HistoryFlushInterval' % serviceInfo['serviceSectionPath'], 5))
   haltStalledInstances()
   checkStalledInstances()
 
+  gHistoryOptions = {
+      'Rollups': gConfig.getValue('%s/HistoryRollups' % serviceInfo['serviceSectionPath'], True),
+      'Partitioning': gConfig.getValue('%s/HistoryPartitioning' % serviceInfo['serviceSectionPath'], False),
+      'PartitionDays': gConfig.getValue('%s/HistoryPartitionDays' % serviceInfo['serviceSectionPath'], 1),
+      'RetentionDays': gConfig.getValue('%s/HistoryRetentionDays' % serviceInfo['serviceSectionPath'], 0)}
+
+  gArchiveOptions = {
+      'Days': gConfig.getValue('%s/ArchiveDays' % serviceInfo['serviceSectionPath'], 0),
+      'BatchSize': gConfig.getValue('%s/ArchiveBatchSize' % serviceInfo['serviceSectionPath'], 500)}
+
   if gVirtualMachineDB._connected:
     gThreadScheduler.addPeriodicTask(60 * 15, checkStalledInstances)
+    if gArchiveOptions['Days'] > 0:
+      gThreadScheduler.addPeriodicTask(60 * 60, archiveInstances)
+    if gHistoryOptions['Rollups'] or gHistoryOptions['Partitioning']:
+      gThreadScheduler.addPeriodicTask(60 * 5, maintainHistory)
     return S_OK()
 
   return S_ERROR()
@@ -84,13 +132,29 @@ def getCEInstances(siteList=None, ceList=None, vo=None):
   ceList = []
   for site in imageDict:
     for ce in imageDict[site]:
-      result = EndpointFactory().getCE(site, ce)
+      result = gEndpointPool.getEndpoint(site, ce)
       if not result['OK']:
         continue
       ceList.append((site, ce, result['Value']))
 
   nodeDict = {}
   for site, ceName, ce in ceList:
+    if hasattr(ce, 'iterVMs'):
+      # The endpoint lists its DIRAC servers page by page with server side filtering
+      ceNodes = {}
+      try:
+        for server in ce.iterVMs(namePattern='^DIRAC_'):
+          ceNodes[server['ID']] = {"Site": site,
+                                   "CEName": ceName,
+                                   "NodeName": server['Name'],
+                                   "PublicIP": server['PublicIP'] or 'None',
+                                   "State": (server['Status'] or 'UNKNOWN').upper()}
+      except IOError as e:
+        gLogger.error('Failed to list the instances', '%s/%s: %s' % (site, ceName, str(e)))
+        continue
+      nodeDict.update(ceNodes)
+      continue
+
     result = ce.getVMNodes()
     if not result['OK']:
       continue
@@ -122,14 +186,56 @@ def checkStalledInstances():
   return haltInstances(stallingList)
 
 
-def stopInstance(site, endpoint, nodeID):
+def maintainHistory():
+  """
+   Roll up the VM history and rotate its partitions
+  """
+  if gHistoryOptions['Rollups']:
+    result = gVirtualMachineDB.rollupHistory()
+    if not result['OK']:
+      gLogger.error('maintainHistory: on rollupHistory call: %s' % result['Message'])
+      return result
 
-  result = getVMTypeConfig(site, endpoint)
+  if gHistoryOptions['Partitioning']:
+    result = gVirtualMachineDB.maintainHistoryPartitions(retentionDays=gHistoryOptions['RetentionDays'],
+                                                         partitionDays=gHistoryOptions['PartitionDays'])
+    if not result['OK']:
+      gLogger.error('maintainHistory: on maintainHistoryPartitions call: %s' % result['Message'])
+      return result
+
+  return S_OK()
+
+
+def archiveInstances():
+  """
+   Move the old instances in a terminal state, and their history, to the archive tables
+  """
+  result = gVirtualMachineDB.archiveInstances(gArchiveOptions['Days'], batchSize=gArchiveOptions['BatchSize'])
   if not result['OK']:
+    gLogger.error('archiveInstances: on archiveInstances call: %s' % result['Message'])
     return result
-  ceParams = result['Value']
-  ceFactory = EndpointFactory()
-  result = ceFactory.getCEObject(parameters=ceParams)
+  if result['Value']:
+    gLogger.info('archiveInstances: %d instances archived' % result['Value'])
+
+  return S_OK()
+
+
+def getHistory(method, *args):
+  """ Run a VirtualMachineDB history query, through the history cache if enabled
+
+  :param str method: name of the VirtualMachineDB method
+  :param args: method arguments
+  :return: S_OK/S_ERROR
+  """
+  function = getattr(gVirtualMachineDB, method)
+  if not gHistoryCache:
+    return function(*args)
+  return gHistoryCache.getResult(method, list(args), function)
+
+
+def stopInstance(site, endpoint, nodeID):
+
+  result = gEndpointPool.getEndpoint(site, endpoint)
   if not result['OK']:
     return result
 
@@ -145,13 +251,7 @@ def createEndpoint(uniqueID):
     return result
   site, endpoint = result['Value'].split('::')
 
-  result = getVMTypeConfig(site, endpoint)
-  if not result['OK']:
-    return result
-  ceParams = result['Value']
-  ceFactory = EndpointFactory()
-  result = ceFactory.getCEObject(parameters=ceParams)
-  return result
+  return gEndpointPool.getEndpoint(site, endpoint)
 
 
 def haltInstances(vmList):
@@ -163,40 +263,73 @@ def haltInstances(vmList):
   failed = {}
   successful = {}
 
+  result = gVirtualMachineDB.getInstancesEndpointInfo(vmList)
+  if not result['OK']:
+    gLogger.error('haltInstances: on getInstancesEndpointInfo call: %s' % result['Message'])
+    return result
+  infoDict = result['Value']
+
+  endpointDict = {}
   for instanceID in vmList:
     instanceID = int(instanceID)
-    result = gVirtualMachineDB.getUniqueID(instanceID)
-    if not result['OK']:
-      gLogger.error('haltInstances: on getUniqueID call: %s' % result['Message'])
+    if instanceID not in infoDict:
+      gLogger.error('haltInstances: unknown InstanceID = %s' % instanceID)
       continue
-    uniqueID = result['Value']
+    endpointDict.setdefault(infoDict[instanceID]['Endpoint'], []).append((instanceID, infoDict[instanceID]['UniqueID']))
 
-    result = createEndpoint(uniqueID)
-    if not result['OK']:
-      gLogger.error('haltInstances: on createEndpoint call: %s' % result['Message'])
-      continue
+  if endpointDict:
+    with ThreadPoolExecutor(max_workers=min(gHaltThreads, len(endpointDict))) as executor:
+      for endpointSuccessful, endpointFailed in executor.map(lambda item: haltEndpointInstances(*item),
+                                                             endpointDict.items()):
+        successful.update(endpointSuccessful)
+        failed.update(endpointFailed)
 
-    endpoint = result['Value']
+  result = gVirtualMachineDB.recordDBHalts(list(successful), 0)
+  if not result['OK']:
+    gLogger.error('haltInstances: on recordDBHalts call: %s' % result['Message'])
 
-    # Get proxy to be used to connect to the cloud endpoint
-    authType = endpoint.parameters.get('Auth')
-    if authType and authType.lower() in ['x509', 'voms']:
-      siteName = endpoint.parameters['Site']
-      ceName = endpoint.parameters['CEName']
-      gLogger.verbose("Getting cloud proxy for %s/%s" % (siteName, ceName))
-      result = getProxyFileForCE(endpoint)
-      if not result['OK']:
-        continue
-      endpoint.setProxy(result['Value'])
+  return S_OK({"Successful": successful, "Failed": failed})
 
-    result = endpoint.stopVM(uniqueID)
-    if result['OK']:
-      gVirtualMachineDB.recordDBHalt(instanceID, 0)
-      successful[instanceID] = True
-    else:
-      failed[instanceID] = result['Message']
 
-  return S_OK({"Successful": successful, "Failed": failed})
+def haltEndpointInstances(endpointName, instanceList):
+  """
+   Delete the VMs of one cloud endpoint, in parallel within the per endpoint limit
+
+  :param str endpointName: endpoint as recorded in the DB, <site>::<ce>
+  :param list instanceList: (instanceID, uniqueID) tuples of the VMs to delete
+  :return: tuple of the successful and failed dictionaries
+  """
+  successful = {}
+  failed = {}
+
+  try:
+    site, ce = endpointName.split('::')
+    result = gEndpointPool.getEndpoint(site, ce)
+  except Exception as e:  # pylint: disable=broad-except
+    result = S_ERROR('Failed to get endpoint %s: %s' % (endpointName, repr(e)))
+  if not result['OK']:
+    gLogger.error('haltInstances: on createEndpoint call: %s' % result['Message'])
+    return successful, dict((instanceID, result['Message']) for instanceID, _uniqueID in instanceList)
+
+  # The pooled endpoint is shared by concurrent calls and already has the proxy of the
+  # generic cloud credentials when the endpoint needs one, it must not be modified here
+  endpoint = result['Value']
+
+  def stopVM(uniqueID):
+    try:
+      return endpoint.stopVM(uniqueID)
+    except Exception as e:  # pylint: disable=broad-except
+      return S_ERROR('Exception in stopVM: %s' % repr(e))
+
+  with ThreadPoolExecutor(max_workers=min(gHaltThreadsPerEndpoint, len(instanceList))) as executor:
+    results = executor.map(stopVM, [uniqueID for _instanceID, uniqueID in instanceList])
+    for (instanceID, _uniqueID), result in zip(instanceList, results):
+      if result['OK']:
+        successful[instanceID] = True
+      else:
+        failed[instanceID] = result['Message']
+
+  return successful, failed
 
 
 def getPilotOutput(pilotRef):
@@ -382,6 +515,26 @@ class VirtualMachineManagerHandler(RequestHandler):
 
     return res
 
+  types_instanceIDHeartBeats = [list]
+
+  def export_instanceIDHeartBeats(self, heartBeatList):
+    """
+    Insert the heart beat info of a list of running instances, f.e. forwarded by a site relay
+    Each element of the list is a (uniqueID, load, jobs, transferredFiles, transferredBytes, uptime) tuple
+    It returns for each uniqueID the result the instanceIDHeartBeat call would have returned
+    """
+    if VmProperties.VM_RPC_OPERATION not in self.rpcProperties:
+      return S_ERROR("Unauthorized instanceIDHeartBeats RPC")
+
+    for heartBeat in heartBeatList:
+      if not isinstance(heartBeat, (list, tuple)) or len(heartBeat) not in (5, 6):
+        return S_ERROR("Invalid heart beat: %s" % str(heartBeat))
+
+    res = gVirtualMachineDB.instanceIDHeartBeats(heartBeatList)
+    self.__logResult('instanceIDHeartBeats', res)
+
+    return res
+
   types_declareInstancesStopping = [list]
 
   def export_declareInstancesStopping(self, instanceIdList):
@@ -487,22 +640,25 @@ class VirtualMachineManagerHandler(RequestHandler):
   types_getInstancesContent = [dict, (list, tuple),
                                six.integer_types, six.integer_types]
 
-  def export_getInstancesContent(self, selDict, sortDict, start, limit):
+  def export_getInstancesContent(self, selDict, sortDict, start, limit, cursor=None, countMode='exact',
+                                 includeArchive=False):
     """
-    Retrieve the contents of the DB
+    Retrieve the contents of the DB, see VirtualMachineDB.getInstancesContent for the
+    cursor pagination, the count modes and the archive
     """
-    res = gVirtualMachineDB.getInstancesContent(selDict, sortDict, start, limit)
+    res = gVirtualMachineDB.getInstancesContent(selDict, sortDict, start, limit, cursor=cursor, countMode=countMode,
+                                                includeArchive=includeArchive)
     self.__logResult('getInstancesContent', res)
 
     return res
 
   types_getHistoryForInstanceID = [six.integer_types]
 
-  def export_getHistoryForInstanceID(self, instanceId):
+  def export_getHistoryForInstanceID(self, instanceId, includeArchive=False):
     """
     Retrieve the contents of the DB
     """
-    res = gVirtualMachineDB.getHistoryForInstanceID(instanceId)
+    res = gVirtualMachineDB.getHistoryForInstanceID(instanceId, includeArchive)
     self.__logResult('getHistoryForInstanceID', res)
 
     return res
@@ -518,6 +674,17 @@ class VirtualMachineManagerHandler(RequestHandler):
 
     return res
 
+  types_getEndpointInstanceCounters = [dict]
+
+  def export_getEndpointInstanceCounters(self, selDict):
+    """
+    Retrieve the number of instances per Endpoint and Status
+    """
+    res = gVirtualMachineDB.getEndpointInstanceCounters(selDict)
+    self.__logResult('getEndpointInstanceCounters', res)
+
+    return res
+
   types_getHistoryValues = [int, dict]
 
   def export_getHistoryValues(self, averageBucket, selDict, fields2Get=None, timespan=0):
@@ -526,7 +693,7 @@ class VirtualMachineManagerHandler(RequestHandler):
     """
     if not fields2Get:
       fields2Get = []
-    res = gVirtualMachineDB.getHistoryValues(averageBucket, selDict, fields2Get, timespan)
+    res = getHistory('getHistoryValues', averageBucket, selDict, fields2Get, timespan)
     self.__logResult('getHistoryValues', res)
 
     return res
@@ -537,7 +704,7 @@ class VirtualMachineManagerHandler(RequestHandler):
     """
     Retrieve number of running instances in each bucket
     """
-    res = gVirtualMachineDB.getRunningInstancesHistory(timespan, bucketSize)
+    res = getHistory('getRunningInstancesHistory', timespan, bucketSize)
     self.__logResult('getRunningInstancesHistory', res)
 
     return res
@@ -548,7 +715,7 @@ class VirtualMachineManagerHandler(RequestHandler):
     """
     Retrieve number of running instances in each bucket by End-Point History
     """
-    res = gVirtualMachineDB.getRunningInstancesBEPHistory(timespan, bucketSize)
+    res = getHistory('getRunningInstancesBEPHistory', timespan, bucketSize)
     self.__logResult('getRunningInstancesBEPHistory', res)
 
     return res
@@ -559,7 +726,7 @@ class VirtualMachineManagerHandler(RequestHandler):
     """
     Retrieve number of running instances in each bucket by Running Pod History
     """
-    res = gVirtualMachineDB.getRunningInstancesByRunningPodHistory(timespan, bucketSize)
+    res = getHistory('getRunningInstancesByRunningPodHistory', timespan, bucketSize)
     self.__logResult('getRunningInstancesByRunningPodHistory', res)
 
     return res
@@ -570,7 +737,7 @@ class VirtualMachineManagerHandler(RequestHandler):
     """
     Retrieve number of running instances in each bucket by Running Pod History
     """
-    res = gVirtualMachineDB.getRunningInstancesByImageHistory(timespan, bucketSize)
+    res = getHistory('getRunningInstancesByImageHistory', timespan, bucketSize)
     self.__logResult('getRunningInstancesByImageHistory', res)
 
     return res
@@ -0,0 +1,101 @@
+""" QueryCache keeps the results of expensive read-only queries for a time interval so
+    that identical requests from several clients are served with a single query.
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import json
+import time
+import threading
+
+from DIRAC import S_ERROR, gLogger
+
+__RCSID__ = "$Id$"
+
+
+class QueryCache(object):
+  """ Cache of query results keyed by the query name, its normalized arguments and the
+      time interval of the request. A result is computed once per interval, concurrent
+      identical requests wait for the query in progress instead of running it again
+  """
+
+  def __init__(self, interval=60, maxSize=1000):
+    """ c'tor
+
+    :param int interval: length in seconds of the time intervals the results are valid for
+    :param int maxSize: maximum number of cached results
+    """
+    self.log = gLogger.getSubLogger('QueryCache')
+    self.interval = max(1, interval)
+    self.maxSize = max(1, maxSize)
+    self.__lock = threading.Lock()
+    # key -> [ threading.Event set when the result is available, result ]
+    self.__results = {}
+
+  @staticmethod
+  def __normalize(args):
+    """ Get a hashable representation of the query arguments
+    """
+    return json.dumps(args, sort_keys=True, default=str)
+
+  def __purge(self, timeBucket):
+    """ Remove the results of past intervals, and the oldest ones if the cache is full.
+        Must be called with the lock held
+    """
+    for key in list(self.__results):
+      if key[2] < timeBucket and self.__results[key][0].is_set():
+        del self.__results[key]
+    if len(self.__results) >= self.maxSize:
+      for key in sorted(self.__results, key=lambda key: key[2])[:len(self.__results) - self.maxSize + 1]:
+        if self.__results[key][0].is_set():
+          del self.__results[key]
+
+  def getResult(self, name, args, function):
+    """ Get the result of function( *args ), from the cache if available
+
+    :param str name: query name
+    :param list args: query arguments
+    :param function: function running the query, returning S_OK/S_ERROR
+    :return: S_OK/S_ERROR
+    """
+    timeBucket = int(time.time() // self.interval)
+    key = (name, self.__normalize(args), timeBucket)
+
+    with self.__lock:
+      entry = self.__results.get(key)
+      owner = entry is None
+      if owner:
+        self.__purge(timeBucket)
+        entry = [threading.Event(), None]
+        self.__results[key] = entry
+
+    if not owner:
+      entry[0].wait()
+      return entry[1]
+
+    result = None
+    try:
+      result = function(*args)
+    except Exception as e:  # pylint: disable=broad-except
+      self.log.exception('Exception while running %s' % name, lException=e)
+      result = S_ERROR('Exception while running %s: %s' % (name, repr(e)))
+    finally:
+      entry[1] = result
+      if not result or not result['OK']:
+        # Failed queries are shared with the waiting requests but not kept
+        with self.__lock:
+          if self.__results.get(key) is entry:
+            del self.__results[key]
+      entry[0].set()
+
+    return result
+
+  def clear(self):
+    """ Remove all the cached results
+    """
+    with self.__lock:
+      for key in list(self.__results):
+        if self.__results[key][0].is_set():
+          del self.__results[key]
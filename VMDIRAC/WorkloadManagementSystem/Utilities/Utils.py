@@ -6,7 +6,7 @@ from __future__ import division
 from __future__ import absolute_import
 
 # DIRAC
-from DIRAC import S_ERROR
+from DIRAC import S_OK, S_ERROR
 from DIRAC.ConfigurationSystem.Client.Helpers import Registry
 from DIRAC.FrameworkSystem.Client.ProxyManagerClient import gProxyManager
 
@@ -17,15 +17,15 @@ from VMDIRAC.Resources.Cloud.ConfigHelper import findGenericCloudCredentials
 __RCSID__ = "$Id$"
 
 
-def getProxyFileForCE(ce):
-  """ Get a file with the proxy to be used to connect to the
-      given cloud endpoint
+def getCloudCredentialsForCE(parameters):
+  """ Get the generic cloud credentials to be used to connect to the
+      cloud endpoint with the given parameters
 
-  :param ce: cloud endpoint object
-  :return: S_OK/S_ERROR, value is the path to the proxy file
+  :param dict parameters: cloud endpoint parameters
+  :return: S_OK/S_ERROR, value is the ( DN, group ) tuple
   """
 
-  vo = ce.parameters.get('VO')
+  vo = parameters.get('VO')
   cloudDN = None
   cloudGroup = None
   if vo:
@@ -34,20 +34,37 @@ def getProxyFileForCE(ce):
       return result
     cloudDN, cloudGroup = result['Value']
 
-  cloudUser = ce.parameters.get('GenericCloudUser')
+  cloudUser = parameters.get('GenericCloudUser')
   if cloudUser:
     result = Registry.getDNForUsername(cloudUser)
     if not result['OK']:
       return result
     cloudDN = result['Value'][0]
-  cloudGroup = ce.parameters.get('GenericCloudGroup', cloudGroup)
+  cloudGroup = parameters.get('GenericCloudGroup', cloudGroup)
 
   if cloudDN and cloudGroup:
-    result = gProxyManager.getPilotProxyFromDIRACGroup(cloudDN, cloudGroup, 3600)
-    if not result['OK']:
-      return result
-    proxy = result['Value']
-    result = gProxyManager.dumpProxyToFile(proxy)
-    return result
+    return S_OK((cloudDN, cloudGroup))
   else:
     return S_ERROR('Could not find generic cloud credentials')
+
+
+def getProxyFileForCE(ce):
+  """ Get a file with the proxy to be used to connect to the
+      given cloud endpoint
+
+  :param ce: cloud endpoint object, or dictionary of its parameters
+  :return: S_OK/S_ERROR, value is the path to the proxy file
+  """
+
+  parameters = ce if isinstance(ce, dict) else ce.parameters
+  result = getCloudCredentialsForCE(parameters)
+  if not result['OK']:
+    return result
+  cloudDN, cloudGroup = result['Value']
+
+  result = gProxyManager.getPilotProxyFromDIRACGroup(cloudDN, cloudGroup, 3600)
+  if not result['OK']:
+    return result
+  proxy = result['Value']
+  result = gProxyManager.dumpProxyToFile(proxy)
+  return result
@@ -0,0 +1,111 @@
+""" Unit tests of the local task queue matching of the CloudDirector
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from VMDIRAC.WorkloadManagementSystem.Agent.CloudDirector import CloudDirector
+
+matchTaskQueues = CloudDirector._CloudDirector__matchTaskQueues
+getResourceTags = CloudDirector._CloudDirector__getResourceTags
+
+
+def taskQueue(**kwargs):
+  """ Task queue as returned by MatcherClient.getMatchingTaskQueues()
+  """
+  tqDict = {'Setup': 'Test', 'CPUTime': 86400, 'OwnerGroup': 'vo_user', 'Jobs': 1, 'Priority': 1.}
+  tqDict.update(kwargs)
+  return tqDict
+
+
+TASK_QUEUES = {1: taskQueue(),
+               2: taskQueue(Tags=['MultiProcessor', '4Processors']),
+               3: taskQueue(Tags=['8Processors', 'MultiProcessor']),
+               4: taskQueue(Tags=['GPU']),
+               5: taskQueue(Platforms=['EL7']),
+               6: taskQueue(Platforms=['EL9']),
+               7: taskQueue(Sites=['Cloud.Other.org']),
+               8: taskQueue(Sites=['Cloud.Test.org']),
+               9: taskQueue(BannedSites=['Cloud.Test.org']),
+               10: taskQueue(JobTypes=['Test']),
+               11: taskQueue(JobTypes=['User']),
+               12: taskQueue(OwnerGroup='other_user'),
+               13: taskQueue(Setup='Other'),
+               14: taskQueue(Tags=['WholeNode', '4GB'])}
+
+
+def vmTypeDict(**kwargs):
+  """ VM type description as built by CloudDirector.__submitVMType()
+  """
+  ceDict = {'Setup': 'Test', 'CPUTime': 99999999, 'Site': 'Cloud.Test.org', 'OwnerGroup': ['vo_user'],
+            'Platform': ['EL7', 'EL6']}
+  ceDict.update(kwargs)
+  ceDict['Tag'] = list(set(ceDict.get('Tag', []) + ['WholeNode'] + getResourceTags(ceDict)))
+  return ceDict
+
+
+def test_resourceTags():
+  """ The processor and memory tags are the ones of Matcher._processResourceDescription()
+  """
+  assert getResourceTags({}) == []
+  assert getResourceTags({'NumberOfProcessors': 1, 'MaxRAM': 1500}) == []
+  assert sorted(getResourceTags({'NumberOfProcessors': '4', 'MaxRAM': '3000'})) == \
+      ['2GB', '2Processors', '3GB', '3Processors', '4Processors', 'MultiProcessor']
+  assert getResourceTags({'NumberOfProcessors': 'many'}) == []
+
+
+def test_singleCore():
+  """ A single core VM type matches the task queues without processor requirements
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict())
+  assert sorted(matched) == [1, 5, 8, 10, 11]
+
+
+def test_multiCore():
+  """ A multi core VM type gets the NProcessors and MultiProcessor tags like with the Matcher
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(NumberOfProcessors=4, MaxRAM=8000))
+  assert sorted(matched) == [1, 2, 5, 8, 10, 11, 14]
+
+
+def test_tags():
+  """ The task queue tags must be provided by the VM type, the required tags of the
+      VM type must be requested by the task queue
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(Tag=['GPU']))
+  assert sorted(matched) == [1, 4, 5, 8, 10, 11]
+
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(Tag=['GPU'], RequiredTag=['GPU']))
+  assert sorted(matched) == [4]
+
+
+def test_platforms():
+  """ Task queues of another platform do not match, the ones without platform do
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(Platform=['EL9']))
+  assert sorted(matched) == [1, 6, 8, 10, 11]
+
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(Platform='EL9, EL7'))
+  assert sorted(matched) == [1, 5, 6, 8, 10, 11]
+
+
+def test_sites():
+  """ The sites and banned sites of the task queues are applied
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(Site='Cloud.Other.org'))
+  assert sorted(matched) == [1, 5, 7, 9, 10, 11]
+
+
+def test_jobTypes():
+  """ A VM type of a site out of the mask only gets the Test jobs
+  """
+  matched = matchTaskQueues(TASK_QUEUES, vmTypeDict(JobType='Test'))
+  assert sorted(matched) == [1, 5, 8, 10]
+
+
+def test_cpuTime():
+  """ The task queues with longer jobs than the VM type allows do not match
+  """
+  matched = matchTaskQueues({1: taskQueue(CPUTime=1000), 2: taskQueue(CPUTime=100000)}, vmTypeDict(CPUTime=50000))
+  assert sorted(matched) == [1]
@@ -0,0 +1,370 @@
+""" Unit tests of the CloudResourceCatalogue against the CS lookups it replaces
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+
+import pytest
+from diraccfg import CFG
+
+from DIRAC import S_OK, S_ERROR
+from DIRAC.Core.Utilities.List import fromChar
+from VMDIRAC.Resources.Cloud import CloudResourceCatalogue as catalogueModule
+
+RESOURCES = """
+Resources
+{
+  Sites
+  {
+    Cloud
+    {
+      Cloud.Open.org
+      {
+        Cloud
+        {
+          open.org
+          {
+            CEType = OpenStack
+            MaxInstances = 10
+            Tag = Cloud, Fast
+            VMTypes
+            {
+              Small
+              {
+                Tag = Small
+              }
+              Large
+              {
+                VO = vo2
+                Tag = Fast, Large
+                MaxRAM = 16000
+              }
+            }
+          }
+        }
+      }
+      Cloud.VO1.org
+      {
+        VO = vo1
+        Cloud
+        {
+          a.vo1.org
+          {
+            CEType = OpenStack
+            VMTypes
+            {
+              Default
+              {
+                Image = EL7
+              }
+            }
+          }
+          b.vo1.org
+          {
+            CEType = OpenNebula
+            VO = vo1, vo2
+            VMTypes
+            {
+              Default
+              {
+                Image = EL9
+              }
+              Special
+              {
+                VO = vo3
+              }
+            }
+          }
+        }
+      }
+      Cloud.VO2.org
+      {
+        Cloud
+        {
+          vo2.org
+          {
+            CEType = OpenStack
+            VO = vo2
+            VMTypes
+            {
+              Default
+              {
+              }
+            }
+          }
+        }
+      }
+      Cloud.Legacy.org
+      {
+        Cloud
+        {
+          legacy.org
+          {
+            CEType = Occi
+            Images
+            {
+              OldImage
+              {
+                VO = vo1
+                Flavor = m1.small
+              }
+            }
+          }
+        }
+      }
+    }
+    LCG
+    {
+      LCG.Grid.org
+      {
+        CE = ce.grid.org
+      }
+    }
+  }
+}
+"""
+
+SITES = [None, ['Cloud.Open.org'], ['Cloud.VO1.org', 'Cloud.Legacy.org'], ['Cloud.Unknown.org']]
+CES = [None, ['open.org'], ['b.vo1.org', 'vo2.org', 'legacy.org']]
+VMTYPES = [None, ['Default'], ['Large', 'OldImage', 'Special']]
+VOS = [None, 'vo1', 'vo2', 'vo3', 'vo4']
+
+
+class CFGConfig(object):
+  """ gConfig replacement reading a CFG object
+  """
+
+  def __init__(self, cfg):
+    self.cfg = cfg
+
+  def __getSection(self, path):
+    section = self.cfg
+    for name in path.strip('/').split('/'):
+      if not section.isSection(name):
+        return None
+      section = section[name]
+    return section
+
+  def getSections(self, path):
+    section = self.__getSection(path)
+    if section is None:
+      return S_ERROR("Path %s does not exist or it's not a section" % path)
+    return S_OK(section.listSections())
+
+  def getOptionsDict(self, path):
+    section = self.__getSection(path)
+    if section is None:
+      return S_ERROR("Path %s does not exist or it's not a section" % path)
+    return S_OK(dict((option, section[option]) for option in section.listOptions()))
+
+  def getValue(self, path, defaultValue=None):
+    return self.cfg.getOption(path, defaultValue)
+
+
+class CSVersion(object):
+  """ gConfigurationData replacement with a settable version
+  """
+
+  def __init__(self):
+    self.version = '1'
+
+  def getVersion(self):
+    return self.version
+
+
+def legacyGetVMTypes(gConfig, siteList=None, ceList=None, vmTypeList=None, vo=None):
+  """ ConfigHelper.getVMTypes() before the catalogue
+  """
+  result = gConfig.getSections('/Resources/Sites')
+  if not result['OK']:
+    return result
+  resultDict = {}
+  for grid in result['Value']:
+    result = gConfig.getSections('/Resources/Sites/%s' % grid)
+    if not result['OK']:
+      continue
+    for site in result['Value']:
+      if siteList is not None and site not in siteList:
+        continue
+      if vo:
+        voList = gConfig.getValue('/Resources/Sites/%s/%s/VO' % (grid, site), [])
+        if voList and vo not in voList:
+          continue
+      result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud' % (grid, site))
+      if not result['OK']:
+        continue
+      for ce in result['Value']:
+        if ceList is not None and ce not in ceList:
+          continue
+        cePath = '/Resources/Sites/%s/%s/Cloud/%s' % (grid, site, ce)
+        if vo:
+          voList = gConfig.getValue('%s/VO' % cePath, [])
+          if voList and vo not in voList:
+            continue
+        result = gConfig.getOptionsDict(cePath)
+        if not result['OK']:
+          continue
+        ceOptionsDict = result['Value']
+        result = gConfig.getSections('%s/VMTypes' % cePath)
+        if not result['OK']:
+          result = gConfig.getSections('%s/Images' % cePath)
+          if not result['OK']:
+            return result
+        for vmType in result['Value']:
+          if vmTypeList is not None and vmType not in vmTypeList:
+            continue
+          if vo:
+            voList = gConfig.getValue('%s/VMTypes/%s/VO' % (cePath, vmType), [])
+            if not voList:
+              voList = gConfig.getValue('%s/Images/%s/VO' % (cePath, vmType), [])
+            if voList and vo not in voList:
+              continue
+          resultDict.setdefault(site, {})
+          resultDict[site].setdefault(ce, ceOptionsDict)
+          resultDict[site][ce].setdefault('VMTypes', {})
+          result = gConfig.getOptionsDict('%s/VMTypes/%s' % (cePath, vmType))
+          if not result['OK']:
+            result = gConfig.getOptionsDict('%s/Images/%s' % (cePath, vmType))
+            if not result['OK']:
+              continue
+          resultDict[site][ce]['VMTypes'][vmType] = result['Value']
+  return S_OK(resultDict)
+
+
+def legacyGetVMTypeConfig(gConfig, site, ce='', vmtype=''):
+  """ ConfigHelper.getVMTypeConfig() before the catalogue
+  """
+  Tags = []
+  grid = site.split('.')[0]
+  if not ce:
+    result = gConfig.getSections('/Resources/Sites/%s/%s/Cloud' % (grid, site))
+    if not result['OK']:
+      return result
+    if len(result['Value']) != 1:
+      return S_ERROR('No cloud endpoint specified')
+    ce = result['Value'][0]
+  result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s' % (grid, site, ce))
+  if not result['OK']:
+    return result
+  resultDict = result['Value']
+  if resultDict.get('Tag'):
+    Tags = fromChar(resultDict['Tag'])
+  resultDict['CEName'] = ce
+  if vmtype:
+    result = gConfig.getOptionsDict('/Resources/Sites/%s/%s/Cloud/%s/VMTypes/%s' % (grid, site, ce, vmtype))
+    if not result['OK']:
+      return result
+    resultDict.update(result['Value'])
+    if resultDict.get('Tag'):
+      Tags = list(set(Tags + fromChar(resultDict['Tag'])))
+  if Tags:
+    resultDict['Tag'] = Tags
+  resultDict['VMType'] = vmtype
+  resultDict['Site'] = site
+  return S_OK(resultDict)
+
+
+def sortedTags(result):
+  """ The order of the merged tags is not defined
+  """
+  if result['OK'] and isinstance(result['Value'].get('Tag'), list):
+    result['Value']['Tag'] = sorted(result['Value']['Tag'])
+  return result
+
+
+@pytest.fixture
+def csConfig(monkeypatch):
+  config = CFGConfig(CFG().loadFromBuffer(RESOURCES))
+  monkeypatch.setattr(catalogueModule, 'gConfig', config)
+  monkeypatch.setattr(catalogueModule, 'gConfigurationData', CSVersion())
+  return config
+
+
+@pytest.fixture
+def catalogue(csConfig):
+  return catalogueModule.CloudResourceCatalogue()
+
+
+def test_getVMTypes(csConfig, catalogue):
+  """ All the selections give the result of the CS lookups
+  """
+  for siteList, ceList, vmTypeList, vo in itertools.product(SITES, CES, VMTYPES, VOS):
+    expected = legacyGetVMTypes(csConfig, siteList=siteList, ceList=ceList, vmTypeList=vmTypeList, vo=vo)
+    result = catalogue.getVMTypes(siteList=siteList, ceList=ceList, vmTypeList=vmTypeList, vo=vo)
+    assert result == expected, (siteList, ceList, vmTypeList, vo)
+
+
+def test_getVMTypesVO(catalogue):
+  """ The site, endpoint and VM type VO restrictions all apply
+  """
+  result = catalogue.getVMTypes(vo='vo2')
+  assert result['OK'], result.get('Message')
+  assert sorted(result['Value']) == ['Cloud.Open.org', 'Cloud.VO2.org']
+  assert sorted(result['Value']['Cloud.Open.org']['open.org']['VMTypes']) == ['Large', 'Small']
+
+  result = catalogue.getVMTypes(vo='vo1')
+  assert result['OK'], result.get('Message')
+  assert sorted(result['Value']['Cloud.VO1.org']) == ['a.vo1.org', 'b.vo1.org']
+  assert list(result['Value']['Cloud.VO1.org']['b.vo1.org']['VMTypes']) == ['Default']
+  assert list(result['Value']['Cloud.Legacy.org']['legacy.org']['VMTypes']) == ['OldImage']
+
+  # vo3 is only allowed by a VM type of an endpoint restricted to other VOs
+  result = catalogue.getVMTypes(vo='vo3')
+  assert result['OK'], result.get('Message')
+  assert 'Cloud.VO1.org' not in result['Value']
+
+
+def test_getVMTypesCopies(catalogue):
+  """ The returned dictionaries can be modified by the callers
+  """
+  result = catalogue.getVMTypes(siteList='Cloud.Open.org')
+  result['Value']['Cloud.Open.org']['open.org']['VMTypes'].pop('Small')
+  result = catalogue.getVMTypes(siteList='Cloud.Open.org')
+  assert 'Small' in result['Value']['Cloud.Open.org']['open.org']['VMTypes']
+
+
+def test_getVMTypeConfig(csConfig, catalogue):
+  """ The VM type parameters are the ones of the CS lookups, the legacy Images are rejected
+  """
+  for site in ['Cloud.Open.org', 'Cloud.VO1.org', 'Cloud.VO2.org', 'Cloud.Legacy.org', 'Cloud.Unknown.org',
+               'LCG.Grid.org', 'Other.Open.org']:
+    for ce in ['', 'open.org', 'a.vo1.org', 'b.vo1.org', 'vo2.org', 'legacy.org', 'unknown.org']:
+      for vmType in ['', 'Small', 'Large', 'Default', 'Special', 'OldImage', 'Unknown']:
+        expected = sortedTags(legacyGetVMTypeConfig(csConfig, site, ce, vmType))
+        result = sortedTags(catalogue.getVMTypeConfig(site, ce, vmType))
+        assert result['OK'] == expected['OK'], (site, ce, vmType, result)
+        if expected['OK']:
+          assert result['Value'] == expected['Value'], (site, ce, vmType)
+
+  result = catalogue.getVMTypeConfig('Cloud.Legacy.org', 'legacy.org', 'OldImage')
+  assert not result['OK']
+  result = catalogue.getVMTypeConfig('Cloud.Open.org', vmtype='Large')
+  assert result['OK'], result.get('Message')
+  assert sorted(result['Value']['Tag']) == ['Cloud', 'Fast', 'Large']
+
+
+def test_missingVMTypes(csConfig, monkeypatch):
+  """ An endpoint without VMTypes nor Images makes the selections including it fail
+  """
+  cfg = CFG().loadFromBuffer(RESOURCES)
+  cfg['Resources']['Sites']['Cloud']['Cloud.VO2.org']['Cloud']['vo2.org'].deleteKey('VMTypes')
+  config = CFGConfig(cfg)
+  monkeypatch.setattr(catalogueModule, 'gConfig', config)
+  catalogue = catalogueModule.CloudResourceCatalogue()
+
+  assert not catalogue.getVMTypes()['OK']
+  assert not legacyGetVMTypes(config)['OK']
+  assert catalogue.getVMTypes(vo='vo1') == legacyGetVMTypes(config, vo='vo1')
+
+
+def test_reload(csConfig, catalogue):
+  """ The catalogue is only rebuilt when the CS version changes
+  """
+  assert 'Cloud.Open.org' in catalogue.getVMTypes()['Value']
+  csConfig.cfg['Resources']['Sites']['Cloud'].deleteKey('Cloud.Open.org')
+  assert 'Cloud.Open.org' in catalogue.getVMTypes()['Value']
+  catalogueModule.gConfigurationData.version = '2'
+  assert 'Cloud.Open.org' not in catalogue.getVMTypes()['Value']
@@ -0,0 +1,103 @@
+""" Unit tests of the LazyEndpoint handles of the EndpointFactory
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pytest
+
+from DIRAC import S_OK
+from VMDIRAC.Resources.Cloud.EndpointFactory import EndpointFactory, LazyEndpoint
+
+
+class FakeEndpoint(object):
+  """ Endpoint class recording its instantiations
+  """
+  instances = []
+
+  def __init__(self, parameters=None):
+    if parameters.get('Fail'):
+      raise ValueError('cannot reach %s' % parameters.get('CEName'))
+    self.parameters = dict(parameters)
+    self.bootstrapParameters = {}
+    self.valid = True
+    FakeEndpoint.instances.append(self)
+
+  def isValid(self):
+    return self.valid
+
+  def setParameters(self, parameters):
+    self.parameters.update(parameters)
+
+  def setBootstrapParameters(self, bootstrapParameters):
+    self.bootstrapParameters.update(bootstrapParameters)
+
+  def createInstances(self, vmsToSubmit):
+    return S_OK(['vm%d' % i for i in range(vmsToSubmit)])
+
+
+def lazyEndpoint(**parameters):
+  FakeEndpoint.instances = []
+  parameters.setdefault('CEName', 'cloud.test.org')
+  return LazyEndpoint(FakeEndpoint, parameters, 'FakeEndpoint')
+
+
+def test_connectOnFirstUse():
+  """ The endpoint is only instantiated on the first attribute access, and only once
+  """
+  endpoint = lazyEndpoint()
+  assert not endpoint.isConnected()
+  assert not FakeEndpoint.instances
+
+  assert endpoint.createInstances(2) == S_OK(['vm0', 'vm1'])
+  assert endpoint.isConnected()
+  assert len(FakeEndpoint.instances) == 1
+
+  assert endpoint.parameters['CEName'] == 'cloud.test.org'
+  assert endpoint.isValid()
+  assert endpoint.connect() == S_OK(FakeEndpoint.instances[0])
+  assert len(FakeEndpoint.instances) == 1
+
+
+def test_parametersBeforeConnection():
+  """ The parameters set before the connection are given to the endpoint
+  """
+  endpoint = lazyEndpoint(MaxInstances=10)
+  endpoint.setParameters({'MaxInstances': 20, 'User': 'user'})
+  endpoint.setBootstrapParameters({'Setup': 'Test'})
+  endpoint.setBootstrapParameters({'CAPath': '/etc/grid-security/certificates'})
+  assert not endpoint.isConnected()
+
+  assert endpoint.parameters == {'CEName': 'cloud.test.org', 'MaxInstances': 20, 'User': 'user'}
+  assert endpoint.bootstrapParameters == {'Setup': 'Test', 'CAPath': '/etc/grid-security/certificates'}
+
+  # After the connection they are set on the endpoint
+  endpoint.setParameters({'MaxInstances': 30})
+  endpoint.setBootstrapParameters({'Setup': 'Other'})
+  assert FakeEndpoint.instances[0].parameters['MaxInstances'] == 30
+  assert FakeEndpoint.instances[0].bootstrapParameters['Setup'] == 'Other'
+
+
+def test_failingConstructor():
+  """ An endpoint which can not be instantiated is invalid and its methods return S_ERROR
+  """
+  endpoint = lazyEndpoint(Fail=True)
+  result = endpoint.createInstances(2)
+  assert not result['OK']
+  assert 'cannot reach cloud.test.org' in result['Message']
+  assert endpoint.isConnected()
+  assert not endpoint.isValid()
+  assert not endpoint.connect()['OK']
+
+  with pytest.raises(AttributeError, match='cannot reach cloud.test.org'):
+    endpoint.parameters  # pylint: disable=pointless-statement
+
+
+def test_warmUp():
+  """ The handles are connected in parallel, the failing ones do not count as valid
+  """
+  endpoints = [lazyEndpoint(), lazyEndpoint(Fail=True), lazyEndpoint(CEName='other.test.org'), object()]
+  assert EndpointFactory().warmUp(endpoints, threads=2) == S_OK(2)
+  assert all(endpoint.isConnected() for endpoint in endpoints[:3])
+  assert EndpointFactory().warmUp(endpoints) == S_OK(0)
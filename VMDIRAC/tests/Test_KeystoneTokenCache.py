@@ -0,0 +1,100 @@
+""" Unit tests of the KeystoneTokenCache
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import stat
+import time
+
+import pytest
+
+from VMDIRAC.Resources.Cloud.KeystoneTokenCache import KeystoneTokenCache
+
+URL = 'https://keystone.test.org:5000/v3'
+IDENTITY = 'user'
+PROJECT = 'project'
+
+
+def tokenEntry(lifetime, token='token'):
+  """ Cache entry of a token expiring in lifetime seconds
+  """
+  return {'Token': token, 'Expires': time.time() + lifetime, 'ComputeURL': 'https://nova.test.org/v2.1'}
+
+
+@pytest.fixture
+def cacheFile(tmp_path):
+  return str(tmp_path / 'keystoneTokens.json')
+
+
+def test_putGet(cacheFile):
+  """ The tokens are found in the process and through the file by another process
+  """
+  entry = tokenEntry(3600)
+  cache = KeystoneTokenCache()
+  cache.put(URL, IDENTITY, PROJECT, entry, cacheFile=cacheFile)
+  assert cache.get(URL, IDENTITY, PROJECT) == entry
+  assert cache.get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) == entry
+
+  # The key includes the identity and the project
+  assert cache.get(URL, 'other', PROJECT, cacheFile=cacheFile) is None
+  assert cache.get(URL, IDENTITY, None, cacheFile=cacheFile) is None
+
+  # A new cache object only has the file entries
+  otherCache = KeystoneTokenCache()
+  assert otherCache.get(URL, IDENTITY, PROJECT) is None
+  assert otherCache.get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) == entry
+  assert otherCache.get(URL, IDENTITY, PROJECT) == entry
+
+  # The returned entries are copies
+  otherCache.get(URL, IDENTITY, PROJECT)['Token'] = 'modified'
+  assert otherCache.get(URL, IDENTITY, PROJECT) == entry
+
+  # The entries of the file are merged
+  otherEntry = tokenEntry(3600, token='otherToken')
+  otherCache.put(URL, IDENTITY, None, otherEntry, cacheFile=cacheFile)
+  with open(cacheFile) as cacheContent:
+    assert sorted(fileEntry['Token'] for fileEntry in json.load(cacheContent).values()) == ['otherToken', 'token']
+
+
+def test_minLifetime(cacheFile):
+  """ Tokens expiring in less than minLifetime seconds are not returned
+  """
+  cache = KeystoneTokenCache(minLifetime=300)
+  cache.put(URL, IDENTITY, PROJECT, tokenEntry(100), cacheFile=cacheFile)
+  assert cache.get(URL, IDENTITY, PROJECT) is None
+  assert cache.get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) is None
+  assert KeystoneTokenCache(minLifetime=60).get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) is not None
+
+  # The expired entries are removed from the file
+  cache.put(URL, IDENTITY, None, tokenEntry(-10), cacheFile=cacheFile)
+  cache.put(URL, 'other', PROJECT, tokenEntry(3600), cacheFile=cacheFile)
+  with open(cacheFile) as cacheContent:
+    assert len(json.load(cacheContent)) == 2
+
+
+def test_corruptedFile(cacheFile):
+  """ A corrupted cache file is ignored and replaced by the next token
+  """
+  with open(cacheFile, 'w') as cacheContent:
+    cacheContent.write('{"truncated": {"Token": ')
+  cache = KeystoneTokenCache()
+  assert cache.get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) is None
+
+  entry = tokenEntry(3600)
+  cache.put(URL, IDENTITY, PROJECT, entry, cacheFile=cacheFile)
+  assert KeystoneTokenCache().get(URL, IDENTITY, PROJECT, cacheFile=cacheFile) == entry
+
+
+def test_permissions(cacheFile):
+  """ The cache file is only readable by its owner, even if it existed before
+  """
+  KeystoneTokenCache().put(URL, IDENTITY, PROJECT, tokenEntry(3600), cacheFile=cacheFile)
+  assert stat.S_IMODE(os.stat(cacheFile).st_mode) == 0o600
+
+  os.chmod(cacheFile, 0o644)
+  KeystoneTokenCache().put(URL, IDENTITY, PROJECT, tokenEntry(3600), cacheFile=cacheFile)
+  assert stat.S_IMODE(os.stat(cacheFile).st_mode) == 0o600
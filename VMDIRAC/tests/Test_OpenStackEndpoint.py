@@ -0,0 +1,126 @@
+""" Unit tests of the paginated server listing of the OpenStackEndpoint
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import pytest
+
+from DIRAC import S_OK
+from VMDIRAC.Resources.Cloud.OpenStackEndpoint import OpenStackEndpoint
+
+COMPUTE_URL = 'https://nova.test.org:8774/v2.1'
+
+
+class FakeResponse(object):
+  """ requests.Response replacement
+  """
+
+  def __init__(self, output, statusCode=200):
+    self.status_code = statusCode
+    self.text = json.dumps(output)
+
+
+def server(serverID, status='ACTIVE', ip=None):
+  """ Server description as returned by the servers listing
+  """
+  serverDict = {'id': serverID, 'name': 'DIRAC_%s' % serverID, 'status': status}
+  if ip:
+    serverDict['addresses'] = {'private': [{'addr': '10.0.0.1', 'OS-EXT-IPS:type': 'fixed'},
+                                           {'addr': ip, 'OS-EXT-IPS:type': 'floating'}]}
+  return serverDict
+
+
+def page(servers, nextURL=None):
+  """ Page of the servers listing, linked to the next one
+  """
+  output = {'servers': servers}
+  if nextURL:
+    output['servers_links'] = [{'rel': 'next', 'href': nextURL}]
+  return FakeResponse(output)
+
+
+class FakeRequest(object):
+  """ OpenStackEndpoint.__request() replacement returning the pages of the listed URLs
+  """
+
+  def __init__(self, pages):
+    self.pages = pages
+    self.calls = []
+
+  def __call__(self, method, url, **kwargs):
+    self.calls.append((method, url, kwargs.get('params')))
+    return self.pages[url]
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+  monkeypatch.setattr(OpenStackEndpoint, 'initialize', lambda self: S_OK())
+  openStackEndpoint = OpenStackEndpoint({'CEName': 'cloud.test.org'})
+  openStackEndpoint.initialized = True
+  openStackEndpoint.computeURL = COMPUTE_URL
+  return openStackEndpoint
+
+
+def fakeRequest(monkeypatch, endpoint, pages):
+  request = FakeRequest(pages)
+  monkeypatch.setattr(endpoint, '_OpenStackEndpoint__request', request)
+  return request
+
+
+def test_pages(monkeypatch, endpoint):
+  """ The servers of all the pages are yielded, with the filters sent in the first request
+  """
+  secondURL = '%s/servers/detail?limit=2&name=%%5EDIRAC_&marker=vm2' % COMPUTE_URL
+  request = fakeRequest(monkeypatch, endpoint,
+                        {'%s/servers/detail' % COMPUTE_URL: page([server('vm1', ip='1.2.3.4'), server('vm2')],
+                                                                 secondURL),
+                         secondURL: page([server('vm3', status='ERROR')])})
+
+  vms = list(endpoint.iterVMs(pageSize=2))
+  assert vms == [{'ID': 'vm1', 'Name': 'DIRAC_vm1', 'Status': 'ACTIVE', 'PublicIP': '1.2.3.4'},
+                 {'ID': 'vm2', 'Name': 'DIRAC_vm2', 'Status': 'ACTIVE', 'PublicIP': None},
+                 {'ID': 'vm3', 'Name': 'DIRAC_vm3', 'Status': 'ERROR', 'PublicIP': None}]
+  # The next link carries the filters and the marker
+  assert request.calls == [('GET', '%s/servers/detail' % COMPUTE_URL, {'limit': 2, 'name': '^DIRAC_'}),
+                           ('GET', secondURL, None)]
+
+
+def test_filters(monkeypatch, endpoint):
+  """ The name filter and one status per listing are sent to the server
+  """
+  request = fakeRequest(monkeypatch, endpoint, {'%s/servers/detail' % COMPUTE_URL: page([server('vm1')])})
+  assert [vm['ID'] for vm in endpoint.iterVMs(namePattern='^DIRAC_vm', statusList=['ACTIVE', 'ERROR'])] == \
+      ['vm1', 'vm1']
+  assert [params for _method, _url, params in request.calls] == \
+      [{'limit': 1000, 'name': '^DIRAC_vm', 'status': 'ACTIVE'},
+       {'limit': 1000, 'name': '^DIRAC_vm', 'status': 'ERROR'}]
+
+  # Without details nor name filter, as for getVMIDs()
+  request = fakeRequest(monkeypatch, endpoint, {'%s/servers' % COMPUTE_URL: page([{'id': 'vm1'}])})
+  assert endpoint.getVMIDs() == S_OK(['vm1'])
+  assert request.calls == [('GET', '%s/servers' % COMPUTE_URL, {'limit': 1000})]
+
+
+def test_emptyPage(monkeypatch, endpoint):
+  """ An empty page stops the listing even if it links to another page
+  """
+  secondURL = '%s/servers/detail?marker=vm1' % COMPUTE_URL
+  thirdURL = '%s/servers/detail?marker=none' % COMPUTE_URL
+  request = fakeRequest(monkeypatch, endpoint,
+                        {'%s/servers/detail' % COMPUTE_URL: page([server('vm1')], secondURL),
+                         secondURL: page([], thirdURL)})
+  assert [vm['ID'] for vm in endpoint.iterVMs()] == ['vm1']
+  assert len(request.calls) == 2
+
+
+def test_error(monkeypatch, endpoint):
+  """ A failed listing raises IOError, getVMIDs() returns S_ERROR
+  """
+  fakeRequest(monkeypatch, endpoint, {'%s/servers' % COMPUTE_URL: FakeResponse({'error': 'denied'}, 403)})
+  with pytest.raises(IOError, match='denied'):
+    list(endpoint.iterVMs(detail=False))
+  assert not endpoint.getVMIDs()['OK']
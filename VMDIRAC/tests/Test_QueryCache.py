@@ -0,0 +1,150 @@
+""" Unit tests of the QueryCache of the VirtualMachineManager
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import pytest
+
+from DIRAC import S_OK, S_ERROR
+from VMDIRAC.WorkloadManagementSystem.Utilities import QueryCache as queryCacheModule
+
+
+class FakeTime(object):
+  """ Replacement of the time module with a settable clock
+  """
+
+  def __init__(self):
+    self.now = 1000000.
+
+  def time(self):
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  fakeTime = FakeTime()
+  monkeypatch.setattr(queryCacheModule, 'time', fakeTime)
+  return fakeTime
+
+
+class CountingQuery(object):
+  """ Query function counting its calls
+  """
+
+  def __init__(self, results=None):
+    self.calls = []
+    self.results = list(results or [])
+
+  def __call__(self, *args):
+    self.calls.append(args)
+    if self.results:
+      return self.results.pop(0)
+    return S_OK(list(args))
+
+
+def cachedResults(cache):
+  return cache._QueryCache__results
+
+
+def test_cached(clock):
+  """ Identical requests of the same interval are served from the cache
+  """
+  cache = queryCacheModule.QueryCache(interval=60)
+  query = CountingQuery()
+  assert cache.getResult('history', [3600, 900], query) == S_OK([3600, 900])
+  clock.now += 10
+  assert cache.getResult('history', [3600, 900], query) == S_OK([3600, 900])
+  assert len(query.calls) == 1
+
+  # Other arguments or another query name are other results
+  assert cache.getResult('history', [3600, 300], query) == S_OK([3600, 300])
+  assert cache.getResult('running', [3600, 900], query) == S_OK([3600, 900])
+  assert len(query.calls) == 3
+
+  # The dictionaries in the arguments are normalized
+  cache.getResult('values', [{'a': 1, 'b': 2}], query)
+  cache.getResult('values', [{'b': 2, 'a': 1}], query)
+  assert len(query.calls) == 4
+
+
+def test_singleFlight(clock):
+  """ Concurrent identical requests run the query once and all get its result
+  """
+  cache = queryCacheModule.QueryCache(interval=60)
+  started = threading.Event()
+  release = threading.Event()
+  calls = []
+
+  def query(timespan):
+    calls.append(timespan)
+    started.set()
+    release.wait(10)
+    return S_OK(timespan)
+
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(cache.getResult('history', [3600], query)))
+             for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  assert started.wait(10)
+  release.set()
+  for thread in threads:
+    thread.join(10)
+  assert calls == [3600]
+  assert results == [S_OK(3600)] * 8
+
+
+def test_failuresNotCached(clock):
+  """ Failed queries are not kept, the next request runs the query again
+  """
+  cache = queryCacheModule.QueryCache(interval=60)
+  query = CountingQuery([S_ERROR('MySQL server has gone away'), S_OK('history')])
+  assert not cache.getResult('history', [3600], query)['OK']
+  assert cache.getResult('history', [3600], query) == S_OK('history')
+  assert len(query.calls) == 2
+  assert cache.getResult('history', [3600], query) == S_OK('history')
+  assert len(query.calls) == 2
+
+  def failing(timespan):
+    raise RuntimeError('lost connection')
+
+  result = cache.getResult('failing', [3600], failing)
+  assert not result['OK']
+  assert 'lost connection' in result['Message']
+  assert len(cachedResults(cache)) == 1
+
+
+def test_purgeByInterval(clock):
+  """ The results of past intervals are recomputed and purged
+  """
+  cache = queryCacheModule.QueryCache(interval=60)
+  query = CountingQuery()
+  cache.getResult('history', [3600], query)
+  cache.getResult('history', [86400], query)
+  assert len(cachedResults(cache)) == 2
+
+  clock.now += 60
+  cache.getResult('history', [3600], query)
+  assert len(query.calls) == 3
+  # Only the result of the current interval is left
+  assert len(cachedResults(cache)) == 1
+
+
+def test_purgeByMaxSize(clock):
+  """ The oldest results are dropped when the cache is full
+  """
+  cache = queryCacheModule.QueryCache(interval=60, maxSize=2)
+  query = CountingQuery()
+  for timespan in [300, 600, 900, 1200]:
+    cache.getResult('history', [timespan], query)
+    assert len(cachedResults(cache)) <= 2
+  # The last result is still cached
+  cache.getResult('history', [1200], query)
+  assert len(query.calls) == 4
+
+  cache.clear()
+  assert not cachedResults(cache)
@@ -0,0 +1,298 @@
+""" Unit tests of VirtualMachineDB, with the MySQL calls mocked
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import random
+import sqlite3
+import datetime
+import threading
+
+import pytest
+
+from DIRAC import S_OK, gLogger
+from VMDIRAC.WorkloadManagementSystem.DB import VirtualMachineDB as vmDBModule
+
+# uniqueID -> ( InstanceID, Status, ErrorMessage, VMImageID, image Status, image ErrorMessage )
+INSTANCES = {'vm-running': (1, 'Running', '', 10, 'Validated', ''),
+             'vm-submitted': (2, 'Submitted', '', 10, 'Validated', ''),
+             'vm-halted': (3, 'Halted', '', 10, 'Validated', ''),
+             'vm-raced': (4, 'Running', '', 10, 'Validated', '')}
+
+
+class FakeMySQL(object):
+  """ Replacement of the DIRAC MySQL calls used by the heartbeat path
+  """
+
+  def __init__(self, statusAfterUpdate, insertedRows):
+    self.statusAfterUpdate = statusAfterUpdate
+    self.insertedRows = insertedRows
+    self.transactions = []
+
+  def query(self, cmd):
+    if 'LEFT JOIN `vm_Images`' in cmd:
+      return S_OK(tuple((uniqueID, ) + row for uniqueID, row in INSTANCES.items() if '"%s"' % uniqueID in cmd))
+    # Status of the instances after the transaction
+    instanceIDs = [int(instanceID) for instanceID in cmd.split('IN (')[-1].strip(' )').split(',')]
+    return S_OK(tuple((row[0], self.statusAfterUpdate.get(uniqueID, 'Running'))
+                      for uniqueID, row in INSTANCES.items() if row[0] in instanceIDs))
+
+  def transaction(self, cmdList):
+    self.transactions.append(cmdList)
+    # Like MySQL._transaction(), a list of ( command, number of affected rows )
+    return S_OK([(cmd, self.insertedRows if cmd.startswith('INSERT') else 0) for cmd in cmdList])
+
+
+@pytest.fixture
+def vmDB(monkeypatch):
+  """ VirtualMachineDB object without a MySQL connection
+  """
+  monkeypatch.setattr(vmDBModule.DB, '__init__', lambda self, *args, **kwargs: None)
+  monkeypatch.setattr(vmDBModule.VirtualMachineDB, '_VirtualMachineDB__initializeDB', lambda self: S_OK())
+  db = vmDBModule.VirtualMachineDB()
+  monkeypatch.setattr(db, 'log', gLogger.getSubLogger('VirtualMachineDB'), raising=False)
+  monkeypatch.setattr(db, '_escapeValues', lambda values: S_OK(['"%s"' % value for value in values]), raising=False)
+  return db
+
+
+def test_instanceIDHeartBeats(vmDB, monkeypatch):
+  """ Each uniqueID gets the result instanceIDHeartBeat would have returned
+  """
+  # vm-raced is halted between the status check and the transaction
+  mysql = FakeMySQL({'vm-raced': 'Halted'}, 2)
+  monkeypatch.setattr(vmDB, '_query', mysql.query, raising=False)
+  monkeypatch.setattr(vmDB, '_transaction', mysql.transaction, raising=False)
+
+  result = vmDB.instanceIDHeartBeats([('vm-running', 1.5, 2, 3, 4, 100),
+                                      ('vm-submitted', 0.5, 1, 0, 0),
+                                      ('vm-halted', 0.1, 0, 0, 0, 10),
+                                      ('vm-raced', 0.1, 0, 0, 0, 10),
+                                      ('vm-unknown', 0.1, 0, 0, 0, 10),
+                                      ('vm-invalid', 'high', 0, 0, 0, 10)])
+  assert result['OK'], result.get('Message')
+  resultDict = result['Value']
+  assert sorted(resultDict) == sorted(['vm-running', 'vm-submitted', 'vm-halted', 'vm-raced',
+                                       'vm-unknown', 'vm-invalid'])
+  assert resultDict['vm-running']['OK']
+  assert resultDict['vm-submitted']['OK']
+  # Not allowed transitions come with the directive for the VM
+  assert not resultDict['vm-halted']['OK']
+  assert resultDict['vm-halted']['State'] == 'halt'
+  assert not resultDict['vm-raced']['OK']
+  assert resultDict['vm-raced']['State'] == 'halt'
+  assert not resultDict['vm-unknown']['OK']
+  assert not resultDict['vm-invalid']['OK']
+
+  # One explicit transaction for all the heartbeats
+  assert len(mysql.transactions) == 1
+  cmdList = mysql.transactions[0]
+  assert cmdList[0] == 'START TRANSACTION'
+  assert cmdList[-1] == 'COMMIT'
+  assert cmdList[1].startswith('INSERT INTO `vm_History`')
+
+
+def test_instanceIDHeartBeat(vmDB, monkeypatch):
+  """ The single heartbeat goes through the bulk path
+  """
+  mysql = FakeMySQL({}, 1)
+  monkeypatch.setattr(vmDB, '_query', mysql.query, raising=False)
+  monkeypatch.setattr(vmDB, '_transaction', mysql.transaction, raising=False)
+
+  assert vmDB.instanceIDHeartBeat('vm-running', 1.5, 2, 3, 4, 100)['OK']
+  result = vmDB.instanceIDHeartBeat('vm-halted', 1.5, 2, 3, 4, 100)
+  assert not result['OK']
+  assert result['State'] == 'halt'
+  assert not vmDB.instanceIDHeartBeat('vm-unknown', 1.5, 2, 3, 4, 100)['OK']
+
+
+def test_historyBufferWriteFailure(vmDB, monkeypatch):
+  """ The buffer thread survives a failed write and writes the next records
+  """
+  written = []
+
+  def update(cmd):
+    if not written:
+      written.append(None)
+      raise RuntimeError('MySQL server has gone away')
+    written.append(cmd)
+    return S_OK(1)
+
+  monkeypatch.setattr(vmDB, '_update', update, raising=False)
+  vmDB.enableHistoryBuffer(flushSize=1, flushInterval=0.01)
+  vmDB._VirtualMachineDB__addInstanceHistory(1, 'Running')
+  vmDB._VirtualMachineDB__addInstanceHistory(2, 'Running')
+  vmDB.flushHistoryBuffer(timeout=5)
+  assert len(written) == 2
+  assert written[1].startswith('INSERT INTO `vm_History`')
+  assert '( 2, "Running"' in written[1]
+
+
+def test_historyBufferFlushFull(vmDB, monkeypatch):
+  """ Flushing a full buffer gives up after the timeout
+  """
+  release = threading.Event()
+  monkeypatch.setattr(vmDB, '_update', lambda cmd: release.wait(5) and S_OK(1), raising=False)
+  vmDB.enableHistoryBuffer(maxSize=1, flushSize=1, flushInterval=0.01, putTimeout=0.01)
+  try:
+    vmDB._VirtualMachineDB__addInstanceHistory(1, 'Running')
+    # Wait for the thread to be blocked writing the first record, then fill the buffer
+    deadline = time.time() + 5
+    while not vmDB._VirtualMachineDB__historyQueue.empty() and time.time() < deadline:
+      time.sleep(0.01)
+    vmDB._VirtualMachineDB__historyQueue.put((2, 'Running', 0., '', 0, 0, 0))
+    start = time.time()
+    assert vmDB.flushHistoryBuffer(timeout=0.2)['OK']
+    assert time.time() - start < 2
+  finally:
+    release.set()
+
+
+def baselineHistoryRecords(dbData, fields2Get):
+  """ Post-processing of getHistoryValues() before the NumPy version, on records
+      as ( InstanceID, bucket, values... )
+  """
+  cumulativeFields = ['Jobs', 'TransferredFiles', 'TransferredBytes']
+  requireExtension = set(i for i, f in enumerate(fields2Get) if f in cumulativeFields)
+  if requireExtension:
+    rDates = []
+    for row in dbData:
+      if row[1] not in rDates:
+        rDates.append(row[1])
+    vmData = {}
+    for row in dbData:
+      vmData.setdefault(row[0], {})[row[1]] = row[2:]
+    rDates.sort()
+    dbData = []
+    for vmID in vmData:
+      prevValues = []
+      for rDate in rDates:
+        if rDate not in vmData[vmID]:
+          if prevValues:
+            dbData.append([rDate] + list(prevValues))
+        else:
+          row = vmData[vmID][rDate]
+          prevValues = [row[i] if i in requireExtension else 0 for i in range(len(row))]
+          dbData.append([rDate] + list(row))
+  else:
+    dbData = [row[1:] for row in dbData]
+
+  sumData = {}
+  for record in dbData:
+    sumData.setdefault(record[0], [0.0] * len(record[1:]))
+    for i, value in enumerate(record[1:]):
+      sumData[record[0]][i] += float(value)
+  finalData = []
+  if sumData:
+    firstValues = sumData[sorted(sumData)[0]]
+    for date in sorted(sumData):
+      finalData.append([date])
+      for i, value in enumerate(sumData[date]):
+        finalData[-1].append(max(0, value - firstValues[i]) if i in requireExtension else value)
+  return finalData
+
+
+def randomHistoryRecords(rng, fields2Get):
+  """ Records as ( InstanceID, bucket, values... ) ordered by bucket, the instances having
+      gaps in their history and starting late
+  """
+  start = datetime.datetime(2021, 3, 1)
+  buckets = [start + datetime.timedelta(seconds=900 * i) for i in range(rng.randint(1, 40))]
+  dbData = []
+  for bucketIndex, bucket in enumerate(buckets):
+    bucketData = []
+    for instanceID in range(1, rng.randint(2, 30)):
+      # Late start of the instance and random gaps
+      if bucketIndex < instanceID % 7 or rng.random() < 0.3:
+        continue
+      values = []
+      for field in fields2Get:
+        if field == 'Load':
+          values.append(rng.random() * 8)
+        elif field == 'TransferredBytes':
+          values.append(rng.randint(0, 10 ** 12))
+        else:
+          values.append(rng.randint(0, 1000))
+      bucketData.append((instanceID, bucket) + tuple(values))
+    # The order of the records of a bucket is not defined
+    rng.shuffle(bucketData)
+    dbData += bucketData
+  return dbData
+
+
+@pytest.mark.parametrize('fields2Get', [['Load', 'Jobs', 'TransferredFiles', 'TransferredBytes'],
+                                        ['Load'],
+                                        ['Jobs'],
+                                        ['TransferredBytes', 'Load']])
+@pytest.mark.parametrize('useNumPy', [False, True])
+def test_getHistoryValues(vmDB, monkeypatch, fields2Get, useNumPy):
+  """ The pure Python and NumPy post-processing give the Records of the former code
+  """
+  if useNumPy and vmDBModule.numpy is None:
+    pytest.skip('NumPy is not available')
+  if not useNumPy:
+    monkeypatch.setattr(vmDBModule, 'numpy', None)
+
+  rng = random.Random(1234)
+  for _ in range(50):
+    dbData = randomHistoryRecords(rng, fields2Get)
+
+    def query(cmd):
+      if 'vm_HistoryRollupState' in cmd:
+        return S_OK(())
+      # The query returns ( bucket, InstanceID, values... )
+      return S_OK(tuple((row[1], row[0]) + row[2:] for row in dbData))
+
+    monkeypatch.setattr(vmDB, '_query', query, raising=False)
+    result = vmDB.getHistoryValues(900, fields2Get=list(fields2Get), timespan=86400)
+    assert result['OK'], result.get('Message')
+    assert result['Value']['ParameterNames'] == ['Update'] + fields2Get
+    assert result['Value']['Records'] == baselineHistoryRecords(dbData, fields2Get)
+
+
+def test_keysetConditionText(vmDB, monkeypatch):
+  """ NULL cursor values: nothing is before NULL in DESC order, everything not NULL is after it in ASC order
+  """
+  monkeypatch.setattr(vmDB, '_escapeString', lambda value: S_OK("'%s'" % value), raising=False)
+  getKeysetCondition = vmDB._VirtualMachineDB__getKeysetCondition
+
+  sortFields = [('inst.Endpoint', 'ASC'), ('inst.LastUpdate', 'DESC'), ('inst.InstanceID', 'DESC')]
+  assert getKeysetCondition(sortFields, [None, None, 7]) == \
+      "( ( inst.Endpoint IS NOT NULL ) OR ( inst.Endpoint IS NULL AND inst.LastUpdate IS NULL " \
+      "AND ( inst.InstanceID < '7' OR inst.InstanceID IS NULL ) ) )"
+  assert getKeysetCondition(sortFields, ['ce', '2021-03-01', 7]) == \
+      "( ( inst.Endpoint > 'ce' ) OR ( inst.Endpoint = 'ce' AND ( inst.LastUpdate < '2021-03-01' " \
+      "OR inst.LastUpdate IS NULL ) ) OR ( inst.Endpoint = 'ce' AND inst.LastUpdate = '2021-03-01' " \
+      "AND ( inst.InstanceID < '7' OR inst.InstanceID IS NULL ) ) )"
+  assert getKeysetCondition([('inst.Endpoint', 'DESC')], [None]) == "FALSE"
+
+
+@pytest.mark.parametrize('directions', [('ASC', 'ASC', 'ASC'), ('ASC', 'DESC', 'DESC'),
+                                        ('DESC', 'ASC', 'ASC'), ('DESC', 'DESC', 'DESC')])
+def test_keysetCondition(vmDB, monkeypatch, directions):
+  """ For each record taken as cursor, the condition selects exactly the records after it
+      in the sort order, with NULL values sorted first as in MySQL, checked with SQLite
+  """
+  monkeypatch.setattr(vmDB, '_escapeString', lambda value: S_OK("'%s'" % value.replace("'", "''")),
+                      raising=False)
+  connection = sqlite3.connect(':memory:')
+  connection.execute("CREATE TABLE inst ( InstanceID INTEGER PRIMARY KEY, Endpoint TEXT, Load REAL )")
+  rng = random.Random(42)
+  rows = [(instanceID, rng.choice([None, 'ce1', 'ce2', "o'ce"]), rng.choice([None, 0.5, 1, 2.25]))
+          for instanceID in range(1, 80)]
+  connection.executemany("INSERT INTO inst VALUES ( ?, ?, ? )", rows)
+
+  sortFields = [('inst.Endpoint', directions[0]), ('inst.Load', directions[1]), ('inst.InstanceID', directions[2])]
+  orderBy = ", ".join(["%s %s" % sortField for sortField in sortFields])
+  ordered = connection.execute("SELECT InstanceID, Endpoint, Load FROM inst ORDER BY %s" % orderBy).fetchall()
+  # SQLite sorts the NULL values first in ascending order, like MySQL
+  assert ordered[0][1] is None or directions[0] == 'DESC'
+
+  getKeysetCondition = vmDB._VirtualMachineDB__getKeysetCondition
+  for position, (instanceID, endpoint, load) in enumerate(ordered):
+    sqlCond = getKeysetCondition(sortFields, [endpoint, load, instanceID])
+    after = connection.execute("SELECT InstanceID, Endpoint, Load FROM inst WHERE %s ORDER BY %s" %
+                               (sqlCond, orderBy)).fetchall()
+    assert after == ordered[position + 1:], (endpoint, load, instanceID, sqlCond)
@@ -0,0 +1,220 @@
+""" Check with EXPLAIN that the hot VirtualMachineDB queries use the indexes of the table
+    descriptions. The test needs MySQLdb and a scratch MySQL/MariaDB database, whose
+    VirtualMachineDB tables are dropped and recreated, given by the environment, e.g.::
+
+      VMDIRAC_TEST_DB_HOST=localhost VMDIRAC_TEST_DB_USER=Dirac VMDIRAC_TEST_DB_PASSWORD=pass \\
+      VMDIRAC_TEST_DB_NAME=VMTest pytest VMDIRAC/tests/Test_VirtualMachineDBIndexes.py
+
+    It is skipped when VMDIRAC_TEST_DB_HOST is not set.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+
+import pytest
+
+from DIRAC import S_OK, S_ERROR
+from VMDIRAC.WorkloadManagementSystem.DB import VirtualMachineDB as vmDBModule
+
+pytestmark = pytest.mark.skipif(not os.environ.get('VMDIRAC_TEST_DB_HOST'),
+                                reason='VMDIRAC_TEST_DB_HOST is not set')
+
+N_INSTANCES = 20000
+N_HISTORY = 200000
+
+
+def createTables(cursor):
+  """ Create the tables of VirtualMachineDB.tablesDesc like DB._createTables() does
+  """
+  for tableName, tableDesc in vmDBModule.VirtualMachineDB.tablesDesc.items():
+    cursor.execute("DROP TABLE IF EXISTS `%s`" % tableName)
+    definitions = ["`%s` %s" % (field, fieldType) for field, fieldType in tableDesc['Fields'].items()]
+    primaryKey = tableDesc.get('PrimaryKey')
+    if primaryKey:
+      if not isinstance(primaryKey, list):
+        primaryKey = [primaryKey]
+      definitions.append("PRIMARY KEY ( %s )" % ", ".join(["`%s`" % key for key in primaryKey]))
+    for indexName, columns in tableDesc.get('Indexes', {}).items():
+      definitions.append("INDEX `%s` ( %s )" % (indexName, ", ".join(["`%s`" % column for column in columns])))
+    cursor.execute("CREATE TABLE `%s` ( %s ) ENGINE=InnoDB" % (tableName, ", ".join(definitions)))
+
+
+def fillTables(cursor):
+  """ Fill the tables with a production like distribution: most instances are terminated
+      long ago, a few are running, and the history spans 30 days
+  """
+  cursor.execute("INSERT INTO `vm_Images` ( `Name`, `Status`, `LastUpdate` ) "
+                 "VALUES ( 'Image', 'Validated', UTC_TIMESTAMP() )")
+  instances = []
+  for instanceID in range(1, N_INSTANCES + 1):
+    if instanceID > N_INSTANCES - 200:
+      status, age = random.choice(['Running', 'Submitted']), random.randint(0, 7200)
+    else:
+      status, age = random.choice(['Halted', 'Halted', 'Halted', 'Error', 'Stalled']), random.randint(86400, 90 * 86400)
+    instances.append((instanceID, 'Pod', 'Image', 'Site::ce%d' % (instanceID % 10), 'vm-%d' % instanceID, 1,
+                      status, age))
+  cursor.executemany("INSERT INTO `vm_Instances` ( `InstanceID`, `RunningPod`, `Name`, `Endpoint`, `UniqueID`, "
+                     "`VMImageID`, `Status`, `LastUpdate` ) "
+                     "VALUES ( %s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP() - INTERVAL %s SECOND )", instances)
+  for start in range(0, N_HISTORY, 10000):
+    history = [(random.randint(1, N_INSTANCES), random.choice(['Running', 'Running', 'Halted']),
+                random.random() * 8, random.randint(0, 100), random.randint(0, 30 * 86400))
+               for _ in range(start, min(N_HISTORY, start + 10000))]
+    cursor.executemany("INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Jobs`, `Update` ) "
+                       "VALUES ( %s, %s, %s, %s, UTC_TIMESTAMP() - INTERVAL %s SECOND )", history)
+  for tableName in ['vm_Images', 'vm_Instances', 'vm_History']:
+    cursor.execute("ANALYZE TABLE `%s`" % tableName)
+    cursor.fetchall()
+
+
+class ExplainingMySQL(object):
+  """ Replacement of the DIRAC MySQL calls running the queries on the test database,
+      and keeping the EXPLAIN output of every SELECT
+  """
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.plans = []
+
+  def __execute(self, cmd):
+    cursor = self.connection.cursor()
+    try:
+      rowCount = cursor.execute(cmd)
+      return rowCount, cursor.fetchall()
+    finally:
+      cursor.close()
+
+  def explain(self, cmd):
+    """ Get the EXPLAIN output of a query as a list of dictionaries
+    """
+    cursor = self.connection.cursor()
+    try:
+      cursor.execute("EXPLAIN %s" % cmd)
+      names = [column[0].lower() for column in cursor.description]
+      return [dict(zip(names, row)) for row in cursor.fetchall()]
+    finally:
+      cursor.close()
+
+  def query(self, cmd, conn=None):
+    if cmd.lstrip().upper().startswith('SELECT'):
+      self.plans.append((cmd, self.explain(cmd)))
+    try:
+      return S_OK(self.__execute(cmd)[1])
+    except Exception as e:  # pylint: disable=broad-except
+      return S_ERROR(repr(e))
+
+  def update(self, cmd, conn=None):
+    try:
+      return S_OK(self.__execute(cmd)[0])
+    except Exception as e:  # pylint: disable=broad-except
+      return S_ERROR(repr(e))
+
+  def transaction(self, cmdList, conn=None):
+    cmdRet = []
+    try:
+      for cmd in cmdList:
+        cmdRet.append((cmd, self.__execute(cmd)[0]))
+      self.connection.commit()
+    except Exception as e:  # pylint: disable=broad-except
+      self.connection.rollback()
+      return S_ERROR(repr(e))
+    return S_OK(cmdRet)
+
+  def escapeString(self, value):
+    return S_OK(self.connection.literal(str(value)).decode('utf-8'))
+
+  def escapeValues(self, values):
+    return S_OK([self.escapeString(value)['Value'] for value in values])
+
+  def getPlans(self, fragment):
+    """ Get the plans of the queries containing the given fragment
+    """
+    return [plan for cmd, plan in self.plans if fragment in cmd]
+
+
+@pytest.fixture(scope='module')
+def connection():
+  MySQLdb = pytest.importorskip('MySQLdb')
+  conn = MySQLdb.connect(host=os.environ['VMDIRAC_TEST_DB_HOST'],
+                         port=int(os.environ.get('VMDIRAC_TEST_DB_PORT', 3306)),
+                         user=os.environ.get('VMDIRAC_TEST_DB_USER', 'Dirac'),
+                         passwd=os.environ.get('VMDIRAC_TEST_DB_PASSWORD', ''),
+                         db=os.environ.get('VMDIRAC_TEST_DB_NAME', 'VMTest'))
+  conn.autocommit(True)
+  cursor = conn.cursor()
+  createTables(cursor)
+  fillTables(cursor)
+  cursor.close()
+  yield conn
+  conn.close()
+
+
+@pytest.fixture
+def mysql(connection):
+  return ExplainingMySQL(connection)
+
+
+@pytest.fixture
+def vmDB(monkeypatch, mysql):
+  """ VirtualMachineDB object sending its queries to the test database
+  """
+  monkeypatch.setattr(vmDBModule.DB, '__init__', lambda self, *args, **kwargs: None)
+  monkeypatch.setattr(vmDBModule.VirtualMachineDB, '_VirtualMachineDB__initializeDB', lambda self: S_OK())
+  db = vmDBModule.VirtualMachineDB()
+  for method, replacement in [('_query', mysql.query), ('_update', mysql.update),
+                              ('_transaction', mysql.transaction), ('_escapeString', mysql.escapeString),
+                              ('_escapeValues', mysql.escapeValues)]:
+    monkeypatch.setattr(db, method, replacement, raising=False)
+  return db
+
+
+def checkIndexes(plans, table, indexes):
+  """ Check that the accesses to the table in the plans use one of the given indexes
+  """
+  rows = [row for plan in plans for row in plan if row.get('table') == table]
+  assert rows, 'No access to %s in %s' % (table, plans)
+  for row in rows:
+    assert row.get('key') in indexes, 'Access to %s without the %s indexes: %s' % (table, indexes, row)
+    assert row.get('type') != 'ALL', 'Full scan of %s: %s' % (table, row)
+
+
+def test_heartbeatQueries(vmDB, mysql):
+  """ The heartbeat status check finds the instances by UniqueID
+  """
+  uniqueIDs = ['vm-%d' % instanceID for instanceID in range(N_INSTANCES - 50, N_INSTANCES + 1)]
+  result = vmDB.instanceIDHeartBeats([(uniqueID, 1.0, 1, 0, 0, 60) for uniqueID in uniqueIDs])
+  assert result['OK'], result.get('Message')
+  checkIndexes(mysql.getPlans('i.UniqueID IN'), 'i', ['UniqueID'])
+
+
+def test_stalledScan(vmDB, mysql):
+  """ The stalled scan reads the old instances of the active states with a range on the Status index
+  """
+  result = vmDB.declareStalledInstances()
+  assert result['OK'], result.get('Message')
+  checkIndexes(mysql.getPlans('LastUpdate <'), 'vm_Instances', ['Status'])
+
+
+def test_instanceCounters(vmDB, mysql):
+  """ The counters of the director are computed from the index on Endpoint and Status
+  """
+  result = vmDB.getEndpointInstanceCounters({'Status': ['New', 'Submitted', 'Running']})
+  assert result['OK'], result.get('Message')
+  checkIndexes(mysql.getPlans('GROUP BY `Endpoint`, `Status`'), 'vm_Instances', ['EndpointStatus', 'Status'])
+
+
+def test_historyQueries(vmDB, mysql):
+  """ The history of the last hours is read with a range on the Update indexes,
+      the history of an instance with the InstanceID index
+  """
+  result = vmDB.getRunningInstancesHistory(timespan=6 * 3600, bucketSize=900)
+  assert result['OK'], result.get('Message')
+  checkIndexes(mysql.getPlans("h.`Status` = 'Running'"), 'h', ['StatusUpdate', 'Update'])
+
+  result = vmDB.getHistoryForInstanceID(N_INSTANCES)
+  assert result['OK'], result.get('Message')
+  checkIndexes(mysql.getPlans('FROM `vm_History` WHERE InstanceId='), 'vm_History', ['InstanceID'])
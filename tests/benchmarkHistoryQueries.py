@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+""" Benchmark of the time window predicates of the VirtualMachineDB history queries
+
+    The script fills the vm_Images, vm_Instances and vm_History tables of a scratch database
+    with synthetic records, if not already filled, and times the five history queries as they
+    were written before, with TIMESTAMPDIFF() predicates and bucket expressions, against the
+    queries built by the current VirtualMachineDB, with a range on the Update field and integer
+    bucket keys. The rollups are not used, both forms read vm_History.
+
+    The range predicates are expected to use the Update indexes of vm_History where the
+    TIMESTAMPDIFF() ones can not. How much faster they are depends on the database: run
+    the script on a representative one before relying on a speedup.
+
+    It needs DIRAC, MySQLdb and a scratch database, for example::
+
+      python tests/benchmarkHistoryQueries.py --host localhost --user Dirac --password pass \\
+        --db VMBenchmark --rows 50000000
+"""
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import argparse
+import random
+import time
+
+import MySQLdb
+
+from DIRAC import S_OK, gLogger
+from VMDIRAC.WorkloadManagementSystem.DB.VirtualMachineDB import VirtualMachineDB
+
+__RCSID__ = "$Id$"
+
+# The queries of the VirtualMachineDB methods before the range predicates
+OLD_QUERIES = {
+    'getHistoryValues':
+        "SELECT `InstanceID`, FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %(bucket)d),"
+        " SUM(`Load`)/COUNT(`Load`), MAX(`Jobs`), MAX(`TransferredFiles`), MAX(`TransferredBytes`)"
+        " FROM `vm_History` WHERE TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %(timespan)d"
+        " GROUP BY FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %(bucket)d), InstanceID"
+        " ORDER BY `Update` ASC",
+    'getRunningInstancesHistory':
+        "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %(bucket)d ),"
+        " COUNT( DISTINCT( `InstanceID` ) ) FROM `vm_History`"
+        " WHERE `Status` = 'Running' AND TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %(timespan)d"
+        " GROUP BY FROM_UNIXTIME(UNIX_TIMESTAMP( `Update` ) - UNIX_TIMESTAMP( `Update` ) mod %(bucket)d )"
+        " ORDER BY `Update` ASC",
+    'getRunningInstancesBEPHistory':
+        "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ),"
+        "  i.Endpoint, COUNT( DISTINCT( h.`InstanceID` ) )  FROM `vm_History` h, `vm_Instances` i"
+        " WHERE  h.InstanceID = i.InstanceID AND h.`Status` = 'Running'"
+        " AND TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %(timespan)d"
+        " GROUP BY FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ) ,"
+        " EndPoint ORDER BY `Update` ASC",
+    'getRunningInstancesByRunningPodHistory':
+        "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ),"
+        "  i.RunningPod, COUNT( DISTINCT( h.`InstanceID` ) )  FROM `vm_History` h, `vm_Instances` i"
+        " WHERE  h.InstanceID = i.InstanceID AND h.`Status` = 'Running'"
+        " AND TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %(timespan)d"
+        " GROUP BY FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ) ,"
+        " RunningPod ORDER BY `Update` ASC",
+    'getRunningInstancesByImageHistory':
+        "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ),"
+        "  ins.Name, COUNT( DISTINCT( h.`InstanceID` ) )"
+        "  FROM `vm_History` h, `vm_Images` img, `vm_Instances` ins"
+        " WHERE  h.InstanceID = ins.InstanceID AND img.VMImageID = ins.VMImageID AND h.`Status` = 'Running'"
+        " AND TIMESTAMPDIFF( SECOND, `Update`, UTC_TIMESTAMP() ) < %(timespan)d"
+        " GROUP BY FROM_UNIXTIME(UNIX_TIMESTAMP( h.`Update` ) - UNIX_TIMESTAMP( h.`Update` ) mod %(bucket)d ) ,"
+        " ins.Name ORDER BY `Update` ASC",
+}
+
+
+class QueryBuilder(VirtualMachineDB):
+  """ VirtualMachineDB without a database connection, giving the SQL of its history queries
+  """
+
+  def __init__(self):  # pylint: disable=super-init-not-called
+    self.log = gLogger.getSubLogger('QueryBuilder')
+    self.lastQuery = None
+
+  def _query(self, cmd, conn=None):
+    # No rollup state is returned, so that the queries only read vm_History
+    if 'vm_HistoryRollupState' not in cmd:
+      self.lastQuery = cmd
+    return S_OK(())
+
+  def getQuery(self, method, timespan, bucket):
+    """ Get the query of a history method of VirtualMachineDB
+
+    :param str method: name of the method
+    :param int timespan: time span in seconds
+    :param int bucket: bucket size in seconds
+    :return: SQL query
+    """
+    self.lastQuery = None
+    if method == 'getHistoryValues':
+      result = self.getHistoryValues(bucket, timespan=timespan)
+    else:
+      result = getattr(self, method)(timespan=timespan, bucketSize=bucket)
+    if not result['OK']:
+      raise RuntimeError('%s: %s' % (method, result['Message']))
+    return self.lastQuery
+
+
+def createTables(cursor, rows, instances, days, batchSize):
+  """ Create the history tables as described by VirtualMachineDB and fill them unless
+      vm_History already has the requested number of rows
+  """
+  for tableName in ['vm_Images', 'vm_Instances', 'vm_History']:
+    tableDesc = VirtualMachineDB.tablesDesc[tableName]
+    definitions = ["`%s` %s" % (field, fieldType) for field, fieldType in tableDesc['Fields'].items()]
+    primaryKey = tableDesc.get('PrimaryKey')
+    if primaryKey:
+      if not isinstance(primaryKey, list):
+        primaryKey = [primaryKey]
+      definitions.append("PRIMARY KEY ( %s )" % ", ".join(["`%s`" % key for key in primaryKey]))
+    for indexName, columns in tableDesc.get('Indexes', {}).items():
+      definitions.append("INDEX `%s` ( %s )" % (indexName, ", ".join(["`%s`" % column for column in columns])))
+    cursor.execute("CREATE TABLE IF NOT EXISTS `%s` ( %s ) ENGINE=InnoDB" % (tableName, ", ".join(definitions)))
+
+  cursor.execute("SELECT COUNT(*) FROM `vm_Instances`")
+  if cursor.fetchone()[0] < instances:
+    cursor.execute("DELETE FROM `vm_Instances`")
+    cursor.execute("DELETE FROM `vm_Images`")
+    cursor.executemany("INSERT INTO `vm_Images` ( `VMImageID`, `Name`, `Status`, `LastUpdate` ) "
+                       "VALUES ( %s, %s, 'Validated', UTC_TIMESTAMP() )",
+                       [(imageID, 'Image%d' % imageID) for imageID in range(1, 11)])
+    for start in range(1, instances + 1, batchSize):
+      cursor.executemany("INSERT INTO `vm_Instances` ( `InstanceID`, `RunningPod`, `Name`, `Endpoint`, "
+                         "`UniqueID`, `VMImageID`, `Status`, `LastUpdate` ) "
+                         "VALUES ( %s, %s, %s, %s, %s, %s, 'Halted', UTC_TIMESTAMP() )",
+                         [(instanceID, 'Pod%d' % (instanceID % 5), 'VMType%d' % (instanceID % 20),
+                           'Site%d::ce' % (instanceID % 50), 'vm-%d' % instanceID, instanceID % 10 + 1)
+                          for instanceID in range(start, min(instances + 1, start + batchSize))])
+
+  cursor.execute("SELECT COUNT(*) FROM `vm_History`")
+  existing = cursor.fetchone()[0]
+  if existing >= rows:
+    print("Table vm_History already has %d rows" % existing)
+    return
+
+  now = int(time.time())
+  span = days * 86400
+  sqlInsert = "INSERT INTO `vm_History` ( `InstanceID`, `Status`, `Load`, `Jobs`, `TransferredFiles`," \
+              " `TransferredBytes`, `Update` ) VALUES "
+  start = time.time()
+  inserted = existing
+  while inserted < rows:
+    values = []
+    for _ in range(min(batchSize, rows - inserted)):
+      status = 'Running' if random.random() < 0.9 else 'Halted'
+      values.append("( %d, '%s', %.2f, %d, %d, %d, FROM_UNIXTIME( %d ) )" %
+                    (random.randint(1, instances), status, random.random() * 8,
+                     random.randint(0, 100), random.randint(0, 1000), random.randint(0, 10 ** 9),
+                     now - random.randint(0, span)))
+    cursor.execute(sqlInsert + ", ".join(values))
+    inserted += len(values)
+    if inserted % (batchSize * 100) < batchSize:
+      print("  %d rows inserted ( %.0f s )" % (inserted, time.time() - start))
+  for tableName in ['vm_Images', 'vm_Instances', 'vm_History']:
+    cursor.execute("ANALYZE TABLE `%s`" % tableName)
+    cursor.fetchall()
+
+
+def timeQuery(cursor, sqlQuery, repeat):
+  """ Run the query repeat times and get the best time and the number of rows
+  """
+  best = None
+  nRows = 0
+  for _ in range(repeat):
+    start = time.time()
+    cursor.execute(sqlQuery)
+    nRows = len(cursor.fetchall())
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, nRows
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=3306)
+  parser.add_argument('--user', default='Dirac')
+  parser.add_argument('--password', default='')
+  parser.add_argument('--db', default='VMBenchmark')
+  parser.add_argument('--rows', type=int, default=50000000, help='number of history records')
+  parser.add_argument('--instances', type=int, default=20000, help='number of distinct instances')
+  parser.add_argument('--days', type=int, default=180, help='time span of the records in days')
+  parser.add_argument('--batch', type=int, default=5000, help='records inserted per statement')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per query, the best one is kept')
+  args = parser.parse_args()
+
+  connection = MySQLdb.connect(host=args.host, port=args.port, user=args.user, passwd=args.password, db=args.db)
+  connection.autocommit(True)
+  cursor = connection.cursor()
+  createTables(cursor, args.rows, args.instances, args.days, args.batch)
+
+  builder = QueryBuilder()
+  print("%-38s %10s %10s %12s %12s %8s" % ('Query', 'Timespan', 'Bucket', 'Old (s)', 'New (s)', 'Speedup'))
+  for timespan, bucket in [(3600, 300), (86400, 900), (7 * 86400, 3600), (30 * 86400, 86400)]:
+    for method in sorted(OLD_QUERIES):
+      params = {'timespan': timespan, 'bucket': bucket}
+      oldTime, oldRows = timeQuery(cursor, OLD_QUERIES[method] % params, args.repeat)
+      newTime, newRows = timeQuery(cursor, builder.getQuery(method, timespan, bucket), args.repeat)
+      if oldRows != newRows:
+        print("WARNING: %s returned %d rows with the old query and %d with the new one" %
+              (method, oldRows, newRows))
+      speedup = oldTime / max(newTime, 1e-6)
+      print("%-38s %10d %10d %12.3f %12.3f %7.1fx" % (method, timespan, bucket, oldTime, newTime, speedup))
+
+  cursor.close()
+  connection.close()
+
+
+if __name__ == '__main__':
+  main()